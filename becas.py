@@ -45,24 +45,52 @@ __email__ = 'tiago.nunes@ua.pt'
 
 
 __all__ = ('email', 'tool', 'timeout', 'secure',
-           'SEMANTIC_GROUPS', 'EXPORT_FORMATS',
-           'annotate_text', 'export_text',
-           'annotate_publication', 'export_publication', 'main',
+           'pool_connections', 'pool_maxsize', 'workers', 'rate_limiter',
+           'retry', 'cache', 'memory_cache', 'chunk_size', 'superset_groups',
+           'json_codec',
+           'hooks', 'metrics', 'concurrency', 'base_url',
+           'SEMANTIC_GROUPS', 'EXPORT_FORMATS', 'CHUNKED_FORMATS',
+           'LOCAL_EXPORT_FORMATS', 'FILTERED_FORMATS',
+           'BecasClient', 'Metrics', 'Histogram', 'RequestInfo', 'HOOKS',
+           'RateLimiter', 'AdaptiveConcurrency', 'Balancer',
+           'BalancedInstance', 'RetryPolicy',
+           'ResultCache',
+           'MemoryCache', 'SentenceIndex',
+           'AnnotationResult', 'Entity', 'Concept', 'AnnotationIndex',
+           'annotate_text', 'export_text', 'export_text_formats',
+           'annotate_publication', 'export_publication',
+           'annotate_texts', 'annotate_publications', 'BatchResult',
+           'JSONLinesWriter', 'main',
            'BecasException', 'AuthenticationRequired', 'InvalidGroups',
            'InvalidFormat', 'TooMuchText', 'TooManyRequests',
            'PublicationNotFound', 'ServiceUnavailable',
            'ConnectionError', 'SSLError', 'Timeout',)
 
 
+import io
+import os
+import re
 import sys
 import time
 import json
+import array
+import bisect
+import random
+import hashlib
+import weakref
+import threading
+import collections
 try:
     from urllib.parse import quote
 except ImportError:
     from urllib import quote  # NOQA
+try:
+    _string_types = (basestring,)  # NOQA
+except NameError:
+    _string_types = (str,)
 
-import requests  # urllib2 sucks badly, we depend on requests
+# requests (urllib2 sucks badly, we depend on it) is imported on first use, so
+# the command-line tool and modules that only import us start up quickly
 
 
 # -- Configuration parameters - you can set these from your modules -----------
@@ -76,6 +104,51 @@ timeout = 120
 #: Whether to use HTTPS or plain HTTP
 secure = False
 
+#: Base URL of the becas API, e.g. ``'http://localhost:8080/becas/api/'``,
+#: a list of base URLs of instances to balance requests over, or a
+#: :class:`Balancer`. If ``None``, the public becas API
+base_url = None
+
+#: Number of per-host connection pools kept by the default client
+pool_connections = 10
+#: Maximum number of connections kept alive in each pool
+pool_maxsize = 10
+#: Number of worker threads used by batch API methods
+workers = 4
+#: :class:`RateLimiter` shared by clients without their own. If ``None``,
+#: requests are limited to two per second, the becas API usage limit
+rate_limiter = None
+#: :class:`AdaptiveConcurrency` shared by clients without their own. If
+#: ``None``, requests in flight are only bounded by the number of workers
+concurrency = None
+#: :class:`RetryPolicy` for transient errors. If ``None``, errors are raised
+#: on the first failure
+retry = None
+#: :class:`ResultCache` shared by clients without their own. If ``None``,
+#: results are not cached
+cache = None
+#: :class:`MemoryCache` of PubMed publication results shared by clients
+#: without their own. If ``None``, publication results are not memoized
+memory_cache = None
+#: Maximum characters per request when annotating text in chunks
+chunk_size = 20000
+#: Semantic groups to annotate with whenever they include those asked for,
+#: as a :class:`dict` like ``groups`` or ``True`` for all
+#: :data:`SEMANTIC_GROUPS`, filtering results to the groups asked for
+#: locally. If ``None``, requests are made with the groups asked for. As
+#: the service resolves mentions overlapping across groups, results filtered
+#: from a superset may differ from those asked for the groups alone
+superset_groups = None
+#: JSON library used to encode requests and decode results (``'orjson'``,
+#: ``'ujson'`` or ``'json'``). If ``None``, the fastest one installed
+json_codec = None
+#: :class:`dict` of hooks of clients without their own, mapping events of
+#: :data:`HOOKS` to a callable or list of callables
+hooks = None
+#: :class:`Metrics` shared by clients created without their own. If ``None``,
+#: each client records its own
+metrics = None
+
 
 # -- Internal constants - do not touch these ----------------------------------
 #: Semantic groups usable as keys of a ``groups`` :class:`dict`
@@ -83,18 +156,34 @@ SEMANTIC_GROUPS = ('SPEC', 'ANAT', 'DISO', 'PATH', 'CHED', 'ENZY',
                    'MRNA', 'PRGE', 'COMP', 'FUNC', 'PROC',)
 #: Output formats available for the :func:`export_text` function
 EXPORT_FORMATS = ('json', 'xml', 'a1', 'conll',)
+#: Output formats of :func:`export_text` that support chunked annotation
+CHUNKED_FORMATS = ('a1', 'conll',)
+#: Output formats of :func:`export_text` that can be filtered to semantic
+#: groups locally, see :data:`superset_groups`
+FILTERED_FORMATS = ('json', 'a1',)
+#: Output formats of :func:`export_text_formats` that can be rendered from a
+#: single JSON export, without a request each, see ``render_locally``
+LOCAL_EXPORT_FORMATS = ('json', 'a1', 'conll',)
+#: Client events that hooks can be registered for
+HOOKS = ('before_request', 'after_request', 'retry', 'throttle',)
+# shared group strings, so concepts don't keep a copy each
+_SEMANTIC_GROUPS = dict((group, group) for group in SEMANTIC_GROUPS)
 
 _ENDPOINTS_PREFIX = 'bioinformatics.ua.pt/becas/api/'
-_TEXT_ANNOTATE_ENDPOINT = _ENDPOINTS_PREFIX + 'text/annotate'
-_TEXT_EXPORT_ENDPOINT = _ENDPOINTS_PREFIX + 'text/export'
-_PUBMED_ANNOTATE_ENDPOINT = _ENDPOINTS_PREFIX + 'pubmed/annotate/'  # + PMID
-_PUBMED_EXPORT_ENDPOINT = _ENDPOINTS_PREFIX + 'pubmed/export/'  # + PMID
-
-_DEFAULT_HEADERS = {
-    'User-Agent': 'becas-python/%s %s' % (
-        __version__, requests.utils.default_user_agent()),
+_ENDPOINT_PATHS = {
+    'annotate_text': 'text/annotate',
+    'export_text': 'text/export',
+    'annotate_publication': 'pubmed/annotate/',  # + PMID
+    'export_publication': 'pubmed/export/',  # + PMID
+}
+
+_DEFAULT_HEADERS = {  # + User-Agent, see _default_headers()
     'Content-Type': 'application/json',
+    'Accept-Encoding': 'gzip, deflate',
 }
+_REQUEST_ENCODINGS = ('gzip', 'deflate',)
+_COMPRESS_MIN_SIZE = 1024  # bytes of smallest request body to compress
+_RESEND = object()  # the service asked for the request body uncompressed
 
 
 # -- Exceptions ---------------------------------------------------------------
@@ -159,13 +248,2083 @@ class SSLError(ConnectionError):
     '''An SSL error occurred.'''
 
 
+# -- Rate limiting ------------------------------------------------------------
+_clock = getattr(time, 'monotonic', time.time)
+
+
+class RateLimiter(object):
+    '''Thread-safe token bucket limiting the rate of requests.
+
+    The bucket holds at most ``burst`` tokens and is refilled with ``rate``
+    tokens per second. Each request takes one token, waiting for it to be
+    refilled if the bucket is empty.
+
+    :param rate: *optional* requests per second (default: 2).
+    :param burst: *optional* requests allowed back to back before throttling
+                  kicks in (default: 1).
+
+    Tokens are reserved without blocking through :meth:`reserve`, so the same
+    limiter can be shared by threads and asyncio coroutines. Any object
+    providing :meth:`reserve`, :meth:`acquire` and :meth:`pause` can be used as
+    a client ``rate_limiter``.
+
+    Usage::
+
+      >>> import becas
+      >>> limiter = becas.RateLimiter(rate=10, burst=5)
+      >>> [limiter.reserve() for i in range(5)]
+      [0, 0, 0, 0, 0]
+      >>> limiter.reserve() > 0
+      True
+
+    '''
+
+    def __init__(self, rate=2, burst=1):
+        if rate <= 0 or burst < 1:
+            raise ValueError('``rate`` must be positive and ``burst`` at '
+                             'least 1')
+        self.rate = float(rate)
+        self.burst = burst
+        #: Number of requests that went through the limiter
+        self.requests = 0
+        #: Number of requests that had to wait for a token
+        self.throttled = 0
+        #: Total seconds requests waited for a token
+        self.waited = 0.0
+        self._tokens = float(burst)
+        self._updated = _clock()
+        self._lock = threading.Lock()
+
+    def reserve(self, tokens=1):
+        '''Take ``tokens`` from the bucket and return seconds to wait until
+        they are available. Never blocks.'''
+
+        with self._lock:
+            now = _clock()
+            self._tokens = min(self.burst, self._tokens +
+                               (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens -= tokens
+            self.requests += 1
+            if self._tokens >= 0:
+                return 0
+            wait = -self._tokens / self.rate
+            self.throttled += 1
+            self.waited += wait
+            return wait
+
+    def acquire(self, tokens=1):
+        '''Take ``tokens`` from the bucket, sleeping until they are available.
+        Return seconds slept.'''
+
+        wait = self.reserve(tokens)
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+    def pause(self, seconds):
+        '''Hold back every request for at least ``seconds``, e.g. after the
+        service asked clients to back off.'''
+
+        with self._lock:
+            now = _clock()
+            self._tokens = min(self.burst, self._tokens +
+                               (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens = min(self._tokens, -seconds * self.rate)
+
+    def stats(self):
+        '''Return a :class:`dict` with throttling statistics.'''
+
+        with self._lock:
+            return {'requests': self.requests,
+                    'throttled': self.throttled,
+                    'waited': self.waited}
+
+
+_shared_rate_limiter = RateLimiter()
+
+
+class AdaptiveConcurrency(object):
+    '''Thread-safe limit of requests in flight, tuned at runtime by additive
+    increase and multiplicative decrease (AIMD).
+
+    The limit grows by ``increase`` for every round of ``limit`` successful
+    requests, and is multiplied by ``decrease`` when the service shows signs
+    of overload: :class:`TooManyRequests`, :class:`ServiceUnavailable`,
+    :class:`Timeout`, or recent latency above ``latency_tolerance`` times the
+    long term average. It shrinks at most once per round, as requests already
+    in flight report the same overload.
+
+    :param initial: *optional* initial limit (default: 4).
+    :param minimum: *optional* lowest limit (default: 1).
+    :param maximum: *optional* highest limit (default: 64).
+    :param increase: *optional* limit added per round (default: 1).
+    :param decrease: *optional* limit factor on overload (default: 0.5).
+    :param latency_tolerance: *optional* ratio of recent to long term
+                              latency taken as overload (default: 2). If
+                              ``None``, latency is ignored.
+    :param rate_limiter: *optional* :class:`RateLimiter` whose rate is tuned
+                         alike, between a tenth of its initial rate and its
+                         initial rate.
+
+    Batch methods of clients using a limiter run ``maximum`` workers by
+    default, and let it decide how many are sending requests.
+
+    Usage::
+
+      >>> import becas
+      >>> limiter = becas.AdaptiveConcurrency(initial=4)
+      >>> token = limiter.acquire()
+      >>> limiter.release(token, 0.1)
+      >>> limiter.limit
+      4.25
+      >>> token = limiter.acquire()
+      >>> limiter.release(token, 0.1, becas.ServiceUnavailable())
+      >>> limiter.limit
+      2.125
+
+    '''
+
+    def __init__(self, initial=4, minimum=1, maximum=64, increase=1,
+                 decrease=0.5, latency_tolerance=2, rate_limiter=None):
+        if not 1 <= minimum <= initial <= maximum or not 0 < decrease < 1:
+            raise ValueError('Limits must be 1 <= minimum <= initial <= '
+                             'maximum and ``decrease`` between 0 and 1')
+        #: Current limit of requests in flight
+        self.limit = float(initial)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.increase = increase
+        self.decrease = decrease
+        self.latency_tolerance = latency_tolerance
+        self.rate_limiter = rate_limiter
+        self.max_rate = rate_limiter.rate if rate_limiter else None
+        #: Number of requests in flight
+        self.in_flight = 0
+        #: Number of times the limit was decreased
+        self.decreases = 0
+        self._recent_latency = self._average_latency = None
+        self._decreased = _clock()
+        self._condition = threading.Condition()
+        self._waiters = []
+
+    def acquire(self):
+        '''Wait until a request can be sent and return a token to
+        :meth:`release` when it completes.'''
+
+        with self._condition:
+            while self.in_flight >= int(self.limit):
+                self._condition.wait()
+            self.in_flight += 1
+            return _clock()
+
+    def try_acquire(self, waiter=None):
+        '''Return a token if a request can be sent now, else ``None``. Never
+        blocks. If no request can be sent, ``waiter`` is called once the next
+        request completes, from the thread releasing it, to try again.'''
+
+        with self._condition:
+            if self.in_flight >= int(self.limit):
+                if waiter is not None:
+                    self._waiters.append(waiter)
+                return None
+            self.in_flight += 1
+            return _clock()
+
+    def release(self, token, latency, error=None):
+        '''Report a request acquired with ``token`` completed in ``latency``
+        seconds, raising ``error`` if any, and adapt the limit.'''
+
+        with self._condition:
+            self.in_flight -= 1
+            if self._overloaded(latency, error):
+                # requests sent before the last decrease saw the same load
+                if token >= self._decreased:
+                    self._decrease()
+            elif error is None:
+                self._increase()
+            self._condition.notify_all()
+            waiters, self._waiters = self._waiters, []
+        for waiter in waiters:
+            waiter()
+
+    def stats(self):
+        '''Return a :class:`dict` with the current limit and counters.'''
+
+        with self._condition:
+            return {'limit': self.limit,
+                    'in_flight': self.in_flight,
+                    'decreases': self.decreases,
+                    'rate': self.rate_limiter.rate
+                    if self.rate_limiter else None}
+
+    def _overloaded(self, latency, error):
+        if isinstance(error, (TooManyRequests, ServiceUnavailable, Timeout)):
+            return True
+        if error is not None or self.latency_tolerance is None:
+            return False
+        if self._average_latency is None:
+            self._recent_latency = self._average_latency = latency
+            return False
+        self._recent_latency += 0.5 * (latency - self._recent_latency)
+        self._average_latency += 0.02 * (latency - self._average_latency)
+        return self._recent_latency > \
+            self.latency_tolerance * self._average_latency
+
+    def _increase(self):
+        self.limit = min(self.maximum,
+                         self.limit + float(self.increase) / self.limit)
+        if self.rate_limiter is not None:
+            self.rate_limiter.rate = min(
+                self.max_rate,
+                self.rate_limiter.rate + 0.1 * self.max_rate / self.limit)
+
+    def _decrease(self):
+        self.limit = max(self.minimum, self.limit * self.decrease)
+        self.decreases += 1
+        self._decreased = _clock()
+        # don't let a latency spike trigger a decrease right away again
+        self._recent_latency = self._average_latency
+        if self.rate_limiter is not None:
+            self.rate_limiter.rate = max(
+                0.1 * self.max_rate, self.rate_limiter.rate * self.decrease)
+
+
+# -- Load balancing -----------------------------------------------------------
+class Balancer(object):
+    '''Thread-safe client-side load balancer over instances of the becas API,
+    tracking their health.
+
+    :param base_urls: base URLs of the instances, e.g.
+                      ``['http://10.0.0.1:8080/becas/api/', ...]``.
+    :param strategy: *optional* ``'round_robin'`` (default) or
+                     ``'least_outstanding'``, to send each request to the
+                     instance with the fewest requests in flight.
+    :param rate: *optional* requests per second allowed to each instance,
+                 each instance getting its own :class:`RateLimiter`. If
+                 ``None``, all instances share the client's rate limiter.
+    :param burst: *optional* burst of the instance rate limiters.
+    :param cooldown: *optional* seconds an instance is left out after a
+                     :class:`ServiceUnavailable` (502 or 503),
+                     :class:`ConnectionError` or :class:`Timeout`, doubled
+                     on each consecutive failure up to ``max_cooldown``.
+    :param max_cooldown: *optional* longest cooldown in seconds.
+
+    Clients fail requests over to another instance right away when one
+    fails like that, and only apply their :class:`RetryPolicy` once every
+    instance failed. An instance gets requests again when its cooldown
+    expires, and is healthy again after its first success. If all
+    instances are cooling down, requests go to the one recovering first.
+
+    Usage::
+
+      >>> import becas
+      >>> balancer = becas.Balancer(['http://a/becas/api/',
+      ...                            'http://b/becas/api/'])
+      >>> a = balancer.acquire()
+      >>> balancer.release(a, becas.ServiceUnavailable())
+      >>> b = balancer.acquire()
+      >>> b.url, balancer.acquire().url
+      ('http://b/becas/api/', 'http://b/becas/api/')
+
+    '''
+
+    STRATEGIES = ('round_robin', 'least_outstanding',)
+
+    def __init__(self, base_urls, strategy='round_robin', rate=None,
+                 burst=1, cooldown=1, max_cooldown=60):
+        if strategy not in self.STRATEGIES:
+            raise ValueError('Unknown balancing strategy ``%s``' % strategy)
+        if isinstance(base_urls, _string_types):
+            base_urls = [base_urls]
+        if not base_urls:
+            raise ValueError('At least one base URL is required')
+        #: :class:`BalancedInstance` of each base URL
+        self.instances = tuple(
+            BalancedInstance(_base_url(url),
+                             RateLimiter(rate, burst) if rate else None)
+            for url in base_urls)
+        self.strategy = strategy
+        self.cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self._next = 0
+        self._lock = threading.Lock()
+
+    def acquire(self, exclude=()):
+        '''Return the instance to send a request to, leaving out those in
+        ``exclude`` unless there are no others, and count it in flight
+        until :meth:`release`.'''
+
+        with self._lock:
+            now = _clock()
+            candidates = [instance for instance in self.instances
+                          if instance not in exclude] or self.instances
+            healthy = [instance for instance in candidates
+                       if instance.down_until <= now]
+            if not healthy:
+                healthy = [min(candidates,
+                               key=lambda instance: instance.down_until)]
+            start = self._next % len(healthy)
+            self._next += 1
+            healthy = healthy[start:] + healthy[:start]
+            if self.strategy == 'least_outstanding':
+                instance = min(healthy,
+                               key=lambda instance: instance.outstanding)
+            else:
+                instance = healthy[0]
+            instance.outstanding += 1
+            instance.requests += 1
+            return instance
+
+    def release(self, instance, error=None):
+        '''Report a request to ``instance`` completed, raising ``error`` if
+        any, and update its health.'''
+
+        with self._lock:
+            instance.outstanding -= 1
+            if isinstance(error, _FAILOVER_ERRORS):
+                instance.failures += 1
+                instance.errors += 1
+                instance.down_until = _clock() + min(
+                    self.max_cooldown,
+                    self.cooldown * 2 ** (instance.failures - 1))
+            elif error is None or isinstance(error, BecasException):
+                # any answer but an outage shows the instance is up
+                instance.failures = 0
+                instance.down_until = 0
+
+    def stats(self):
+        '''Return a :class:`list` with a :class:`dict` of statistics of each
+        instance.'''
+
+        with self._lock:
+            now = _clock()
+            return [{'url': instance.url,
+                     'healthy': instance.down_until <= now,
+                     'outstanding': instance.outstanding,
+                     'requests': instance.requests,
+                     'errors': instance.errors}
+                    for instance in self.instances]
+
+
+class BalancedInstance(object):
+    '''Instance of the becas API in a :class:`Balancer`.'''
+
+    __slots__ = ('url', 'rate_limiter', 'outstanding', 'requests', 'errors',
+                 'failures', 'down_until',)
+
+    def __init__(self, url, rate_limiter=None):
+        #: Base URL, ending with ``'/'``
+        self.url = url
+        #: :class:`RateLimiter` of requests to this instance, if any
+        self.rate_limiter = rate_limiter
+        #: Number of requests in flight
+        self.outstanding = 0
+        #: Number of requests sent
+        self.requests = 0
+        #: Number of requests failed with an outage
+        self.errors = 0
+        self.failures = 0  # consecutive
+        self.down_until = 0
+
+    def __repr__(self):
+        return 'BalancedInstance(%r)' % self.url
+
+
+_FAILOVER_ERRORS = (ServiceUnavailable, ConnectionError, Timeout,)
+_balancers = {}
+_balancers_lock = threading.Lock()
+
+
+def _balancer(base_url):
+    '''Return the :class:`Balancer` of ``base_url``, a :class:`Balancer`,
+    a base URL or a list of them, shared by clients, or ``None``.'''
+
+    if base_url is None or isinstance(base_url, Balancer):
+        return base_url
+    key = (base_url,) if isinstance(base_url, _string_types) \
+        else tuple(base_url)
+    with _balancers_lock:
+        if key not in _balancers:
+            _balancers[key] = Balancer(key)
+        return _balancers[key]
+
+
+def _base_url(url):
+    '''Return base URL ``url`` with a scheme and a trailing slash.'''
+
+    if '://' not in url:
+        url = 'http://' + url
+    return url if url.endswith('/') else url + '/'
+
+
+# -- Retries ------------------------------------------------------------------
+class RetryPolicy(object):
+    '''Policy for retrying requests that failed with transient errors.
+
+    Requests failing with :class:`TooManyRequests` are retried after the
+    ``Retry-After`` delay requested by the service. Those failing with
+    :class:`ServiceUnavailable`, :class:`Timeout` or :class:`ConnectionError`
+    are retried with exponential backoff and full jitter.
+
+    :param max_attempts: *optional* maximum number of attempts per request,
+                         including the first one (default: 5).
+    :param deadline: *optional* maximum seconds to spend on a request,
+                     including waits between attempts (default: no limit).
+    :param backoff: *optional* base seconds of exponential backoff
+                    (default: 0.5).
+    :param max_backoff: *optional* maximum seconds of a single backoff
+                        (default: 30).
+
+    Waits are also imposed on the client's :class:`RateLimiter`, so that
+    concurrent requests back off together instead of all retrying at once.
+
+    Usage::
+
+      >>> import becas
+      >>> policy = becas.RetryPolicy(max_attempts=3, deadline=60)
+      >>> policy.delay(1, becas.TooManyRequests(wait='2'), elapsed=0)
+      2.0
+      >>> policy.delay(3, becas.ServiceUnavailable(), elapsed=0) is None
+      True
+      >>> client = becas.BecasClient(email='you@example.com', retry=policy)
+
+    '''
+
+    #: Exceptions worth retrying
+    retry_on = (TooManyRequests, ServiceUnavailable, Timeout, ConnectionError)
+
+    def __init__(self, max_attempts=5, deadline=None, backoff=0.5,
+                 max_backoff=30):
+        self.max_attempts = max_attempts
+        self.deadline = deadline
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+
+    def delay(self, attempt, error, elapsed):
+        '''Return seconds to wait before retrying a request that failed with
+        ``error`` on its ``attempt``-th attempt, ``elapsed`` seconds after it
+        started, or ``None`` if ``error`` should be raised instead.'''
+
+        if (not isinstance(error, self.retry_on) or isinstance(error, SSLError)
+                or attempt >= self.max_attempts):
+            return None
+        wait = None
+        if isinstance(error, TooManyRequests):
+            wait = _parse_retry_after(error.wait)
+        if wait is None:
+            cap = min(self.max_backoff, self.backoff * 2 ** (attempt - 1))
+            wait = random.uniform(0, cap)
+        if self.deadline is not None and elapsed + wait > self.deadline:
+            return None
+        return wait
+
+
+def _parse_retry_after(value):
+    '''Return seconds to wait from a ``Retry-After`` header value, given in
+    seconds or as an HTTP date.'''
+
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    from email.utils import parsedate_tz, mktime_tz
+    date = parsedate_tz(value)
+    if date is None:
+        return None
+    return max(0.0, mktime_tz(date) - time.time())
+
+
+# -- Result caching -----------------------------------------------------------
+class ResultCache(object):
+    '''Persistent cache of annotation results, stored in a SQLite database.
+
+    Results are keyed by a hash of the API endpoint and the request
+    parameters, so repeated requests for the same text or publication with
+    the same options are answered locally. The database runs in WAL mode and
+    can be shared by several threads and processes.
+
+    :param path: path of the SQLite database file, created if needed.
+    :param max_size: *optional* maximum total size in bytes of cached results.
+                     Oldest results are evicted first (default: no limit).
+    :param max_age: *optional* seconds after which results expire
+                    (default: never).
+
+    Usage::
+
+      >>> import os, tempfile
+      >>> import becas
+      >>> path = os.path.join(tempfile.mkdtemp(), 'becas-cache.db')
+      >>> cache = becas.ResultCache(path, max_age=7 * 24 * 3600)
+      >>> cache.set('key', b'{}')
+      >>> cache.get('key') == b'{}'
+      True
+      >>> cache.get('other') is None
+      True
+      >>> sorted(cache.stats().items())  # doctest: +NORMALIZE_WHITESPACE
+      [('entries', 1), ('evictions', 0), ('hits', 1), ('misses', 1),
+       ('size', 2)]
+
+    '''
+
+    #: Number of stores between checks of the ``max_size`` limit
+    check_interval = 100
+
+    def __init__(self, path, max_size=None, max_age=None):
+        self.path = path
+        self.max_size = max_size
+        self.max_age = max_age
+        #: Number of lookups answered from the cache
+        self.hits = 0
+        #: Number of lookups not found in the cache
+        self.misses = 0
+        #: Number of results evicted from the cache
+        self.evictions = 0
+        self._stores = 0
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._connection()  # create database
+
+    def get(self, key):
+        '''Return cached result for ``key``, or ``None``.'''
+
+        row = self._execute('SELECT value, created FROM results WHERE key = ?',
+                            (key,)).fetchone()
+        if row is not None and self.max_age is not None \
+                and row[1] < time.time() - self.max_age:
+            row = None
+        with self._lock:
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        return bytes(row[0])
+
+    def set(self, key, value):
+        '''Store result ``value`` (:class:`bytes`) for ``key``.'''
+
+        import sqlite3
+        self._execute('INSERT OR REPLACE INTO results (key, value, size, '
+                      'created) VALUES (?, ?, ?, ?)',
+                      (key, sqlite3.Binary(value), len(value), time.time()),
+                      commit=True)
+        with self._lock:
+            self._stores += 1
+            check = self._stores % self.check_interval == 1
+        if check:
+            self.evict()
+
+    def evict(self):
+        '''Remove expired results and, if over ``max_size``, the oldest
+        results.'''
+
+        evicted = 0
+        if self.max_age is not None:
+            evicted += self._execute(
+                'DELETE FROM results WHERE created < ?',
+                (time.time() - self.max_age,), commit=True).rowcount
+        if self.max_size is not None:
+            total = self._execute(
+                'SELECT COALESCE(SUM(size), 0) FROM results').fetchone()[0]
+            if total > self.max_size:
+                # evict down to 90% of the limit, to evict in batches
+                excess = total - self.max_size * 0.9
+                keys = []
+                cursor = self._execute(
+                    'SELECT key, size FROM results ORDER BY created')
+                for key, size in cursor:
+                    keys.append((key,))
+                    excess -= size
+                    if excess <= 0:
+                        break
+                cursor.close()
+                self._executemany('DELETE FROM results WHERE key = ?', keys)
+                evicted += len(keys)
+        with self._lock:
+            self.evictions += evicted
+
+    def clear(self):
+        '''Remove all cached results.'''
+
+        self._execute('DELETE FROM results', commit=True)
+
+    def stats(self):
+        '''Return a :class:`dict` with cache statistics.'''
+
+        entries, size = self._execute(
+            'SELECT COUNT(*), COALESCE(SUM(size), 0) FROM results').fetchone()
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses,
+                    'evictions': self.evictions,
+                    'entries': entries, 'size': size}
+
+    def _connect(self):
+        '''Open a connection to the cache database.'''
+
+        import sqlite3
+        connection = sqlite3.connect(self.path, timeout=30)
+        connection.execute('PRAGMA journal_mode=WAL')
+        connection.execute('PRAGMA synchronous=NORMAL')
+        connection.execute('CREATE TABLE IF NOT EXISTS results ('
+                           'key TEXT PRIMARY KEY, value BLOB, '
+                           'size INTEGER, created REAL)')
+        connection.execute('CREATE INDEX IF NOT EXISTS results_created '
+                           'ON results (created)')
+        connection.commit()
+        return connection
+
+    def _connection(self):
+        '''Return the database connection of the calling thread.'''
+
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = self._local.connection = self._connect()
+        return connection
+
+    def _execute(self, sql, params=(), commit=False):
+        '''Execute ``sql`` on the calling thread's connection.'''
+
+        connection = self._connection()
+        cursor = connection.execute(sql, params)
+        if commit:
+            connection.commit()
+        return cursor
+
+    def _executemany(self, sql, params):
+        '''Execute ``sql`` once for each parameters in ``params``.'''
+
+        connection = self._connection()
+        connection.executemany(sql, params)
+        connection.commit()
+
+
+class MemoryCache(object):
+    '''Thread-safe in-memory LRU cache of annotation results.
+
+    Used by clients to memoize PubMed publication results, answering repeated
+    requests for popular publications without a round trip to the service.
+
+    :param max_entries: *optional* maximum number of cached results
+                        (default: 1024).
+    :param max_bytes: *optional* maximum total size in bytes of cached
+                      results (default: 64 MiB).
+    :param ttl: *optional* seconds after which results expire
+                (default: never).
+
+    Least recently used results are evicted first. Usage::
+
+      >>> import becas
+      >>> cache = becas.MemoryCache(max_entries=2)
+      >>> cache.set(1, b'1'); cache.set(2, b'2'); cache.get(1) == b'1'
+      True
+      >>> cache.set(3, b'3'); cache.get(2) is None
+      True
+      >>> sorted(cache.stats().items())  # doctest: +NORMALIZE_WHITESPACE
+      [('bytes', 2), ('entries', 2), ('evictions', 1), ('hits', 1),
+       ('misses', 1)]
+
+    '''
+
+    def __init__(self, max_entries=1024, max_bytes=64 * 2 ** 20, ttl=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        #: Number of lookups answered from the cache
+        self.hits = 0
+        #: Number of lookups not found in the cache
+        self.misses = 0
+        #: Number of results evicted from the cache
+        self.evictions = 0
+        self._items = collections.OrderedDict()  # key -> (value, expires)
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        '''Return cached result for ``key``, or ``None``.'''
+
+        with self._lock:
+            item = self._items.pop(key, None)
+            if item is not None and item[1] is not None \
+                    and item[1] < _clock():
+                self._bytes -= len(item[0])
+                item = None
+            if item is None:
+                self.misses += 1
+                return None
+            self._items[key] = item  # most recently used
+            self.hits += 1
+            return item[0]
+
+    def set(self, key, value):
+        '''Store result ``value`` (:class:`bytes`) for ``key``.'''
+
+        if self.max_bytes is not None and len(value) > self.max_bytes:
+            return
+        expires = _clock() + self.ttl if self.ttl is not None else None
+        with self._lock:
+            previous = self._items.pop(key, None)
+            if previous is not None:
+                self._bytes -= len(previous[0])
+            self._items[key] = (value, expires)
+            self._bytes += len(value)
+            while (len(self._items) > self.max_entries or
+                   self.max_bytes is not None and
+                   self._bytes > self.max_bytes):
+                _, (evicted, _) = self._items.popitem(last=False)
+                self._bytes -= len(evicted)
+                self.evictions += 1
+
+    def clear(self):
+        '''Remove all cached results.'''
+
+        with self._lock:
+            self._items.clear()
+            self._bytes = 0
+
+    def stats(self):
+        '''Return a :class:`dict` with cache statistics.'''
+
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses,
+                    'evictions': self.evictions,
+                    'entries': len(self._items), 'bytes': self._bytes}
+
+
+class SentenceIndex(object):
+    '''Thread-safe content-hash index of sentence annotation results, for
+    batches annotating repeated sentences only once.
+
+    :param cache: *optional* :class:`MemoryCache` holding the results
+                  (default: one of up to 100000 sentences and 256 MiB).
+
+    Sentences are indexed by a hash of their text and semantic groups. While
+    a sentence is being annotated for a document, other documents wait for
+    its result instead of sending it again. Share an index between batches
+    to keep reusing the sentences seen.
+
+    Usage::
+
+      >>> import becas
+      >>> index = becas.SentenceIndex()
+      >>> index.stats()['sentences']
+      0
+
+    '''
+
+    def __init__(self, cache=None):
+        if cache is None:
+            cache = MemoryCache(max_entries=100000, max_bytes=256 * 2 ** 20)
+        self.cache = cache
+        #: Number of sentences looked up
+        self.sentences = 0
+        #: Number of sentences answered from the index or a request in flight
+        self.hits = 0
+        self._pending = {}  # key -> _Call
+        self._lock = threading.Lock()
+
+    def stats(self):
+        '''Return a :class:`dict` with index statistics.'''
+
+        with self._lock:
+            return {'sentences': self.sentences, 'hits': self.hits,
+                    'unique': self.sentences - self.hits,
+                    'entries': self.cache.stats()['entries']}
+
+    def _claim(self, key):
+        '''Return ``(content, call, leader)``: the indexed result of sentence
+        ``key``, else the call in flight annotating it, led by the caller if
+        ``leader``.'''
+
+        with self._lock:
+            self.sentences += 1
+            content = self.cache.get(key)
+            call = self._pending.get(key) if content is None else None
+            if content is not None or call is not None:
+                self.hits += 1
+                return content, call, False
+            call = self._pending[key] = _Call()
+            return None, call, True
+
+    def _resolve(self, key, call, content=None, error=None):
+        '''Complete the ``call`` annotating sentence ``key`` with its result
+        ``content`` or ``error``.'''
+
+        if content is not None:
+            self.cache.set(key, content)
+        call.result, call.error = content, error
+        with self._lock:
+            del self._pending[key]
+        call.done.set()
+
+
+# -- Metrics ------------------------------------------------------------------
+class Metrics(object):
+    '''Thread-safe counters of client activity.
+
+    Clients count requests and bytes transferred, both as sent over the wire
+    and uncompressed, from which :meth:`snapshot` derives compression ratios
+    and bytes saved by compression. Requests, bytes, errors by exception type
+    and :class:`Histogram` of latency and JSON decoding time are also kept
+    per API method.
+
+    Usage::
+
+      >>> import becas
+      >>> metrics = becas.Metrics()
+      >>> metrics.record_transfer(1000, 4000, 2000, 10000)
+      >>> snapshot = metrics.snapshot()
+      >>> snapshot['bytes_saved'], snapshot['response_compression_ratio']
+      (11000, 5.0)
+      >>> metrics.record_request('annotate_text', 0.2,
+      ...                        becas.ServiceUnavailable())
+      >>> metrics.snapshot()['endpoints']['annotate_text']['errors']
+      {'ServiceUnavailable': 1}
+
+    '''
+
+    def __init__(self):
+        self._counters = collections.defaultdict(int)
+        self._endpoints = {}
+        self._lock = threading.Lock()
+
+    def incr(self, name, value=1):
+        '''Increment counter ``name`` by ``value``.'''
+
+        with self._lock:
+            self._counters[name] += value
+
+    def record_transfer(self, sent, sent_uncompressed, received,
+                        received_uncompressed, endpoint=None):
+        '''Record bytes of a request and its response body, as transferred
+        and uncompressed, to API method ``endpoint``.'''
+
+        with self._lock:
+            counters = self._counters
+            counters['requests'] += 1
+            counters['bytes_sent'] += sent
+            counters['bytes_sent_uncompressed'] += sent_uncompressed
+            counters['bytes_received'] += received
+            counters['bytes_received_uncompressed'] += received_uncompressed
+            if endpoint is not None:
+                counters = self._endpoint(endpoint)
+                counters['bytes_sent'] += sent
+                counters['bytes_received'] += received
+
+    def record_request(self, endpoint, seconds, error=None):
+        '''Record a request attempt to API method ``endpoint`` that took
+        ``seconds`` and raised ``error``, if any.'''
+
+        with self._lock:
+            counters = self._endpoint(endpoint)
+            counters['requests'] += 1
+            counters['latency'].observe(seconds)
+            if error is not None:
+                errors = counters['errors']
+                name = type(error).__name__
+                errors[name] = errors.get(name, 0) + 1
+
+    def record_throttle(self, seconds):
+        '''Record a request held back ``seconds`` by the rate limiter.'''
+
+        with self._lock:
+            self._counters['throttled'] += 1
+            self._counters['throttle_seconds'] += seconds
+
+    def record_decode(self, endpoint, seconds):
+        '''Record ``seconds`` spent decoding a JSON result of API method
+        ``endpoint``.'''
+
+        with self._lock:
+            self._endpoint(endpoint)['decode'].observe(seconds)
+
+    def snapshot(self):
+        '''Return a :class:`dict` with current counter values, derived
+        compression statistics and per API method ``endpoints`` statistics.'''
+
+        with self._lock:
+            snapshot = dict(self._counters)
+            snapshot['endpoints'] = dict(
+                (endpoint, dict((name, value.snapshot()
+                                 if isinstance(value, Histogram)
+                                 else dict(value)
+                                 if isinstance(value, dict) else value)
+                                for name, value in counters.items()))
+                for endpoint, counters in self._endpoints.items())
+        sent = snapshot.get('bytes_sent', 0)
+        sent_uncompressed = snapshot.get('bytes_sent_uncompressed', 0)
+        received = snapshot.get('bytes_received', 0)
+        received_uncompressed = snapshot.get('bytes_received_uncompressed', 0)
+        snapshot['bytes_saved'] = (sent_uncompressed - sent +
+                                   received_uncompressed - received)
+        snapshot['request_compression_ratio'] = (
+            float(sent_uncompressed) / sent if sent else None)
+        snapshot['response_compression_ratio'] = (
+            float(received_uncompressed) / received if received else None)
+        return snapshot
+
+    def reset(self):
+        '''Reset all counters.'''
+
+        with self._lock:
+            self._counters.clear()
+            self._endpoints.clear()
+
+    def _endpoint(self, endpoint):
+        counters = self._endpoints.get(endpoint)
+        if counters is None:
+            counters = self._endpoints[endpoint] = {
+                'requests': 0, 'bytes_sent': 0, 'bytes_received': 0,
+                'errors': {}, 'latency': Histogram(), 'decode': Histogram()}
+        return counters
+
+
+class Histogram(object):
+    '''Distribution of observed values in buckets of fixed upper bounds, as
+    exported to monitoring systems. Not thread-safe on its own.
+
+    :param bounds: *optional* increasing bucket upper bounds (default:
+                   :attr:`LATENCY_BOUNDS`, in seconds).
+
+    >>> histogram = Histogram()
+    >>> for seconds in (0.02, 0.03, 0.04, 0.3):
+    ...     histogram.observe(seconds)
+    >>> histogram.count, histogram.percentile(0.5)
+    (4, 0.05)
+
+    '''
+
+    #: Default bucket upper bounds, in seconds
+    LATENCY_BOUNDS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                      1, 2.5, 5, 10, 30, 60, 120,)
+
+    def __init__(self, bounds=LATENCY_BOUNDS):
+        self.bounds = tuple(bounds)
+        #: Observations per bucket, the last one above all bounds
+        self.counts = [0] * (len(self.bounds) + 1)
+        #: Number of observations
+        self.count = 0
+        #: Sum of observed values
+        self.sum = 0.0
+        #: Largest observed value
+        self.max = None
+
+    def observe(self, value):
+        '''Add ``value`` to the distribution.'''
+
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def percentile(self, fraction):
+        '''Return the upper bound of the bucket holding the ``fraction``
+        percentile, or the largest value if above all bounds.'''
+
+        if not self.count:
+            return None
+        rank, seen = fraction * self.count, 0
+        for bound, count in zip(self.bounds, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return self.max
+
+    def snapshot(self):
+        '''Return a :class:`dict` with count, sum, max, percentiles and
+        cumulative ``buckets`` as ``[upper bound, count]``.'''
+
+        cumulative, buckets = 0, []
+        for bound, count in zip(self.bounds, self.counts):
+            cumulative += count
+            buckets.append([bound, cumulative])
+        return {'count': self.count, 'sum': self.sum, 'max': self.max,
+                'p50': self.percentile(0.5), 'p95': self.percentile(0.95),
+                'p99': self.percentile(0.99), 'buckets': buckets}
+
+
+# -- Instrumentation ----------------------------------------------------------
+class RequestInfo(object):
+    '''Request attempt passed to client hooks.
+
+    Hooks are registered per event of :data:`HOOKS` in a :class:`dict` given
+    as client ``hooks``, or as the module-level :data:`hooks`:
+
+    * ``throttle``: the rate limiter held back the attempt
+      ``timings['throttle']`` seconds.
+    * ``before_request``: the attempt is about to be sent.
+    * ``after_request``: the attempt completed, with a ``status`` or an
+      ``error``, and all ``timings``.
+    * ``retry``: the attempt failed and will be retried after ``delay``
+      seconds.
+
+    Usage::
+
+      >>> import becas
+      >>> def log(info):
+      ...     print(info.endpoint, info.status, info.timings['total'])
+      >>> client = becas.BecasClient(hooks={'after_request': log})
+
+    '''
+
+    __slots__ = ('endpoint', 'url', 'attempt', 'status', 'error', 'delay',
+                 'bytes_sent', 'bytes_received', 'timings')
+
+    def __init__(self, endpoint, url, attempt):
+        #: API method name, e.g. ``'annotate_text'``
+        self.endpoint = endpoint
+        #: Request URL
+        self.url = url
+        #: Attempt number, starting at 1
+        self.attempt = attempt
+        #: HTTP status of the response, if any
+        self.status = None
+        #: :class:`BecasException` raised by the attempt, if any
+        self.error = None
+        #: Seconds before the attempt is retried, for ``retry`` hooks
+        self.delay = None
+        #: Bytes of the request body, as sent
+        self.bytes_sent = 0
+        #: Bytes of the response body, as received
+        self.bytes_received = 0
+        #: Seconds spent waiting for the rate limiter (``throttle``), until
+        #: the response headers arrived, including connection and server
+        #: time (``response``), reading the response body (``download``),
+        #: and in the whole attempt after throttling (``total``)
+        self.timings = {'throttle': 0}
+
+    def __repr__(self):
+        return '<RequestInfo: %s attempt %d>' % (self.endpoint, self.attempt)
+
+
+def _fire(hooks, event, info):
+    '''Call ``hooks`` registered for ``event`` with ``info``.'''
+
+    callbacks = hooks.get(event) if hooks else None
+    if callbacks is None:
+        return
+    if callable(callbacks):
+        callbacks = (callbacks,)
+    for callback in callbacks:
+        callback(info)
+
+
+def _validate_hooks(hooks):
+    '''Ensure hooks are registered for known events only.'''
+
+    for event in hooks or ():
+        if event not in HOOKS:
+            raise ValueError('Unknown hook event ``%s``' % event)
+
+
+# -- Request coalescing -------------------------------------------------------
+class _SingleFlight(object):
+    '''Coalesce concurrent calls with the same key into a single call, whose
+    result or exception is shared by every caller.'''
+
+    def __init__(self):
+        #: Number of calls answered by a call already in flight
+        self.coalesced = 0
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, func):
+        '''Return ``func()``, or the result of the call in flight for
+        ``key``.'''
+
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+            else:
+                self.coalesced += 1
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+        try:
+            call.result = func()
+            return call.result
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+
+class _Call(object):
+    '''A call in flight.'''
+
+    __slots__ = ('done', 'result', 'error')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+# -- Typed results ------------------------------------------------------------
+class AnnotationResult(object):
+    '''Compact annotation result, parsed when its fields are first accessed.
+
+    The response body is kept as is until then, and entities are stored as
+    arrays of offsets plus references to interned mentions and concepts,
+    shared by all results. Interning tables are bounded, so mentions seen
+    long ago are no longer shared with new results. Large numbers of results
+    can so be held in memory at a fraction of the size of the decoded
+    :class:`dict`.
+
+    :param content: response body (:class:`bytes`) or decoded :class:`dict`.
+
+    Usage::
+
+      >>> import becas
+      >>> result = becas.AnnotationResult(
+      ...     b'{"text": "BRCA1 is a gene.", '
+      ...     b'"entities": ["BRCA1|UNIPROT:P38398:::PRGE|0"]}')
+      >>> entity = result.entities[0]
+      >>> print(entity.text)
+      BRCA1
+      >>> entity.start, entity.end
+      (0, 5)
+      >>> entity.concepts[0] is becas.Concept.get('UNIPROT:P38398:::PRGE')
+      True
+
+    Sections of PubMed publication results are :class:`AnnotationResult`
+    too, e.g. ``result['abstract']``, and :attr:`raw` gives the decoded
+    :class:`dict`.
+    '''
+
+    __slots__ = ('_content', '_text', '_starts', '_ends', '_mentions')
+
+    def __init__(self, content):
+        self._content = content
+        self._mentions = None
+
+    @property
+    def raw(self):
+        '''Result as a :class:`dict`, decoded anew on every access.'''
+
+        content = self._content
+        return content if isinstance(content, dict) else _decode_json(content)
+
+    @property
+    def text(self):
+        '''Annotated text, if echoed by the service.'''
+
+        self._parse()
+        return self._text
+
+    @property
+    def entities(self):
+        ''':class:`tuple` of :class:`Entity` found in the text.'''
+
+        self._parse()
+        return tuple(Entity(text, start if start >= 0 else None,
+                            end if end >= 0 else None, concepts)
+                     for start, end, (text, concepts)
+                     in zip(self._starts, self._ends, self._mentions))
+
+    @property
+    def concepts(self):
+        ''':class:`tuple` of distinct :class:`Concept` of all entities, in
+        order of first mention.'''
+
+        self._parse()
+        concepts = collections.OrderedDict()
+        for _, mention_concepts in self._mentions:
+            for concept in mention_concepts:
+                concepts[concept] = None
+        return tuple(concepts)
+
+    def __len__(self):
+        self._parse()
+        return len(self._mentions)
+
+    def __getitem__(self, key):
+        value = self.raw[key]
+        if isinstance(value, dict) and 'entities' in value:
+            return AnnotationResult(value)
+        return value
+
+    def __repr__(self):
+        return '<AnnotationResult: %d entities>' % len(self)
+
+    def _parse(self):
+        if self._mentions is not None:
+            return
+        raw = self.raw
+        starts, ends, mentions = array.array('l'), array.array('l'), []
+        for entity in raw.get('entities', ()):
+            text, start, end, ids = _parse_entity(entity)
+            starts.append(start if start is not None else -1)
+            ends.append(end if end is not None else -1)
+            mentions.append(_mention(text, ids))
+        self._text = raw.get('text')
+        self._starts, self._ends, self._mentions = starts, ends, mentions
+
+
+class Entity(object):
+    '''Concept mention in an annotated text.
+
+    :ivar text: mention text.
+    :ivar start: offset of the first character of the mention in the text.
+    :ivar end: offset after the last character of the mention in the text.
+    :ivar concepts: :class:`tuple` of :class:`Concept` mentioned.
+    '''
+
+    __slots__ = ('text', 'start', 'end', 'concepts')
+
+    def __init__(self, text, start, end, concepts):
+        self.text = text
+        self.start = start
+        self.end = end
+        self.concepts = concepts
+
+    def __repr__(self):
+        return 'Entity(%r, %r, %r, %r)' % (self.text, self.start, self.end,
+                                           self.concepts)
+
+
+class Concept(object):
+    '''Biomedical concept, identified by a becas concept ID such as
+    ``'UNIPROT:P38398:::PRGE'``.
+
+    Concepts are interned: get them with :meth:`get` to share a single object
+    per ID for as long as any result refers to it.
+    '''
+
+    __slots__ = ('id', 'source', 'identifier', 'group', '__weakref__')
+
+    _interned = weakref.WeakValueDictionary()
+
+    def __init__(self, id):
+        parts = id.split(':')
+        #: Concept ID
+        self.id = id
+        #: Source of the concept, e.g. ``'UNIPROT'``
+        self.source = parts[0]
+        #: Identifier of the concept in its source, e.g. ``'P38398'``
+        self.identifier = parts[1] if len(parts) > 1 else ''
+        #: Semantic group of the concept, one of :data:`SEMANTIC_GROUPS`
+        self.group = _SEMANTIC_GROUPS.get(parts[-1], parts[-1])
+
+    @classmethod
+    def get(cls, id):
+        '''Return the interned concept with ID ``id``.'''
+
+        concept = cls._interned.get(id)
+        if concept is None:
+            concept = cls._interned.setdefault(id, cls(id))
+        return concept
+
+    def __repr__(self):
+        return 'Concept(%r)' % (self.id,)
+
+
+_ALL_DOCS = object()  # default of AnnotationIndex queries
+
+
+class AnnotationIndex(object):
+    '''Index of the entities of annotation results by span, semantic group
+    and concept.
+
+    Span queries bisect arrays of entity offsets, taking logarithmic time
+    plus the size of the answer, and group and concept queries are hash
+    lookups. Results of many texts or publications can be added to one index
+    under a ``doc`` key of your choice, e.g. the :attr:`BatchResult.index`.
+
+    :param result: *optional* annotation result (:class:`dict` or
+                   :class:`AnnotationResult`) to index, with ``doc=None``.
+
+    Group and concept queries cover all documents unless given a ``doc``,
+    which can be ``None`` too. PubMed publication results have a result per
+    section, to be added one by one, e.g. ``result['abstract']``.
+
+    Usage::
+
+      >>> import becas
+      >>> index = becas.AnnotationIndex({
+      ...     'text': 'BRCA1 mutations cause breast cancer.',
+      ...     'entities': ['BRCA1|UNIPROT:P38398:::PRGE|0',
+      ...                  'breast cancer|UMLS:C0006142:T191:DISO|22']})
+      >>> [entity.text for entity in index.overlapping(3, 25)]
+      ['BRCA1', 'breast cancer']
+      >>> [(doc, entity.start) for doc, entity in index.group('DISO')]
+      [(None, 22)]
+      >>> len(index.concept('UNIPROT:P38398:::PRGE'))
+      1
+      >>> index.add({'entities': ['p53|UNIPROT:P04637:::PRGE|0']}, doc=1)
+      >>> [doc for doc, _ in index.group('PRGE')]
+      [None, 1]
+      >>> [entity.text for _, entity in index.group('PRGE', doc=None)]
+      ['BRCA1']
+
+    '''
+
+    def __init__(self, result=None):
+        self._spans = {}  # doc: (starts, max_ends, entities) sorted by start
+        self._groups = collections.defaultdict(list)
+        self._concepts = collections.defaultdict(list)
+        if result is not None:
+            self.add(result)
+
+    def __len__(self):
+        return sum(len(entities) for _, _, entities in self._spans.values())
+
+    def add(self, result, doc=None):
+        '''Add the entities of ``result`` to the index under key ``doc``,
+        replacing entities previously added under the same key.'''
+
+        if not isinstance(result, AnnotationResult):
+            result = AnnotationResult(result)
+        if not len(result) and any(isinstance(value, dict) and
+                                   'entities' in value
+                                   for value in result.raw.values()):
+            raise ValueError('Publication results have a result per '
+                             'section, add them one by one, e.g. '
+                             "``result['abstract']``")
+        if doc in self._spans:
+            self._remove(doc)
+        entities = sorted((entity for entity in result.entities
+                           if entity.start is not None),
+                          key=lambda entity: entity.start)
+        starts, max_ends, max_end = [], [], -1
+        for entity in entities:
+            starts.append(entity.start)
+            max_end = max(max_end, entity.end)
+            max_ends.append(max_end)
+        self._spans[doc] = starts, max_ends, entities
+        for entity in result.entities:
+            item = IndexedEntity(doc, entity)
+            for group in set(concept.group for concept in entity.concepts):
+                self._groups[group].append(item)
+            for id in set(concept.id for concept in entity.concepts):
+                self._concepts[id].append(item)
+
+    def overlapping(self, start, end=None, doc=None):
+        '''Return :class:`Entity` of document ``doc`` overlapping span
+        ``[start, end)``, or offset ``start`` if ``end`` is ``None``, by
+        start offset.'''
+
+        if end is None:
+            end = start + 1
+        starts, max_ends, entities = self._spans.get(doc, ((), (), ()))
+        # entities before lo all end before start, entities from hi on all
+        # start after end, since max_ends is non-decreasing
+        lo = bisect.bisect_right(max_ends, start)
+        hi = bisect.bisect_left(starts, end)
+        return [entity for entity in entities[lo:hi] if entity.end > start]
+
+    def group(self, group, doc=_ALL_DOCS):
+        '''Return :class:`IndexedEntity` mentioning concepts of semantic
+        ``group``, of all documents or only ``doc``.'''
+
+        return self._filter(self._groups.get(group, ()), doc)
+
+    def concept(self, id, doc=_ALL_DOCS):
+        '''Return :class:`IndexedEntity` mentioning concept ``id``, of all
+        documents or only ``doc``.'''
+
+        return self._filter(self._concepts.get(id, ()), doc)
+
+    @staticmethod
+    def _filter(items, doc):
+        if doc is _ALL_DOCS:
+            return list(items)
+        return [item for item in items if item.doc == doc]
+
+    def _remove(self, doc):
+        del self._spans[doc]
+        for index in (self._groups, self._concepts):
+            for key, items in list(index.items()):
+                index[key] = [item for item in items if item.doc != doc]
+
+
+#: Entity of an :class:`AnnotationIndex`, with the ``doc`` key of its result
+IndexedEntity = collections.namedtuple('IndexedEntity', ('doc', 'entity'))
+
+
+_mentions = {}  # interned (text, concepts) by (text, concept IDs)
+_MAX_MENTIONS = 2 ** 16  # distinct mentions interned before starting anew
+
+
+def _mention(text, ids):
+    '''Return the interned ``(text, concepts)`` pair of a mention.'''
+
+    key = (text, ids if isinstance(ids, _string_types) else tuple(ids))
+    mention = _mentions.get(key)
+    if mention is None:
+        if len(_mentions) >= _MAX_MENTIONS:
+            # results keep their mentions, new ones are shared from now on
+            _mentions.clear()
+        if not isinstance(ids, (list, tuple)):
+            ids = ids.split(';')
+        mention = _mentions.setdefault(
+            key, (text, tuple(Concept.get(id) for id in ids if id)))
+    return mention
+
+
+def _parse_entity(entity):
+    '''Return ``(text, start, end, ids)`` of an entity of annotation
+    results, either a ``TEXT|IDS|START`` string or a :class:`dict`.
+
+    >>> _parse_entity('BRCA1|UNIPROT:P38398:::PRGE|3')
+    ('BRCA1', 3, 8, 'UNIPROT:P38398:::PRGE')
+
+    '''
+
+    if isinstance(entity, dict):
+        return (entity.get('text'), entity.get('start'), entity.get('end'),
+                entity.get('ids') or ())
+    head, _, start = entity.rpartition('|')
+    text, _, ids = head.rpartition('|')
+    if not start.isdigit():
+        return text, None, None, ids
+    return text, int(start), int(start) + len(text), ids
+
+
+# -- API client ---------------------------------------------------------------
+class BecasClient(object):
+    '''becas API client holding a persistent HTTP session.
+
+    Connections to the becas API are kept alive and reused across requests,
+    saving a TCP (and TLS, when ``secure``) handshake on every call.
+
+    :param email: *optional* becas API authentication ``email`` parameter.
+    :param tool: *optional* becas API authentication ``tool`` parameter.
+    :param timeout: *optional* seconds to wait before timing out a request.
+    :param secure: *optional* whether to use HTTPS or plain HTTP.
+    :param pool_connections: *optional* number of per-host connection pools
+                             to cache.
+    :param pool_maxsize: *optional* maximum number of connections kept alive
+                         in each pool. Should be at least the number of
+                         threads sharing the client.
+    :param keep_alive: *optional* flag to keep connections open between
+                       requests (default: ``True``).
+    :param rate_limiter: *optional* :class:`RateLimiter` for requests of this
+                         client, e.g. to give each API key its own budget.
+    :param concurrency: *optional* :class:`AdaptiveConcurrency` limiting
+                        requests in flight of this client.
+    :param retry: *optional* :class:`RetryPolicy` for transient errors.
+    :param cache: *optional* :class:`ResultCache` for annotation results.
+    :param memory_cache: *optional* :class:`MemoryCache` for PubMed
+                         publication results.
+    :param chunk_size: *optional* maximum characters per request when
+                       annotating text in chunks.
+    :param superset_groups: *optional* semantic groups to annotate with
+                            whenever they include those asked for, filtering
+                            results locally, so requests for different
+                            groups share a single result (``True`` for all
+                            :data:`SEMANTIC_GROUPS`).
+    :param coalesce: *optional* flag to share the response of a request with
+                     identical requests made while it is in flight, instead
+                     of repeating it (default: ``True``).
+    :param compress_requests: *optional* encoding (``'gzip'`` or
+                              ``'deflate'``) to compress large request
+                              bodies with. If the service rejects compressed
+                              requests, the client stops compressing them.
+    :param metrics: *optional* :class:`Metrics` to record client activity in
+                    (default: :data:`metrics`, or the client's own).
+    :param typed: *optional* flag to return annotation results as compact
+                  :class:`AnnotationResult` objects instead of :class:`dict`
+                  (default: ``False``).
+    :param hooks: *optional* :class:`dict` mapping events of :data:`HOOKS` to
+                  a callable or list of callables, called with a
+                  :class:`RequestInfo`.
+    :param base_url: *optional* base URL of the becas API, list of base URLs
+                     of instances to balance requests over, or
+                     :class:`Balancer`. Each instance gets its own pool of
+                     up to ``pool_maxsize`` connections.
+
+    Responses are always requested compressed. Parameters left as ``None``
+    fall back to the module-level configuration parameters, read at request
+    time.
+
+    Usage::
+
+      >>> import becas
+      >>> client = becas.BecasClient(email='you@example.com', pool_maxsize=4,
+      ...                            rate_limiter=becas.RateLimiter(rate=5))
+      >>> client.email
+      'you@example.com'
+      >>> client.close()
+
+    Clients can also be used as context managers, closing their connections
+    on exit.
+    '''
+
+    def __init__(self, email=None, tool=None, timeout=None, secure=None,
+                 pool_connections=None, pool_maxsize=None, keep_alive=True,
+                 rate_limiter=None, retry=None, cache=None,
+                 memory_cache=None, chunk_size=None, coalesce=True,
+                 compress_requests=None, metrics=None, typed=False,
+                 hooks=None, concurrency=None, base_url=None,
+                 superset_groups=None):
+        self.email = email
+        self.tool = tool
+        self.timeout = timeout
+        self.secure = secure
+        self.rate_limiter = rate_limiter
+        self.retry = retry
+        self.concurrency = concurrency
+        self.base_url = base_url
+        self.cache = cache
+        self.memory_cache = memory_cache
+        self.chunk_size = chunk_size
+        self.superset_groups = superset_groups
+        self._in_flight = _SingleFlight() if coalesce else None
+        if compress_requests not in (None,) + _REQUEST_ENCODINGS:
+            raise ValueError('Unknown request encoding ``%s``'
+                             % compress_requests)
+        self.compress_requests = compress_requests
+        if metrics is None:
+            metrics = globals()['metrics'] or Metrics()
+        self.metrics = metrics
+        self.typed = typed
+        _validate_hooks(hooks)
+        self.hooks = hooks
+        self._pool_maxsize = pool_maxsize if pool_maxsize is not None \
+            else globals()['pool_maxsize']
+        self.session = _new_session(
+            pool_connections if pool_connections is not None
+            else globals()['pool_connections'],
+            self._pool_maxsize,
+            keep_alive)
+        self._mounted = set()
+        self._mount_lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    @property
+    def coalesced(self):
+        '''Number of requests answered by an identical request in flight.'''
+
+        return self._in_flight.coalesced if self._in_flight else 0
+
+    def close(self):
+        '''Close all pooled connections.'''
+
+        self.session.close()
+
+    def annotate_text(self, text, groups=None, echo=False, chunked=False):
+        '''Annotate text with biomedical concepts.
+
+        See :func:`becas.annotate_text`.
+        '''
+
+        groups, wanted = self._widen_groups(groups)
+        payload = _annotate_text_payload(text, groups, echo)
+        if chunked:
+            results = self._annotate_chunks(
+                text,
+                lambda chunk: self._decode_json('annotate_text', self._request(
+                    'annotate_text',
+                    _annotate_text_payload(chunk, groups, echo))),
+                _merge_annotations)
+            results = _filter_groups(results, wanted)
+            return AnnotationResult(results) if self.typed else results
+        content = self._request('annotate_text', payload)
+
+        return self._annotation_result('annotate_text', content, wanted)
+
+    def export_text(self, text, format, groups=None, chunked=False):
+        '''Export text annotated with biomedical concepts in JSON, XML, A1 or
+        CONLL.
+
+        See :func:`becas.export_text`.
+        '''
+
+        payload = _export_text_payload(text, format, groups)
+        if chunked:
+            if format not in CHUNKED_FORMATS:
+                raise InvalidFormat('Format ``%s`` does not support chunked '
+                                    'annotation' % format)
+            return self._annotate_chunks(
+                text, lambda chunk: self.export_text(chunk, format, groups),
+                _merge_a1 if format == 'a1' else _merge_conll)
+        wanted = None
+        if format in FILTERED_FORMATS:
+            groups, wanted = self._widen_groups(groups)
+            payload = _export_text_payload(text, format, groups)
+        content = self._request('export_text', payload)
+
+        return _filter_export(_decode_text(content), format, wanted)
+
+    def export_text_formats(self, text, formats, groups=None,
+                            render_locally=False):
+        '''Export text annotated with biomedical concepts in several formats.
+
+        See :func:`becas.export_text_formats`.
+        '''
+
+        formats = _validate_formats(formats)
+        results = {}
+        if render_locally and set(formats) & set(LOCAL_EXPORT_FORMATS):
+            results['json'] = self.export_text(text, 'json', groups)
+            result = self._decode_json('export_text', results['json'])
+            for format in formats:
+                if format not in results and format in LOCAL_EXPORT_FORMATS:
+                    results[format] = _render_export(text, result, format)
+        for format in formats:
+            if format not in results:
+                results[format] = self.export_text(text, format, groups)
+        return dict((format, results[format]) for format in formats)
+
+    def annotate_publication(self, pmid, groups=None):
+        '''Annotate PubMed publication with biomedical concepts.
+
+        See :func:`becas.annotate_publication`.
+        '''
+
+        groups, wanted = self._widen_groups(groups)
+        payload = _publication_payload(pmid, groups)
+        content = self._request('annotate_publication', payload, pmid)
+
+        return self._annotation_result('annotate_publication', content,
+                                       wanted)
+
+    def export_publication(self, pmid, groups=None):
+        '''Export PubMed publication as MEDLINE IeXML annotated with
+        biomedical concepts.
+
+        See :func:`becas.export_publication`.
+        '''
+
+        payload = _publication_payload(pmid, groups)
+        content = self._request('export_publication', payload, pmid)
+
+        return _decode_text(content)
+
+    def annotate_texts(self, texts, groups=None, echo=False, workers=None,
+                       ordered=True, dedupe=False):
+        '''Annotate many texts concurrently.
+
+        See :func:`becas.annotate_texts`.
+        '''
+
+        if dedupe:
+            index = dedupe if isinstance(dedupe, SentenceIndex) \
+                else SentenceIndex()
+            return self._batch(
+                lambda text: self._annotate_sentences(text, groups, echo,
+                                                      index),
+                texts, workers, ordered)
+        return self._batch(lambda text: self.annotate_text(text, groups, echo),
+                           texts, workers, ordered)
+
+    def annotate_publications(self, pmids, groups=None, workers=None,
+                              ordered=True):
+        '''Annotate many PubMed publications concurrently.
+
+        See :func:`becas.annotate_publications`.
+        '''
+
+        return self._batch(
+            lambda pmid: self.annotate_publication(pmid, groups), pmids,
+            workers, ordered)
+
+    def _annotate_sentences(self, text, groups, echo, index):
+        '''Annotate ``text`` sentence by sentence, requesting only those not
+        in sentence ``index``, joined in as few requests as possible, and
+        reassemble their results.'''
+
+        _validate_text(text)
+        groups, wanted = self._widen_groups(groups)
+        if groups:
+            _validate_groups(groups)
+        codec = _json_codec()
+        sentences = _split_sentences(text)
+        keys = [_cache_key('sentence', {'text': sentence, 'groups': groups})
+                for _, sentence in sentences]
+        contents, waiting, led = {}, {}, []
+        for key, (_, sentence) in zip(keys, sentences):
+            if key in contents or key in waiting:
+                continue
+            content, call, leader = index._claim(key)
+            if leader:
+                led.append((key, sentence, call))
+                waiting[key] = call
+            elif call is not None:
+                waiting[key] = call
+            else:
+                contents[key] = content
+        try:
+            for batch in _join_sentences(led, self._option('chunk_size')):
+                joined, offsets = '', []
+                for _, sentence, _ in batch:
+                    offsets.append(len(joined))
+                    joined += sentence + '\n\n'
+                result = self._decode_json('annotate_text', self._request(
+                    'annotate_text', _annotate_text_payload(joined, groups)))
+                for (key, _, call), sentence_result in zip(
+                        batch, _split_annotations(result, offsets)):
+                    index._resolve(key, call, codec.dumps(sentence_result))
+        except BaseException as e:
+            for key, _, call in led:
+                if not call.done.is_set():
+                    index._resolve(key, call, error=e)
+            raise
+        # sentences led by other documents are being annotated meanwhile
+        for key, call in waiting.items():
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            contents[key] = call.result
+
+        results = _merge_annotations(text, [
+            (offset, codec.loads(contents[key]))
+            for (offset, _), key in zip(sentences, keys)])
+        results.setdefault('entities', [])
+        results.setdefault('ids', {})
+        if echo:
+            results['text'] = text
+        results = _filter_groups(results, wanted)
+        return AnnotationResult(results) if self.typed else results
+
+    def _annotate_chunks(self, text, annotate, merge):
+        '''Split ``text`` in chunks, ``annotate`` them concurrently and
+        ``merge`` their results.'''
+
+        chunks = _split_text(text, self._option('chunk_size'))
+        results = []
+        for result in self._batch(lambda chunk: annotate(chunk[1]), chunks):
+            if result.error is not None:
+                raise result.error
+            results.append((result.item[0], result.result))
+        return merge(text, results)
+
+    def _decode_json(self, endpoint, content):
+        '''Decode JSON result of API method ``endpoint``, timing it.'''
+
+        started = _clock()
+        result = _decode_json(content)
+        self.metrics.record_decode(endpoint, _clock() - started)
+        return result
+
+    def _annotation_result(self, endpoint, content, groups=None):
+        '''Return annotation result of API method ``endpoint`` in response
+        body ``content``, filtered to semantic ``groups`` if given.'''
+
+        if groups is None:
+            return AnnotationResult(content) if self.typed else \
+                self._decode_json(endpoint, content)
+        result = _filter_groups(self._decode_json(endpoint, content), groups)
+        return AnnotationResult(result) if self.typed else result
+
+    def _widen_groups(self, groups):
+        '''Return the semantic groups to request instead of ``groups``, and
+        the groups to filter results to, if any.'''
+
+        return _widen_groups(self._option('superset_groups'), groups)
+
+    def _batch(self, func, items, workers=None, ordered=True):
+        '''Apply ``func`` to ``items`` in a pool of worker threads, yielding
+        a :class:`BatchResult` for each item.'''
+
+        if workers is None:
+            concurrency = self._option('concurrency')
+            workers = concurrency.maximum if concurrency is not None \
+                else globals()['workers']
+        return _batch(func, items, workers, ordered)
+
+    def _option(self, name):
+        '''Return client option, falling back to module configuration.'''
+
+        value = getattr(self, name)
+        return globals()[name] if value is None else value
+
+    def _validate_authentication(self):
+        '''Ensure the client has authentication parameters.'''
+
+        _validate_authentication(self._option('email'), self._option('tool'))
+
+    def _endpoint_url(self, endpoint, pmid=None, instance=None):
+        '''Return service URL for given endpoint, of a balanced
+        ``instance`` if given.'''
+
+        return _endpoint_url(endpoint, pmid, secure=self._option('secure'),
+                             email=self._option('email'),
+                             tool=self._option('tool'),
+                             base_url=instance.url if instance else None)
+
+    def _request(self, endpoint, payload, pmid=None):
+        '''Return the response body of a request to one of the becas API
+        endpoints, from the result caches if possible.'''
+
+        self._validate_authentication()
+        memory_cache = self._option('memory_cache') if pmid else None
+        if memory_cache is not None:
+            memory_key = (endpoint, pmid,
+                          tuple(sorted(payload.get('groups', {}).items())))
+            content = memory_cache.get(memory_key)
+            if content is not None:
+                return content
+        cache = self._option('cache')
+        key = None
+        if cache is not None or self._in_flight is not None:
+            key = _cache_key(endpoint, payload, pmid)
+        content = cache.get(key) if cache is not None else None
+        if content is None:
+            if self._in_flight is not None:
+                content = self._in_flight.do(
+                    key, lambda: self._fetch(endpoint, payload, pmid, cache,
+                                             key))
+            else:
+                content = self._fetch(endpoint, payload, pmid, cache, key)
+
+        if memory_cache is not None:
+            memory_cache.set(memory_key, content)
+        return content
+
+    def _fetch(self, endpoint, payload, pmid, cache, key):
+        '''Return the response body of a request to one of the becas API
+        endpoints, storing it in the result cache.'''
+
+        content = self._do_request(endpoint, payload, pmid).content
+        if cache is not None:
+            cache.set(key, content)
+        return content
+
+    def _do_request(self, endpoint, payload, pmid=None):
+        '''Perform a POST request to API method ``endpoint`` through the
+        client session, failing over between balanced instances and
+        retrying transient errors according to the client retry policy.'''
+
+        balancer = _balancer(self._option('base_url'))
+        concurrency = self._option('concurrency')
+        retry = self._option('retry')
+        hooks = self._option('hooks')
+        failed = set()
+        started = _clock()
+        attempt = 0
+        while True:
+            attempt += 1
+            token = concurrency.acquire() if concurrency is not None else None
+            instance = balancer.acquire(failed) if balancer else None
+            url = self._endpoint_url(endpoint, pmid, instance)
+            rate_limiter = instance and instance.rate_limiter or \
+                self._rate_limiter()
+            info = RequestInfo(endpoint, url, attempt)
+            error = None
+            try:
+                try:
+                    # in here, so a failing hook releases token and instance
+                    if instance is not None:
+                        self._mount(instance.url)
+                    wait = rate_limiter.acquire()
+                    if wait:
+                        info.timings['throttle'] = wait
+                        self.metrics.record_throttle(wait)
+                        _fire(hooks, 'throttle', info)
+                    _fire(hooks, 'before_request', info)
+                    res = self._send(url, payload, info)
+                except BaseException as e:
+                    error = e
+                    raise
+                finally:
+                    if concurrency is not None:
+                        concurrency.release(token,
+                                            info.timings.get('total', 0),
+                                            error)
+                    if instance is not None:
+                        balancer.release(instance, error)
+            except BecasException as e:
+                info.error = e
+                self.metrics.record_request(endpoint,
+                                            info.timings.get('total', 0), e)
+                _fire(hooks, 'after_request', info)
+                if instance is not None and isinstance(e, _FAILOVER_ERRORS):
+                    failed.add(instance)
+                    if len(failed) < len(balancer.instances):
+                        # fail over to another instance right away
+                        info.delay = 0
+                        _fire(hooks, 'retry', info)
+                        continue
+                    failed.clear()
+                wait = retry and retry.delay(attempt, e, _clock() - started)
+                if wait is None:
+                    raise
+                info.delay = wait
+                _fire(hooks, 'retry', info)
+                rate_limiter.pause(wait)
+            else:
+                self.metrics.record_request(endpoint, info.timings['total'])
+                _fire(hooks, 'after_request', info)
+                if res is not _RESEND:
+                    return res
+                info.delay = 0
+                _fire(hooks, 'retry', info)
+
+    def _mount(self, base_url):
+        '''Give the balanced instance at ``base_url`` its own connection
+        pool.'''
+
+        if base_url in self._mounted:
+            return
+        import requests
+        with self._mount_lock:
+            if base_url not in self._mounted:
+                self.session.mount(base_url, requests.adapters.HTTPAdapter(
+                    pool_connections=1, pool_maxsize=self._pool_maxsize))
+                self._mounted.add(base_url)
+
+    def _send(self, url, payload, info):
+        '''Perform a single POST request through the client session,
+        recording its transfer and timings in ``info``, and return the
+        response, or ``_RESEND`` if it must be sent again uncompressed.'''
+
+        import requests
+        data = _json_codec().dumps(payload)
+        body, headers = _encode_body(data, self.compress_requests)
+        started = _clock()
+        try:
+            try:
+                res = self.session.post(url,
+                                        data=body,
+                                        headers=headers,
+                                        timeout=self._option('timeout'))
+            finally:
+                info.timings['total'] = _clock() - started
+        except requests.exceptions.Timeout as e:
+            raise Timeout(e)
+        except requests.exceptions.SSLError as e:
+            raise SSLError(e)
+        except requests.exceptions.ConnectionError as e:
+            raise ConnectionError(e)
+        except Exception as e:
+            raise BecasException(e)
+
+        info.status = res.status_code
+        info.bytes_sent, info.bytes_received = len(body), _wire_size(res)
+        # requests reads the body right after the headers, timed in elapsed
+        info.timings['response'] = min(res.elapsed.total_seconds(),
+                                       info.timings['total'])
+        info.timings['download'] = (info.timings['total'] -
+                                    info.timings['response'])
+        self.metrics.record_transfer(len(body), len(data),
+                                     info.bytes_received, len(res.content),
+                                     info.endpoint)
+        if headers and res.status_code == 415:
+            # the service doesn't accept compressed requests, stop trying
+            self.compress_requests = None
+            return _RESEND
+        _check_status(res.status_code, res.headers, res.content, res.reason)
+        return res
+
+    def _rate_limiter(self):
+        '''Return the rate limiter throttling requests of this client.'''
+
+        return self._option('rate_limiter') or _shared_rate_limiter
+
+
+_default_client_lock = threading.Lock()
+
+
+def _default_client():
+    '''Return the shared client used by the module-level API methods.'''
+
+    if _default_client.client is None:
+        with _default_client_lock:
+            if _default_client.client is None:
+                _default_client.client = BecasClient()
+    return _default_client.client
+
+
+_default_client.client = None
+
+
+#: Outcome of one item of a batch: its position in the input, the input
+#: item, and either its ``result`` or the ``error`` raised for it.
+BatchResult = collections.namedtuple('BatchResult',
+                                     ('index', 'item', 'result', 'error'))
+
+
+_profilers = None  # profilers of worker threads, a list when profiling
+_thread_profiler = threading.local()
+
+
+def _profiled(func, *args):
+    '''Call ``func`` with ``args``, profiling this thread if :func:`main` is
+    profiling, as its profiler only profiles the main thread.'''
+
+    profilers = _profilers
+    if profilers is None:
+        return func(*args)
+    local = _thread_profiler
+    if getattr(local, 'profilers', None) is not profilers:
+        import cProfile
+        local.profilers, local.profiler = profilers, cProfile.Profile()
+        profilers.append(local.profiler)
+    return local.profiler.runcall(func, *args)
+
+
+def _batch(func, items, workers, ordered=True,
+           errors=(BecasException, ValueError)):
+    '''Apply ``func`` to ``items`` in a pool of ``workers`` threads.
+
+    At most ``2 * workers`` items are pending at any time, so ``items`` can be
+    a lazy iterable of any length. Results are yielded in input order if
+    ``ordered``, else as they complete. Exceptions in ``errors`` are reported
+    in the results of the items raising them.
+    '''
+
+    from concurrent import futures
+
+    def call(index, item):
+        try:
+            return BatchResult(index, item, _profiled(func, item), None)
+        except errors as e:
+            return BatchResult(index, item, None, e)
+
+    items = enumerate(items)
+    executor = futures.ThreadPoolExecutor(max_workers=workers)
+    pending = collections.deque()
+    try:
+        for index, item in items:
+            pending.append(executor.submit(call, index, item))
+            if len(pending) < 2 * workers:
+                continue
+            if ordered:
+                yield pending.popleft().result()
+            else:
+                done, _ = futures.wait(pending,
+                                       return_when=futures.FIRST_COMPLETED)
+                for future in done:
+                    pending.remove(future)
+                    yield future.result()
+        if ordered:
+            while pending:
+                yield pending.popleft().result()
+        else:
+            for future in futures.as_completed(list(pending)):
+                yield future.result()
+    finally:
+        for future in pending:
+            future.cancel()
+        executor.shutdown(wait=True)
+
+
 # -- API methods --------------------------------------------------------------
-def annotate_text(text, groups=None, echo=False):
+def annotate_text(text, groups=None, echo=False, chunked=False):
     '''Annotate text with biomedical concepts.
 
     :param text: text to annotate (:class:`str` or :class:`unicode`).
     :param groups: *optional* :class:`dict` of concept groups to identity.
     :param echo: *optional* flag to return ``text`` in the response.
+    :param chunked: *optional* flag to split long ``text`` in chunks of at most
+                    :data:`chunk_size` characters, annotated concurrently.
 
     :return: :class:`dict` with annotation results.
 
@@ -175,30 +2334,25 @@ def annotate_text(text, groups=None, echo=False):
       >>> becas.email = 'you@example.com'
       >>> results = becas.annotate_text('BRCA1 is a human caretaker gene.')
 
+    Texts too long to annotate in a single request (raising
+    :class:`TooMuchText`) can be annotated with ``chunked=True``. Chunks end
+    at paragraph or sentence boundaries and their results are merged, with
+    entity offsets relative to the whole ``text``.
     '''
 
-    _validate_text(text)
-    payload = {'text': text}
-    if groups:
-        _validate_groups(groups)
-        payload['groups'] = groups
-    if echo:
-        payload['echo'] = True
-    _validate_authentication()
-
-    endpoint = _endpoint_url('annotate_text')
-    response = _do_request(endpoint, payload)
+    return _default_client().annotate_text(text, groups, echo, chunked)
 
-    return response.json()
 
-
-def export_text(text, format, groups=None):
+def export_text(text, format, groups=None, chunked=False):
     '''Export text annotated with biomedical concepts in JSON, XML, A1 or
     CONLL.
 
     :param text: text to annotate (:class:`str` or :class:`unicode`).
     :param format: output format (one of 'json', 'xml', 'a1' or 'conll').
     :param groups: *optional* :class:`dict` of concept groups to identity.
+    :param chunked: *optional* flag to split long ``text`` in chunks of at most
+                    :data:`chunk_size` characters, annotated concurrently.
+                    Only for formats in :data:`CHUNKED_FORMATS`.
 
     :return: :class:`unicode` string with annotation results.
 
@@ -214,18 +2368,46 @@ def export_text(text, format, groups=None):
 
     '''
 
-    _validate_text(text)
-    _validate_format(format)
-    payload = {'text': text, 'format': format}
-    if groups:
-        _validate_groups(groups)
-        payload['groups'] = groups
-    _validate_authentication()
+    return _default_client().export_text(text, format, groups, chunked)
+
+
+def export_text_formats(text, formats, groups=None, render_locally=False):
+    '''Export text annotated with biomedical concepts in several formats at
+    once.
 
-    endpoint = _endpoint_url('export_text')
-    response = _do_request(endpoint, payload)
+    Each format is requested from the service, unless ``render_locally``:
+    formats in :data:`LOCAL_EXPORT_FORMATS` are then rendered from a single
+    JSON export instead of a request each, so the text is annotated once.
+    Results rendered locally are not those of the service. A1 gets a
+    text-bound annotation per mention and a ``Reference`` normalization per
+    concept. CoNLL gets ``TOKEN START END TAG`` lines of whitespace separated
+    tokens, tagged ``B-`` or ``I-`` semantic group, or ``O``. XML is always
+    requested from the service.
 
-    return response.text
+    :param text: text to annotate (:class:`str` or :class:`unicode`).
+    :param formats: output formats (any of :data:`EXPORT_FORMATS`), as a
+                    list or a comma separated string.
+    :param groups: *optional* :class:`dict` of concept groups to identity.
+    :param render_locally: *optional* flag to render A1 and CoNLL from the
+                           JSON export (default: ``False``).
+
+    :return: :class:`dict` mapping each format to a :class:`unicode` string
+             with annotation results.
+
+    Usage::
+
+      >>> import becas
+      >>> becas.email = 'you@example.com'
+      >>> text = 'BRCA1 is a human caretaker gene.'
+      >>> results = becas.export_text_formats(text, 'json,a1,conll',
+      ...                                     render_locally=True)
+      >>> sorted(results)
+      ['a1', 'conll', 'json']
+
+    '''
+
+    return _default_client().export_text_formats(text, formats, groups,
+                                                 render_locally)
 
 
 def annotate_publication(pmid, groups=None):
@@ -244,17 +2426,7 @@ def annotate_publication(pmid, groups=None):
 
     '''
 
-    _validate_pmid(pmid)
-    payload = {}
-    if groups:
-        _validate_groups(groups)
-        payload['groups'] = groups
-    _validate_authentication()
-
-    endpoint = _endpoint_url('annotate_publication', pmid=pmid)
-    response = _do_request(endpoint, payload)
-
-    return response.json()
+    return _default_client().annotate_publication(pmid, groups)
 
 
 def export_publication(pmid, groups=None):
@@ -274,37 +2446,321 @@ def export_publication(pmid, groups=None):
 
     '''
 
+    return _default_client().export_publication(pmid, groups)
+
+
+def annotate_texts(texts, groups=None, echo=False, workers=None,
+                   ordered=True, dedupe=False):
+    '''Annotate many texts with biomedical concepts concurrently.
+
+    :param texts: iterable of texts to annotate.
+    :param groups: *optional* :class:`dict` of concept groups to identity.
+    :param echo: *optional* flag to return each text in its response.
+    :param workers: *optional* number of concurrent requests (default:
+                    :data:`workers`).
+    :param ordered: *optional* flag to yield results in input order
+                    (default: ``True``) or as soon as they complete.
+    :param dedupe: *optional* flag to split texts in sentences and annotate
+                   each distinct sentence once, or a :class:`SentenceIndex`
+                   of sentences already annotated to reuse. The sentences
+                   of a text not seen before are sent in a single request,
+                   and results are reassembled with offsets in the text.
+
+    :return: iterator of :class:`BatchResult`, one per text, holding either
+             the annotation results :class:`dict` or the exception raised
+             for that text.
+
+    All workers share the same request throttle. Usage::
+
+      >>> import becas
+      >>> becas.email = 'you@example.com'
+      >>> texts = ['BRCA1 is a human caretaker gene.', 'Asthma and COPD.']
+      >>> for batch_result in becas.annotate_texts(texts, workers=2):
+      ...     if batch_result.error:
+      ...         print(batch_result.index, batch_result.error)
+
+    '''
+
+    return _default_client().annotate_texts(texts, groups, echo, workers,
+                                            ordered, dedupe)
+
+
+def annotate_publications(pmids, groups=None, workers=None, ordered=True):
+    '''Annotate many PubMed publications with biomedical concepts
+    concurrently.
+
+    :param pmids: iterable of PMIDs of publications to annotate.
+    :param groups: *optional* :class:`dict` of concept groups to identity.
+    :param workers: *optional* number of concurrent requests (default:
+                    :data:`workers`).
+    :param ordered: *optional* flag to yield results in input order
+                    (default: ``True``) or as soon as they complete.
+
+    :return: iterator of :class:`BatchResult`, one per PMID, holding either
+             the annotation results :class:`dict` or the exception raised
+             for that publication.
+
+    Usage::
+
+      >>> import becas
+      >>> becas.email = 'you@example.com'
+      >>> results = dict((r.item, r.result) for r in
+      ...                becas.annotate_publications([23225384, 23193287]))
+
+    '''
+
+    return _default_client().annotate_publications(pmids, groups, workers,
+                                                   ordered)
+
+
+# -- Streaming output ---------------------------------------------------------
+class JSONLinesWriter(object):
+    '''Stream annotation results to a file as JSON Lines.
+
+    Each result is written as soon as it is available, as one JSON object per
+    line holding the input identifier and either the ``result`` or the
+    ``error`` message, so memory use doesn't grow with the number of results
+    and consumers can start reading before a batch ends. Lines are flushed to
+    the output in batches, at most ``flush_every`` lines or
+    ``flush_interval`` seconds apart.
+
+    :param output: path of file to write to, or binary file object. Paths
+                   ending in ``.gz`` are gzip compressed.
+    :param id_key: *optional* JSON key of the input identifier
+                   (default: ``'id'``).
+    :param append: *optional* flag to append to an existing file.
+    :param compress: *optional* flag to gzip the output, overriding the
+                     choice based on the file name.
+    :param flush_every: *optional* number of lines between flushes
+                        (default: 1000).
+    :param flush_interval: *optional* maximum seconds between flushes
+                           (default: 1).
+
+    Usage::
+
+      >>> import io
+      >>> import becas
+      >>> output = io.BytesIO()
+      >>> with becas.JSONLinesWriter(output, id_key='pmid') as writer:
+      ...     _ = writer.write(23225384, {'entities': []})
+      ...     _ = writer.write(1, error=becas.PublicationNotFound('Not found'))
+      >>> print(output.getvalue().decode('utf-8').strip())
+      {"pmid": 23225384, "result": {"entities": []}}
+      {"pmid": 1, "error": "PublicationNotFound: Not found"}
+
+    '''
+
+    def __init__(self, output, id_key='id', append=False, compress=None,
+                 flush_every=1000, flush_interval=1):
+        self.id_key = id_key
+        self.flush_every = flush_every
+        self.flush_interval = flush_interval
+        #: Number of lines written
+        self.lines = 0
+        if hasattr(output, 'write'):
+            self._close = False
+            self._file = output
+        else:
+            self._close = True
+            self._file = open(output, 'ab' if append else 'wb')
+            if compress is None:
+                compress = output.endswith('.gz')
+        self.compress = bool(compress)
+        self._pending = []
+        self._flushed = _clock()
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def write(self, id, result=None, error=None):
+        '''Write the ``result`` of input ``id``, or the ``error`` it raised.
+        Return whether written lines were flushed.'''
+
+        record = collections.OrderedDict([(self.id_key, id)])
+        if error is not None:
+            record['error'] = '%s: %s' % (type(error).__name__, error)
+        else:
+            record['result'] = result.raw \
+                if isinstance(result, AnnotationResult) else result
+        line = (json.dumps(record) + '\n').encode('utf-8')
+        with self._lock:
+            self._pending.append(line)
+            self.lines += 1
+            if len(self._pending) >= self.flush_every or \
+                    _clock() - self._flushed >= self.flush_interval:
+                self._flush()
+                return True
+            return False
+
+    def flush(self):
+        '''Flush written lines to the output.'''
+
+        with self._lock:
+            self._flush()
+
+    def close(self):
+        '''Flush and close the output, unless it was given as a file object.'''
+
+        with self._lock:
+            self._flush()
+            if self._close:
+                self._file.close()
+
+    def _flush(self):
+        # Compressed lines are flushed as complete gzip members, so the
+        # output stays readable, and appendable, up to the last flush
+        if self._pending:
+            data = b''.join(self._pending)
+            self._file.write(_gzip(data) if self.compress else data)
+            self._pending = []
+        self._file.flush()
+        self._flushed = _clock()
+
+
+def _gzip(data):
+    '''Return ``data`` compressed as a gzip member.'''
+
+    import io
+    import gzip
+    buf = io.BytesIO()
+    with gzip.GzipFile(fileobj=buf, mode='wb') as gzip_file:
+        gzip_file.write(data)
+    return buf.getvalue()
+
+
+# -- Helpers ------------------------------------------------------------------
+def _endpoint_url(endpoint, pmid=None, secure=None, email=None, tool=None,
+                  base_url=None):
+    '''Return service URL for given endpoint, of the becas API at
+    ``base_url`` or the public one.'''
+
+    if endpoint not in _ENDPOINT_PATHS:
+        raise ValueError('Unknown endpoint "%s"' % endpoint)
+    if base_url is None:
+        base_url = ('https://' if secure else 'http://') + _ENDPOINTS_PREFIX
+    url = base_url + _ENDPOINT_PATHS[endpoint]
+    if endpoint.endswith('_publication'):
+        url += str(pmid)
+    return url + '?tool=' + quote(tool) + '&email=' + quote(email)
+
+
+def _annotate_text_payload(text, groups=None, echo=False):
+    '''Validate arguments and return payload for text annotation.'''
+
+    _validate_text(text)
+    payload = {'text': text}
+    if groups:
+        _validate_groups(groups)
+        payload['groups'] = groups
+    if echo:
+        payload['echo'] = True
+    return payload
+
+
+def _export_text_payload(text, format, groups=None):
+    '''Validate arguments and return payload for text export.'''
+
+    _validate_text(text)
+    _validate_format(format)
+    payload = {'text': text, 'format': format}
+    if groups:
+        _validate_groups(groups)
+        payload['groups'] = groups
+    return payload
+
+
+def _publication_payload(pmid, groups=None):
+    '''Validate arguments and return payload for publication annotation or
+    export.'''
+
     _validate_pmid(pmid)
     payload = {}
     if groups:
         _validate_groups(groups)
         payload['groups'] = groups
-    _validate_authentication()
+    return payload
 
-    endpoint = _endpoint_url('export_publication', pmid=pmid)
-    response = _do_request(endpoint, payload)
 
-    return response.text
+def _cache_key(endpoint, payload, pmid=None):
+    '''Return result cache key for a request to ``endpoint``.'''
 
+    data = json.dumps([endpoint, pmid, payload], sort_keys=True,
+                      separators=(',', ':'))
+    return hashlib.sha256(data.encode('utf-8')).hexdigest()
 
-# -- Helpers ------------------------------------------------------------------
-def _endpoint_url(endpoint, pmid=None):
-    '''Return service URL for given endpoint.'''
-
-    scheme = 'https://' if secure else 'http://'
-    auth = '?tool=' + quote(tool) + '&email=' + quote(email)
-    if endpoint == 'annotate_text':
-        return scheme + _TEXT_ANNOTATE_ENDPOINT + auth
-    if endpoint == 'export_text':
-        return scheme + _TEXT_EXPORT_ENDPOINT + auth
-    if endpoint == 'annotate_publication':
-        return scheme + _PUBMED_ANNOTATE_ENDPOINT + str(pmid) + auth
-    if endpoint == 'export_publication':
-        return scheme + _PUBMED_EXPORT_ENDPOINT + str(pmid) + auth
-    raise ValueError('Unknown endpoint "%s"' % endpoint)
-
-
-def _validate_authentication():
+
+def _decode_json(content):
+    '''Decode JSON response body.'''
+
+    return _json_codec().loads(content)
+
+
+#: JSON libraries by order of preference
+_JSON_CODECS = ('orjson', 'ujson', 'json',)
+_JSONCodec = collections.namedtuple('_JSONCodec', ('name', 'dumps', 'loads'))
+
+
+def _json_codec():
+    '''Return the configured JSON codec, encoding to and decoding from UTF-8
+    :class:`bytes`.'''
+
+    codec = _json_codec.codecs.get(json_codec)
+    if codec is None:
+        codec = _json_codec.codecs[json_codec] = _load_json_codec(json_codec)
+    return codec
+
+
+_json_codec.codecs = {}  # loaded codecs by configured name
+
+
+def _load_json_codec(name=None):
+    '''Return JSON codec using library ``name``, or the fastest installed.
+
+    >>> _load_json_codec('json').loads(b'{"a": 1}')
+    {'a': 1}
+
+    '''
+
+    if name is not None and name not in _JSON_CODECS:
+        raise ValueError('Unknown JSON codec ``%s``' % name)
+    for candidate in (name,) if name else _JSON_CODECS:
+        if candidate == 'orjson':
+            try:
+                import orjson
+            except ImportError:
+                if name:
+                    raise
+                continue
+            # orjson encodes to and decodes from bytes, no text copies
+            return _JSONCodec('orjson', orjson.dumps, orjson.loads)
+        if candidate == 'ujson':
+            try:
+                import ujson
+            except ImportError:
+                if name:
+                    raise
+                continue
+            return _JSONCodec(
+                'ujson',
+                lambda obj: ujson.dumps(obj, ensure_ascii=False)
+                .encode('utf-8'),
+                ujson.loads)
+    return _JSONCodec('json',
+                      lambda obj: json.dumps(obj).encode('utf-8'),
+                      lambda data: json.loads(data.decode('utf-8')))
+
+
+def _decode_text(content):
+    '''Decode text response body.'''
+
+    return content.decode('utf-8')
+
+
+def _validate_authentication(email, tool):
     '''Ensure the user has authenticated itself by providing an email
     address and tool name.'''
 
@@ -356,59 +2812,653 @@ def _validate_format(format):
         raise InvalidFormat('Unknown format ``%s``' % format)
 
 
-def _do_request(endpoint, payload):
-    '''Perform a POST request to one of the becas API endpoints.'''
+def _validate_formats(formats):
+    '''Validate export formats, given as a list or a comma separated string,
+    and return them as a list without duplicates.'''
+
+    if isinstance(formats, _string_types):
+        formats = formats.split(',')
+    unique = []
+    for format in formats:
+        format = format.strip()
+        _validate_format(format)
+        if format not in unique:
+            unique.append(format)
+    if not unique:
+        raise InvalidFormat('No export format given')
+    return unique
+
+
+def _new_session(pool_connections, pool_maxsize, keep_alive=True):
+    '''Return a :class:`requests.Session` with a keep-alive connection pool.'''
+
+    import requests
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=pool_connections,
+                                            pool_maxsize=pool_maxsize)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    session.headers.update(_default_headers())
+    if not keep_alive:
+        session.headers['Connection'] = 'close'
+    # SSL certificate validation fails in systems without proper CAs
+    # installed, so we disable client validation
+    session.verify = False
+    return session
+
+
+def _default_headers():
+    '''Return headers sent with every request.'''
+
+    import requests
+    headers = dict(_DEFAULT_HEADERS)
+    headers['User-Agent'] = 'becas-python/%s %s' % (
+        __version__, requests.utils.default_user_agent())
+    return headers
+
+
+def _encode_body(data, encoding):
+    '''Return request body and headers for ``data`` compressed with
+    ``encoding`` (``'gzip'``, ``'deflate'`` or ``None``), if worth it.'''
+
+    if not encoding or len(data) < _COMPRESS_MIN_SIZE:
+        return data, None
+    if encoding == 'gzip':
+        return _gzip(data), {'Content-Encoding': 'gzip'}
+    if encoding == 'deflate':
+        import zlib
+        return zlib.compress(data), {'Content-Encoding': 'deflate'}
+    raise ValueError('Unknown request encoding ``%s``' % encoding)
+
+
+def _wire_size(res):
+    '''Return bytes of a response body as transferred, before decoding.'''
 
-    # Throttle requests to perform at most two per second
-    delay = 0.5
-    current = time.time()
-    wait = _do_request._previous + delay - current
-    if wait > 0:
-        time.sleep(wait)
-        _do_request._previous = current + wait
-    else:
-        _do_request._previous = current
     try:
-        res = requests.post(endpoint,
-                            data=json.dumps(payload),
-                            headers=_DEFAULT_HEADERS,
-                            timeout=timeout,
-                            verify=False)  # SSL certificate validation fails
-                                           # in systems without proper CAs
-                                           # installed, so we disable
-                                           # client validation
-    except requests.exceptions.Timeout as e:
-        raise Timeout(e)
-    except requests.exceptions.SSLError as e:
-        raise SSLError(e)
-    except requests.exceptions.ConnectionError as e:
-        raise ConnectionError(e)
-    except Exception as e:
-        raise BecasException(e)
+        return res.raw.tell()
+    except (AttributeError, ValueError, IOError):
+        pass
+    try:
+        return int(res.headers['Content-Length'])
+    except (KeyError, ValueError):
+        return len(res.content)
+
+
+def _check_status(status_code, headers, content, reason=None):
+    '''Raise the exception matching an HTTP error response, if any.'''
+
+    if status_code < 400:
+        return
+    if status_code == 404:
+        raise PublicationNotFound(_error_message(content))
+    if status_code == 413:
+        raise TooMuchText(_error_message(content))
+    if status_code == 429:
+        raise TooManyRequests(wait=headers.get('Retry-After'))
+    if status_code == 502:
+        raise ServiceUnavailable()
+    if status_code == 503:
+        raise ServiceUnavailable(_error_message(content))
+    raise BecasException('%s %s' % (status_code, reason or 'HTTP Error'))
+
+
+def _error_message(content):
+    '''Return the ``error`` message of a JSON error response body.'''
 
     try:
-        res.raise_for_status()
-    except requests.exceptions.HTTPError as e:
-        if res.status_code == 404:
-            raise PublicationNotFound(res.json()['error'])
-        if res.status_code == 413:
-            raise TooMuchText(res.json()['error'])
-        if res.status_code == 429:
-            raise TooManyRequests(wait=res.headers['Retry-After'])
-        if res.status_code == 502:
-            raise ServiceUnavailable()
-        if res.status_code == 503:
-            raise ServiceUnavailable(res.json()['error'])
-        raise BecasException(e)
+        if isinstance(content, bytes):
+            content = content.decode('utf-8')
+        return json.loads(content)['error']
+    except (ValueError, KeyError, TypeError):
+        return content
+
+
+# -- Text chunking ------------------------------------------------------------
+_SENTENCE_END = re.compile(r'([.!?])["\')\]]*\s+|\n')
+_LAST_WORD = re.compile(r'[\w.]+$', re.UNICODE)
+#: Abbreviations not ending sentences, lowercase without the last period
+_ABBREVIATIONS = frozenset(('al', 'approx', 'ca', 'cf', 'dr', 'e.g', 'eq',
+                            'eqs', 'fig', 'figs', 'i.e', 'no', 'nos', 'prof',
+                            'ref', 'refs', 'resp', 'sp', 'spp', 'st',
+                            'tab', 'vs'))
+
+
+def _split_text(text, size):
+    r'''Split ``text`` in chunks of at most ``size`` characters, preferably at
+    paragraph or sentence boundaries. Return list of ``(offset, chunk)``.
+
+    >>> _split_text('One. Two.\n\nThree four.', 12)
+    [(0, 'One. Two.\n\n'), (11, 'Three four.')]
+    >>> _split_text('abcdef', 4)
+    [(0, 'abcd'), (4, 'ef')]
+
+    '''
+
+    chunks = []
+    start = 0
+    while len(text) - start > size:
+        window = text[start:start + size]
+        end = window.rfind('\n\n') + 2
+        if end < size // 2:
+            ends = _sentence_ends(window)
+            end = ends[-1] if ends else 0
+        if end < size // 2:
+            end = max(window.rfind(' '), window.rfind('\t')) + 1
+        if end <= 0:
+            end = size
+        chunks.append((start, window[:end]))
+        start += end
+    chunks.append((start, text[start:]))
+    return [(offset, chunk) for offset, chunk in chunks if chunk.strip()]
+
+
+def _split_sentences(text):
+    r'''Split ``text`` at sentence ends and line breaks. Return list of
+    ``(offset, sentence)``, sentences stripped of surrounding whitespace.
+
+    >>> _split_sentences('One. Two!\n  Three "four."  ')
+    [(0, 'One.'), (5, 'Two!'), (12, 'Three "four."')]
+    >>> _split_sentences('Infection with E. coli was treated, vs. placebo '
+    ...                  '(Fig. 2). See Smith et al. (2010), i.e. S. aureus.')
+    ... # doctest: +NORMALIZE_WHITESPACE
+    [(0, 'Infection with E. coli was treated, vs. placebo (Fig. 2).'),
+     (58, 'See Smith et al. (2010), i.e. S. aureus.')]
+
+    '''
+
+    ends = _sentence_ends(text)
+    sentences = []
+    start = 0
+    for end in ends + [len(text)]:
+        sentence = text[start:end]
+        stripped = sentence.lstrip()
+        if stripped.strip():
+            sentences.append((start + len(sentence) - len(stripped),
+                              stripped.rstrip()))
+        start = end
+    return sentences
+
+
+def _sentence_ends(text):
+    '''Return offsets after the sentence ends and line breaks of ``text``.
+
+    Periods after a single capital letter or one of :data:`_ABBREVIATIONS`,
+    and sentence ends followed by a lowercase word or a number, don't end
+    sentences.
+
+    >>> _sentence_ends('See Dr. J. Smith et al. 2 times. Why? it did. Done.')
+    [33, 46]
+
+    '''
+
+    ends = []
+    for match in _SENTENCE_END.finditer(text):
+        end = match.end()
+        if match.group(1) is not None:
+            following = text[end:end + 1]
+            if following.islower() or following.isdigit():
+                continue
+            if match.group(1) == '.':
+                word = _LAST_WORD.search(text, max(0, match.start() - 20),
+                                         match.start())
+                word = word.group() if word else ''
+                if len(word) == 1 and word.isupper() or \
+                        word.lower() in _ABBREVIATIONS:
+                    continue
+        ends.append(end)
+    return ends
+
+
+def _split_annotations(result, offsets):
+    '''Split annotation ``result`` of sentences joined in one text, starting
+    at ``offsets``, into a result per sentence with entity offsets relative
+    to it.
+
+    >>> results = _split_annotations(
+    ...     {'entities': ['BRCA1|UNIPROT:P38398:::PRGE|0',
+    ...                   'cancer|UMLS:C0006826:T191:DISO|8'],
+    ...      'ids': {'UNIPROT:P38398:::PRGE': {},
+    ...              'UMLS:C0006826:T191:DISO': {}}}, [0, 8])
+    >>> results[1]['entities'], list(results[1]['ids'])
+    (['cancer|UMLS:C0006826:T191:DISO|0'], ['UMLS:C0006826:T191:DISO'])
+
+    '''
+
+    entities = [[] for _ in offsets]
+    for entity in result.get('entities', ()):
+        start = _parse_entity(entity)[1]
+        i = bisect.bisect_right(offsets, start or 0) - 1
+        entities[max(i, 0)].append(entity)
+    ids = result.get('ids') or {}
+    results = []
+    for offset, found in zip(offsets, entities):
+        referenced = {}
+        for entity in found:
+            concepts = _parse_entity(entity)[3]
+            if isinstance(concepts, _string_types):
+                concepts = concepts.split(';')
+            for id in concepts:
+                if id in ids:
+                    referenced[id] = ids[id]
+        results.append({'entities': [_shift_entity(entity, -offset)
+                                     for entity in found],
+                        'ids': referenced})
+    return results
+
+
+def _join_sentences(sentences, size):
+    '''Group ``sentences``, ``(key, sentence, call)`` tuples, in batches of
+    at most ``size`` characters once joined, but for longer sentences.'''
+
+    batch, length = [], 0
+    for item in sentences:
+        if batch and length + len(item[1]) + 2 > size:
+            yield batch
+            batch, length = [], 0
+        batch.append(item)
+        length += len(item[1]) + 2
+    if batch:
+        yield batch
+
+
+def _merge_annotations(text, results):
+    '''Merge annotation results of text chunks, given as a list of
+    ``(offset, results)``, shifting entity offsets by chunk offset.'''
+
+    merged = {}
+    for offset, result in results:
+        for key, value in result.items():
+            if key == 'entities':
+                merged.setdefault(key, []).extend(
+                    _shift_entity(entity, offset) for entity in value)
+            elif isinstance(value, dict):
+                merged.setdefault(key, {}).update(value)
+            elif isinstance(value, list):
+                merged.setdefault(key, []).extend(value)
+            else:
+                merged.setdefault(key, value)
+    if 'text' in merged:
+        merged['text'] = text
+    return merged
+
+
+def _shift_entity(entity, offset):
+    '''Shift an entity's offsets by ``offset`` characters.
+
+    Entities are either strings ending in ``|START`` or :class:`dict` with
+    ``start`` and ``end`` keys.
+
+    >>> _shift_entity('BRCA1|UNIPROT:P38398:::PRGE|3', 10)
+    'BRCA1|UNIPROT:P38398:::PRGE|13'
+
+    '''
+
+    if isinstance(entity, dict):
+        entity = dict(entity)
+        for key in ('start', 'end'):
+            if isinstance(entity.get(key), int):
+                entity[key] += offset
+        return entity
+    head, sep, start = entity.rpartition('|')
+    if not sep or not start.isdigit():
+        return entity
+    return '%s|%d' % (head, int(start) + offset)
+
+
+def _merge_a1(text, results):
+    r'''Merge A1 standoff annotations of text chunks, given as a list of
+    ``(offset, a1)``, shifting text-bound offsets by chunk offset and
+    renumbering annotation IDs.
+
+    >>> _merge_a1('', [(0, 'T1\tPRGE 0 5\tBRCA1\nN1\tReference T1 X\tBRCA1'),
+    ...                (9, 'T1\tDISO 2 8\tcancer\n')]).splitlines()
+    ... # doctest: +NORMALIZE_WHITESPACE
+    ['T1\tPRGE 0 5\tBRCA1', 'N1\tReference T1 X\tBRCA1',
+     'T2\tDISO 11 17\tcancer']
+
+    '''
+
+    counters = {}
+    lines = []
+    for offset, a1 in results:
+        ids = {}
+        chunk_lines = [line.split('\t') for line in a1.splitlines() if line]
+        for fields in chunk_lines:
+            prefix = fields[0][:1]
+            counters[prefix] = counters.get(prefix, 0) + 1
+            ids[fields[0]] = '%s%d' % (prefix, counters[prefix])
+        for fields in chunk_lines:
+            fields[0] = ids[fields[0]]
+            if len(fields) > 1:
+                if fields[0].startswith('T'):
+                    fields[1] = _shift_a1_spans(fields[1], offset)
+                else:
+                    fields[1] = ' '.join(_map_a1_reference(token, ids)
+                                         for token in fields[1].split(' '))
+            lines.append('\t'.join(fields))
+    return '\n'.join(lines) + '\n' if lines else ''
+
+
+def _shift_a1_spans(annotation, offset):
+    '''Shift spans of an A1 text-bound annotation (``TYPE START END``, with
+    discontinuous spans separated by ``;``) by ``offset``.'''
+
+    type_, _, spans = annotation.partition(' ')
+    shifted = []
+    for span in spans.split(';'):
+        shifted.append(' '.join(str(int(position) + offset)
+                                for position in span.split()))
+    return '%s %s' % (type_, ';'.join(shifted))
+
+
+def _map_a1_reference(token, ids):
+    '''Map annotation IDs referenced by token (``ID`` or ``ROLE:ID``).'''
+
+    role, sep, id_ = token.rpartition(':')
+    if id_ in ids:
+        return role + sep + ids[id_]
+    return token
+
+
+def _merge_conll(text, results):
+    r'''Merge CoNLL annotations of text chunks, given as a list of
+    ``(offset, conll)``, shifting character offset columns (second and
+    third, when numeric) by chunk offset.
+
+    >>> _merge_conll('', [(0, 'BRCA1\t0\t5\tB-PRGE\n'),
+    ...                   (9, 'cancer\t2\t8\tB-DISO\n')]).splitlines()
+    ['BRCA1\t0\t5\tB-PRGE', '', 'cancer\t11\t17\tB-DISO']
+
+    '''
+
+    blocks = []
+    for offset, conll in results:
+        lines = []
+        for line in conll.strip('\n').split('\n'):
+            fields = line.split('\t')
+            if len(fields) > 2 and fields[1].isdigit() and fields[2].isdigit():
+                fields[1] = str(int(fields[1]) + offset)
+                fields[2] = str(int(fields[2]) + offset)
+            lines.append('\t'.join(fields))
+        blocks.append('\n'.join(lines))
+    return '\n\n'.join(blocks) + '\n'
+
+
+# -- Local export -------------------------------------------------------------
+_TOKEN = re.compile(r'\S+', re.UNICODE)
+
+
+def _render_export(text, result, format):
+    '''Return ``format`` (one of :data:`LOCAL_EXPORT_FORMATS` but JSON)
+    export of ``text`` rendered from its annotation ``result``.'''
+
+    entities = result.get('entities', ())
+    if format == 'a1':
+        return _render_a1(entities)
+    if format == 'conll':
+        return _render_conll(text, entities)
+    raise InvalidFormat('Format ``%s`` cannot be rendered locally' % format)
+
+
+def _entity_spans(entities):
+    '''Return ``(text, start, end, concepts)`` of located ``entities`` of
+    annotation results, sorted by position.'''
+
+    spans = []
+    for entity in entities:
+        mention, start, end, ids = _parse_entity(entity)
+        concepts = _mention(mention, ids)[1]
+        if start is not None and concepts:
+            spans.append((mention, start, end, concepts))
+    spans.sort(key=lambda span: (span[1], -span[2]))
+    return spans
+
+
+def _render_a1(entities):
+    r'''Return A1 standoff annotations of ``entities``, with a text-bound
+    annotation per mention and a ``Reference`` normalization per concept.
+
+    >>> _render_a1(['cancer|UMLS:C0006826:T191:DISO|9',
+    ...             'BRCA1|UNIPROT:P38398:::PRGE;UMLS:C0376571:T028:PRGE|0',
+    ...            ]).splitlines()  # doctest: +NORMALIZE_WHITESPACE
+    ['T1\tPRGE 0 5\tBRCA1', 'N1\tReference T1 UNIPROT:P38398:::PRGE\tBRCA1',
+     'N2\tReference T1 UMLS:C0376571:T028:PRGE\tBRCA1',
+     'T2\tDISO 9 15\tcancer',
+     'N3\tReference T2 UMLS:C0006826:T191:DISO\tcancer']
+
+    '''
+
+    lines = []
+    references = 0
+    for i, (mention, start, end, concepts) in enumerate(
+            _entity_spans(entities), 1):
+        lines.append('T%d\t%s %d %d\t%s' % (i, concepts[0].group, start, end,
+                                            mention))
+        for concept in concepts:
+            references += 1
+            lines.append('N%d\tReference T%d %s\t%s' % (references, i,
+                                                        concept.id, mention))
+    return '\n'.join(lines) + '\n' if lines else ''
+
+
+def _render_conll(text, entities):
+    r'''Return CoNLL annotations of whitespace separated tokens of ``text``
+    (``TOKEN START END TAG``), tagged ``B-`` and ``I-`` semantic group of the
+    mentions in ``entities`` they begin or continue, or ``O``.
+
+    >>> _render_conll('BRCA1 causes breast cancer.',
+    ...               ['breast cancer|UMLS:C0006142:T191:DISO|13'],
+    ...               ).splitlines()  # doctest: +NORMALIZE_WHITESPACE
+    ['BRCA1\t0\t5\tO', 'causes\t6\t12\tO', 'breast\t13\t19\tB-DISO',
+     'cancer.\t20\t27\tI-DISO']
+
+    '''
+
+    mentions = {}
+    for _, start, end, concepts in _entity_spans(entities):
+        mentions.setdefault(start, (end, concepts[0].group))
+    lines = []
+    end = group = None
+    for token in _TOKEN.finditer(text):
+        start = token.start()
+        if start in mentions:
+            end, group = mentions[start]
+            tag = 'B-' + group
+        elif end is not None and start < end:
+            tag = 'I-' + group
+        else:
+            end = None
+            tag = 'O'
+        lines.append('%s\t%d\t%d\t%s\n' % (token.group(), start, token.end(),
+                                           tag))
+    return ''.join(lines)
+
+
+# -- Semantic group filtering -------------------------------------------------
+def _widen_groups(superset, groups):
+    '''Return the semantic groups to request instead of ``groups`` given
+    ``superset`` groups (see :data:`superset_groups`), and the groups to
+    filter results to, if any.
+
+    >>> groups, wanted = _widen_groups({'PRGE': True, 'DISO': True},
+    ...                                {'DISO': True})
+    >>> sorted(groups), sorted(wanted)
+    (['DISO', 'PRGE'], ['DISO'])
+    >>> _widen_groups({'PRGE': True, 'DISO': True}, {'ANAT': True})
+    ({'ANAT': True}, None)
+
+    '''
+
+    if superset is None:
+        return groups, None
+    if groups:
+        _validate_groups(groups)
+    if superset is True:
+        superset = dict((group, True) for group in SEMANTIC_GROUPS)
+    wanted, offered = _enabled_groups(groups), _enabled_groups(superset)
+    if not wanted <= offered:
+        return groups, None
+    return superset, wanted if wanted != offered else None
+
+
+def _enabled_groups(groups):
+    '''Return :class:`frozenset` of semantic groups enabled in ``groups``,
+    all of them if ``None``.'''
+
+    if not groups:
+        return frozenset(SEMANTIC_GROUPS)
+    return frozenset(group for group, value in groups.items() if value)
+
+
+def _concept_group(id):
+    '''Return semantic group of concept ID ``id``.'''
 
-    return res
+    return id.rpartition(':')[2]
 
-_do_request._previous = 0  # time of last request
+
+def _filter_groups(result, groups):
+    '''Return annotation ``result`` keeping only concepts of semantic
+    ``groups``, and mentions with any left, down to nested results.
+
+    >>> result = _filter_groups({'entities': [
+    ...     'BRCA1|UNIPROT:P38398:::PRGE;UMLS:C0006826:T191:DISO|0',
+    ...     'cancer|UMLS:C0006826:T191:DISO|9',
+    ...     'human|NCBI:9606:::SPEC|16'],
+    ...     'ids': {'UNIPROT:P38398:::PRGE': {}, 'UMLS:C0006826:T191:DISO': {},
+    ...             'NCBI:9606:::SPEC': {}}}, {'DISO'})
+    >>> result['entities']
+    ['BRCA1|UMLS:C0006826:T191:DISO|0', 'cancer|UMLS:C0006826:T191:DISO|9']
+    >>> list(result['ids'])
+    ['UMLS:C0006826:T191:DISO']
+
+    '''
+
+    if groups is None or not isinstance(result, dict):
+        return result
+    filtered = {}
+    for key, value in result.items():
+        if key == 'entities' and isinstance(value, list):
+            value = [entity for entity in
+                     (_filter_entity(entity, groups) for entity in value)
+                     if entity is not None]
+        elif key == 'ids' and isinstance(value, dict):
+            value = dict((id, concept) for id, concept in value.items()
+                         if _concept_group(id) in groups)
+        elif isinstance(value, dict):
+            value = _filter_groups(value, groups)
+        elif isinstance(value, list):
+            value = [_filter_groups(item, groups) for item in value]
+        filtered[key] = value
+    return filtered
+
+
+def _filter_entity(entity, groups):
+    '''Return ``entity`` of annotation results keeping only concepts of
+    semantic ``groups``, or ``None`` if none are left.'''
+
+    if isinstance(entity, dict):
+        ids = entity.get('ids') or ()
+        split = isinstance(ids, _string_types)
+        kept = [id for id in (ids.split(';') if split else ids)
+                if _concept_group(id) in groups]
+        if not kept:
+            return None
+        entity = dict(entity)
+        entity['ids'] = ';'.join(kept) if split else kept
+        return entity
+    head, _, start = entity.rpartition('|')
+    text, _, ids = head.rpartition('|')
+    ids = ids.split(';')
+    kept = [id for id in ids if _concept_group(id) in groups]
+    if not kept:
+        return None
+    if len(kept) == len(ids):
+        return entity
+    return '%s|%s|%s' % (text, ';'.join(kept), start)
+
+
+def _filter_export(content, format, groups):
+    '''Return export ``content`` in ``format`` (one of
+    :data:`FILTERED_FORMATS`) keeping only annotations of semantic
+    ``groups``, if given.'''
+
+    if groups is None:
+        return content
+    if format == 'json':
+        result = _filter_groups(_decode_json(content.encode('utf-8')),
+                                groups)
+        return _json_codec().dumps(result).decode('utf-8')
+    if format == 'a1':
+        return _filter_a1(content, groups)
+    raise InvalidFormat('Format ``%s`` cannot be filtered locally' % format)
+
+
+def _filter_a1(a1, groups):
+    r'''Return A1 standoff annotations keeping only text-bound annotations
+    of semantic ``groups`` or referring to concepts of those groups, typed
+    as one of them, and the annotations referring to them with concepts of
+    those groups, renumbered.
+
+    >>> _filter_a1('T1\tPRGE 0 5\tBRCA1\n'
+    ...            'N1\tReference T1 UNIPROT:P38398:::PRGE\tBRCA1\n'
+    ...            'T2\tDISO 9 15\tcancer\n'
+    ...            'N2\tReference T2 UMLS:C0006826:T191:DISO\tcancer\n',
+    ...            {'DISO'}).splitlines()  # doctest: +NORMALIZE_WHITESPACE
+    ['T1\tDISO 9 15\tcancer',
+     'N1\tReference T1 UMLS:C0006826:T191:DISO\tcancer']
+    >>> _filter_a1('T1\tPRGE 0 5\tBRCA1\n'
+    ...            'N1\tReference T1 UNIPROT:P38398:::PRGE\tBRCA1\n'
+    ...            'N2\tReference T1 UMLS:C0006826:T191:DISO\tBRCA1\n',
+    ...            {'DISO'}).splitlines()  # doctest: +NORMALIZE_WHITESPACE
+    ['T1\tDISO 0 5\tBRCA1',
+     'N1\tReference T1 UMLS:C0006826:T191:DISO\tBRCA1']
+
+    '''
+
+    annotations = [line.split('\t') for line in a1.splitlines()]
+    referred = {}  # text-bound annotation ID: groups of concepts kept
+    for fields in annotations:
+        tokens = fields[1].split(' ') if len(fields) > 1 else ()
+        if fields[0].startswith('N') and len(tokens) > 2 and \
+                _concept_group(tokens[-1]) in groups:
+            referred.setdefault(tokens[1], []).append(
+                _concept_group(tokens[-1]))
+    dropped = set()
+    lines = []
+    for fields in annotations:
+        if len(fields) < 2:
+            continue
+        tokens = fields[1].split(' ')
+        if fields[0].startswith('T'):
+            if tokens[0] not in groups:
+                if fields[0] not in referred:
+                    dropped.add(fields[0])
+                    continue
+                tokens[0] = referred[fields[0]][0]
+                fields[1] = ' '.join(tokens)
+        elif any(token.rpartition(':')[2] in dropped for token in tokens):
+            continue
+        elif fields[0].startswith('N') and \
+                _concept_group(tokens[-1]) not in groups:
+            continue
+        lines.append('\t'.join(fields))
+    return _merge_a1('', [(0, '\n'.join(lines))])
 
 
 # -- Command line interface ---------------------------------------------------
 def _argparser():
-    '''Return ArgumentParser to parse command-line options.'''
+    '''Return ArgumentParser to parse command-line options, built once.'''
+
+    if _argparser.parser is None:
+        _argparser.parser = _build_argparser()
+    return _argparser.parser
+
+
+_argparser.parser = None
+
+
+def _build_argparser():
+    '''Build ArgumentParser to parse command-line options.'''
 
     import argparse
     description = 'Annotate text or PubMed publications using the becas API.'
@@ -439,9 +3489,33 @@ def _argparser():
                                 help='plain text to annotate')
         text_input.add_argument('-i', '--stdin', action='store_true',
                                 dest='stdin', help='read text from STDIN')
+        text_input.add_argument('-c', '--corpus', dest='corpus',
+                                metavar='PATH',
+                                help=('directory or glob pattern of text '
+                                      'files to annotate'))
+        corpus_group = text_parser.add_argument_group('corpus processing')
+        corpus_group.add_argument('-d', '--output-dir', dest='output_dir',
+                                  metavar='DIR',
+                                  help=('directory to save annotation '
+                                        'results of a corpus or in several '
+                                        'formats to, mirroring the corpus '
+                                        'tree'))
+        _add_workers_option(corpus_group)
+        if text_parser is text_annotate_parser:
+            corpus_group.add_argument(
+                '--dedupe', action='store_true', dest='dedupe',
+                help=('annotate each distinct sentence of the corpus once, '
+                      'for corpora repeating boilerplate sentences'))
     output_group = text_export_parser.add_argument_group('output selection')
     output_group.add_argument('--format', required=True, dest='format',
-                              choices=EXPORT_FORMATS, help='output format')
+                              type=_cli_formats, metavar='FORMAT[,FORMAT]',
+                              help=('output format, or comma separated '
+                                    'formats to save to --output-dir (%s)'
+                                    % ', '.join(EXPORT_FORMATS)))
+    output_group.add_argument('--render-locally', action='store_true',
+                              help=('annotate once and render several '
+                                    'formats from the JSON export, in '
+                                    'formats differing from the service'))
     #  Publication methods
     publication_annotate_parser = subparsers.add_parser(
         'annotate-publication',
@@ -462,9 +3536,42 @@ def _argparser():
         input_group.add_argument('-p', '--pmid', type=int, required=True,
                                  dest='pmid', metavar='PMID',
                                  help='PMID of publication to annotate')
+    #  Bulk methods
+    publications_annotate_parser = subparsers.add_parser(
+        'annotate-publications',
+        help='annotate a list of PubMed publications as JSON Lines',
+        description=('Annotate a list of PubMed publications with biomedical '
+                     'concepts using the becas API, writing one JSON object '
+                     'per line. Completed PMIDs are checkpointed, so an '
+                     'interrupted run resumes where it stopped.'))
+    publications_annotate_parser.set_defaults(
+        func=_cli_annotate_publications)
+    _add_auth_options(publications_annotate_parser)
+    input_group = publications_annotate_parser.add_argument_group(
+        'input selection')
+    input_group.add_argument('--pmid-file', type=argparse.FileType('rt'),
+                             required=True, dest='pmid_file', metavar='FILE',
+                             help='file listing one PMID per line')
+    bulk_group = publications_annotate_parser.add_argument_group(
+        'bulk processing')
+    bulk_group.add_argument('--checkpoint', dest='checkpoint', metavar='FILE',
+                            help=('file recording completed PMIDs (default: '
+                                  'PMID file name with a .done suffix)'))
+    _add_workers_option(bulk_group)
+    bulk_group.add_argument('--rate', type=float, dest='rate',
+                            help=('maximum requests per second (default: '
+                                  'becas API usage limit)'))
+    bulk_group.add_argument('--adaptive', action='store_true',
+                            dest='adaptive',
+                            help=('adapt concurrent requests to service load, '
+                                  'up to --workers'))
+    bulk_group.add_argument('--gzip', action='store_true', dest='gzip',
+                            help=('gzip compress output (default for output '
+                                  'files ending in .gz)'))
     for parser in (text_annotate_parser, text_export_parser,
                    publication_annotate_parser, publication_export_parser):
         _add_common_options(parser)
+    _add_common_options(publications_annotate_parser, output_file_type=str)
     return ap
 
 
@@ -479,16 +3586,27 @@ def _add_auth_options(parser):
                                   '(default: %s)' % tool))
 
 
-def _add_common_options(parser):
+def _add_workers_option(parser):
+    '''Add concurrency option to a ArgumentParser.'''
+
+    parser.add_argument('--workers', type=int, dest='workers',
+                        default=workers,
+                        help=('number of concurrent requests '
+                              '(default: %d)' % workers))
+
+
+def _add_common_options(parser, output_file_type=None):
     '''Add common API options to a ArgumentParser.'''
 
     import argparse
+    if output_file_type is None:
+        output_file_type = argparse.FileType('wt')
     parser.add_argument('-g', '--groups', dest='groups',
                         help=('semantic groups to use for annotation as a '
                               'comma separated list (e.g. PRGE,DISO,ANAT). '
                               'Available groups: (%s)'
                               % ', '.join(SEMANTIC_GROUPS)))
-    parser.add_argument('-o', '--output-file', type=argparse.FileType('wt'),
+    parser.add_argument('-o', '--output-file', type=output_file_type,
                         dest='output_file', metavar='FILE',
                         help='file to save annotation results to')
     parser.add_argument('--secure', action='store_true', dest='secure',
@@ -497,16 +3615,32 @@ def _add_common_options(parser):
     parser.add_argument('--timeout', type=int, dest='timeout',
                         default=timeout,
                         help='seconds to wait before timing out a request')
+    parser.add_argument('--base-url', action='append', dest='base_url',
+                        metavar='URL',
+                        help=('base URL of the becas API (e.g. '
+                              'http://localhost:8080/becas/api/), can be '
+                              'repeated to balance requests over instances'))
+    parser.add_argument('--balance', choices=Balancer.STRATEGIES,
+                        dest='balance', default='round_robin',
+                        help=('how to balance requests over instances '
+                              '(default: round_robin)'))
+    parser.add_argument('--stats', action='store_true', dest='stats',
+                        help=('print timing and transfer statistics to '
+                              'STDERR when done'))
+    parser.add_argument('--profile', dest='profile', metavar='FILE',
+                        help='save a cProfile dump of the run to FILE')
 
 
 def _setup_common_cli_args(args):
     '''Validate and set common command-line arguments.'''
 
-    global email, tool, timeout, secure
+    global email, tool, timeout, secure, base_url
     email = args.email
     tool = args.tool
     timeout = args.timeout
     secure = args.secure
+    if args.base_url:
+        base_url = Balancer(args.base_url, strategy=args.balance)
     groups = None
     if args.groups:
         groups = {}
@@ -547,6 +3681,16 @@ def _get_cli_text(args):
 def _handle_annotation_results(results, output_file):
     '''Print annotation results to STDOUT or to a file.'''
 
+    started = _clock()
+    try:
+        _write_annotation_results(results, output_file)
+    finally:
+        _record_output(started)
+
+
+def _write_annotation_results(results, output_file):
+    '''Write annotation results to STDOUT or to a file.'''
+
     results = json.dumps(results) if isinstance(results, dict) else results
     if output_file:
         try:
@@ -564,6 +3708,23 @@ def _cli_annotate_text(args):
     '''Annotate text from the command-line.'''
 
     groups = _setup_common_cli_args(args)
+    if args.corpus:
+        client = _cli_corpus_client(args)
+        if not args.dedupe:
+            return _cli_annotate_corpus(
+                args, lambda text: client.annotate_text(text, groups),
+                '.json')
+        index = SentenceIndex()
+        try:
+            return _cli_annotate_corpus(
+                args, lambda text: client._annotate_sentences(
+                    text, groups, False, index), '.json')
+        finally:
+            stats = index.stats()
+            sys.stderr.write('%d sentences, %d distinct\n'
+                             % (stats['sentences'], stats['unique']))
+    if args.dedupe:
+        _argparser().error('--dedupe requires --corpus')
     text = _get_cli_text(args)
     try:
         results = annotate_text(text, groups)
@@ -578,9 +3739,17 @@ def _cli_export_text(args):
     '''Export annotated text from the command-line.'''
 
     groups = _setup_common_cli_args(args)
+    if len(args.format) > 1:
+        return _cli_export_text_formats(args, groups)
+    format = args.format[0]
+    if args.corpus:
+        client = _cli_corpus_client(args)
+        return _cli_annotate_corpus(
+            args, lambda text: client.export_text(text, format, groups),
+            '.' + format)
     text = _get_cli_text(args)
     try:
-        results = export_text(text, args.format, groups)
+        results = export_text(text, format, groups)
     except ValueError as e:
         _argparser().error(e)
     except BecasException as e:
@@ -588,6 +3757,163 @@ def _cli_export_text(args):
     _handle_annotation_results(results, args.output_file)
 
 
+def _cli_export_text_formats(args, groups):
+    '''Export annotated text in several formats from the command-line,
+    saving a file per format to the output directory.'''
+
+    extensions = ['.' + format for format in args.format]
+
+    def export(text):
+        results = client.export_text_formats(text, args.format, groups,
+                                             args.render_locally)
+        return dict(('.' + format, results[format]) for format in results)
+
+    if args.corpus:
+        client = _cli_corpus_client(args)
+        return _cli_annotate_corpus(args, export, extensions)
+    if not args.output_dir or args.output_file:
+        _argparser().error('several --format require --output-dir')
+    client = _default_client()
+    text = _get_cli_text(args)
+    name = os.path.splitext(os.path.basename(args.file.name))[0] \
+        if args.file else 'text'
+    try:
+        results = export(text)
+    except ValueError as e:
+        _argparser().error(e)
+    except BecasException as e:
+        _abort(e)
+    for extension in extensions:
+        _write_file(os.path.join(args.output_dir, name + extension),
+                    results[extension])
+
+
+def _cli_formats(formats):
+    '''Return export formats of a comma separated command-line argument.'''
+
+    import argparse
+    try:
+        return _validate_formats(formats)
+    except InvalidFormat:
+        raise argparse.ArgumentTypeError(
+            'invalid choice: %r (choose from %s)'
+            % (formats, ', '.join(EXPORT_FORMATS)))
+
+
+def _cli_corpus_client(args):
+    '''Return client to annotate a corpus from the command-line.'''
+
+    if not args.output_dir:
+        _argparser().error('--corpus requires --output-dir')
+    if args.workers < 1:
+        _argparser().error('--workers must be at least 1')
+    return BecasClient(pool_maxsize=args.workers, retry=RetryPolicy())
+
+
+def _cli_annotate_corpus(args, annotate, extension):
+    '''Annotate every file of a corpus concurrently, saving results with
+    ``extension`` to a mirrored tree in the output directory. Given a list of
+    extensions, ``annotate`` returns a :class:`dict` of results by extension.
+
+    Files are read, annotated and written by the same worker threads, so disk
+    I/O overlaps with requests in flight. Files whose results are newer than
+    them are skipped.
+    '''
+
+    base, paths = _corpus_files(args.corpus)
+    several = isinstance(extension, list)
+    extensions = extension if several else [extension]
+
+    def process(path):
+        relpath = os.path.splitext(os.path.relpath(path, base))[0]
+        output_paths = [os.path.join(args.output_dir, relpath + ext)
+                        for ext in extensions]
+        if all(_is_up_to_date(output_path, path)
+               for output_path in output_paths):
+            return None
+        with io.open(path, 'rt', encoding='utf-8') as infile:
+            text = infile.read()
+        results = annotate(text)
+        if not several:
+            results = {extension: results}
+        for ext, output_path in zip(extensions, output_paths):
+            result = results[ext]
+            if isinstance(result, dict):
+                result = json.dumps(result)
+            _write_file(output_path, result)
+        return output_paths[0]
+
+    annotated = skipped = failed = 0
+    for result in _batch(process, paths, args.workers, ordered=False,
+                         errors=(BecasException, ValueError,
+                                 EnvironmentError)):
+        if result.error is not None:
+            failed += 1
+            sys.stderr.write('%s: %s: %s\n' % (
+                result.item, type(result.error).__name__, result.error))
+        elif result.result is None:
+            skipped += 1
+        else:
+            annotated += 1
+    sys.stderr.write('%d files annotated, %d up to date, %d failed\n'
+                     % (annotated, skipped, failed))
+    if failed:
+        sys.exit(1)
+
+
+def _corpus_files(corpus):
+    '''Return base directory and iterator of text files of a corpus, given
+    as a directory or glob pattern.'''
+
+    if os.path.isdir(corpus):
+        def walk():
+            for dirpath, dirnames, filenames in os.walk(corpus):
+                dirnames.sort()
+                for filename in sorted(filenames):
+                    yield os.path.join(dirpath, filename)
+        return corpus, walk()
+
+    import glob
+    base = []
+    for part in corpus.split(os.sep):
+        if any(char in part for char in '*?['):
+            break
+        base.append(part)
+    base = os.sep.join(base) or os.curdir
+    return base, (path for path in sorted(glob.glob(corpus))
+                  if os.path.isfile(path))
+
+
+def _is_up_to_date(output_path, input_path):
+    '''Return whether ``output_path`` exists and is newer than
+    ``input_path``.'''
+
+    try:
+        return os.path.getmtime(output_path) >= os.path.getmtime(input_path)
+    except OSError:
+        return False
+
+
+def _write_file(path, text):
+    '''Write ``text`` to ``path`` atomically, creating parent directories.'''
+
+    started = _clock()
+    directory = os.path.dirname(path)
+    if directory and not os.path.isdir(directory):
+        try:
+            os.makedirs(directory)
+        except OSError:
+            if not os.path.isdir(directory):  # not created by another thread
+                raise
+    temp_path = '%s.%d.tmp' % (path, threading.current_thread().ident)
+    with io.open(temp_path, 'wt', encoding='utf-8') as outfile:
+        outfile.write(text)
+    if os.path.exists(path) and sys.platform == 'win32':
+        os.remove(path)  # rename doesn't overwrite on Windows
+    os.rename(temp_path, path)
+    _record_output(started)
+
+
 def _cli_annotate_publication(args):
     '''Annotate PubMed publication from the command-line.'''
 
@@ -614,11 +3940,178 @@ def _cli_export_publication(args):
     _handle_annotation_results(results, args.output_file)
 
 
+def _cli_annotate_publications(args):
+    '''Annotate a list of PubMed publications from the command-line.'''
+
+    groups = _setup_common_cli_args(args)
+    if args.workers < 1:
+        _argparser().error('--workers must be at least 1')
+    checkpoint = args.checkpoint or args.pmid_file.name + '.done'
+    done = _read_checkpoint(checkpoint)
+    pmids = (pmid for pmid in _read_cli_pmids(args.pmid_file)
+             if pmid not in done)
+    rate_limiter = RateLimiter(args.rate, burst=args.workers) \
+        if args.rate else None
+    client = BecasClient(
+        pool_maxsize=args.workers, retry=RetryPolicy(),
+        rate_limiter=rate_limiter,
+        concurrency=AdaptiveConcurrency(
+            initial=min(4, args.workers), maximum=args.workers,
+            rate_limiter=rate_limiter) if args.adaptive else None)
+    output = args.output_file or getattr(sys.stdout, 'buffer', sys.stdout)
+    failed = 0
+    completed = []  # PMIDs to checkpoint once their results are flushed
+    with open(checkpoint, 'at') as checkpoint_file:
+        try:
+            with JSONLinesWriter(output, id_key='pmid', append=True,
+                                 compress=args.gzip or None) as writer:
+                for result in client.annotate_publications(
+                        pmids, groups, workers=args.workers, ordered=False):
+                    flushed = False
+                    if isinstance(result.error, PublicationNotFound):
+                        sys.stderr.write('PMID %d: %s\n'
+                                         % (result.item, result.error))
+                    elif result.error is not None:
+                        failed += 1
+                        sys.stderr.write('PMID %d: %s: %s\n' % (
+                            result.item, type(result.error).__name__,
+                            result.error))
+                        continue
+                    else:
+                        started = _clock()
+                        flushed = writer.write(result.item, result.result)
+                        _record_output(started)
+                    completed.append(result.item)
+                    if flushed:
+                        _write_checkpoint(checkpoint_file, completed)
+        finally:
+            # the writer flushed all lines on exit, even if interrupted
+            _write_checkpoint(checkpoint_file, completed)
+    if failed:
+        _abort('%d publications failed. Run again to retry them.' % failed)
+
+
+def _read_cli_pmids(pmid_file):
+    '''Yield PMIDs listed one per line in ``pmid_file``.'''
+
+    for number, line in enumerate(pmid_file, 1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            pmid = int(line)
+            _validate_pmid(pmid)
+        except ValueError:
+            _argparser().error('Invalid PMID ``%s`` in line %d of `%s`'
+                               % (line, number, pmid_file.name))
+        yield pmid
+
+
+def _write_checkpoint(checkpoint_file, pmids):
+    '''Record completed ``pmids`` in checkpoint file and empty the list.'''
+
+    checkpoint_file.writelines('%d\n' % pmid for pmid in pmids)
+    checkpoint_file.flush()
+    del pmids[:]
+
+
+def _read_checkpoint(path):
+    '''Return set of PMIDs recorded as completed in checkpoint file.'''
+
+    try:
+        with open(path, 'rt') as checkpoint_file:
+            return set(int(line) for line in checkpoint_file
+                       if line.strip().isdigit())
+    except IOError:
+        return set()
+
+
+def _record_output(started):
+    '''Record seconds spent writing results since ``started``, for
+    ``--stats``.'''
+
+    if metrics is not None:
+        metrics.incr('output_seconds', _clock() - started)
+
+
+class _CLIStats(object):
+    '''Statistics of a command-line run, collected for ``--stats``.'''
+
+    def __init__(self):
+        self.started = _clock()
+        self.metrics = Metrics()
+        self.latencies = []
+
+    def after_request(self, info):
+        self.latencies.append(info.timings.get('total', 0))
+
+    def report(self, output):
+        '''Write statistics summary to ``output``.'''
+
+        snapshot = self.metrics.snapshot()
+        endpoints = snapshot['endpoints'].values()
+        errors = collections.Counter()
+        for endpoint in endpoints:
+            errors.update(endpoint['errors'])
+        latencies = sorted(self.latencies)
+        lines = [
+            ('wall time', '%.3f s' % (_clock() - self.started)),
+            ('requests', '%d (%d errors%s)' % (
+                len(latencies), sum(errors.values()),
+                ''.join(', %s: %d' % error
+                        for error in sorted(errors.items())))),
+            ('throttled', '%d requests, %.3f s' % (
+                snapshot.get('throttled', 0),
+                snapshot.get('throttle_seconds', 0))),
+        ]
+        if latencies:
+            lines.append(('latency', ', '.join(
+                '%s %.1f ms' % (name, 1000 * latencies[min(
+                    len(latencies) - 1, int(len(latencies) * fraction))])
+                for name, fraction in (('p50', 0.5), ('p90', 0.9),
+                                       ('p99', 0.99), ('max', 1)))))
+        lines.extend([
+            ('bytes sent', '%d (%d uncompressed)' % (
+                snapshot.get('bytes_sent', 0),
+                snapshot.get('bytes_sent_uncompressed', 0))),
+            ('bytes received', '%d (%d uncompressed)' % (
+                snapshot.get('bytes_received', 0),
+                snapshot.get('bytes_received_uncompressed', 0))),
+            ('JSON parse time', '%.3f s' % sum(
+                endpoint['decode']['sum'] for endpoint in endpoints)),
+            ('output time', '%.3f s' % snapshot.get('output_seconds', 0)),
+        ])
+        output.write(''.join('%-16s %s\n' % line for line in lines))
+
+
 def main():
     '''Command-line interface entry point.'''
 
+    global hooks, metrics, _profilers
     args = _argparser().parse_args()
-    args.func(args)
+    stats = profiler = None
+    if args.stats:
+        stats = _CLIStats()
+        metrics = stats.metrics
+        hooks = {'after_request': stats.after_request}
+    if args.profile:
+        import cProfile
+        profiler = cProfile.Profile()
+        _profilers = []
+        profiler.enable()
+    try:
+        args.func(args)
+    finally:
+        if profiler is not None:
+            import pstats
+            profiler.disable()
+            profile = pstats.Stats(profiler)
+            for worker_profiler in _profilers:
+                profile.add(worker_profiler)
+            profile.dump_stats(args.profile)
+            _profilers = None
+        if stats is not None:
+            stats.report(sys.stderr)
 
 
 def _abort(msg, ret=1):
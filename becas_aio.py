@@ -0,0 +1,433 @@
+# -*- coding: utf-8 -*-
+'''
+becas_aio - asyncio client for the becas API
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+Coroutine versions of the :mod:`becas` API methods, for use from asyncio
+applications. Requires Python 3.5+ and `aiohttp`_::
+
+    $ pip install aiohttp
+
+Arguments are validated and errors are reported exactly as in :mod:`becas`,
+and requests share the same :class:`becas.RateLimiter`, so mixing both
+clients in one process stays within the becas API usage limits. Throttle
+waits are non-blocking and requests can be cancelled at any time.
+
+.. _aiohttp: http://aiohttp.readthedocs.io/
+
+'''
+
+__all__ = ('AsyncBecasClient',)
+
+
+import asyncio
+
+import aiohttp
+
+import becas
+
+
+class AsyncBecasClient(object):
+    '''asyncio becas API client holding a persistent HTTP session.
+
+    :param email: *optional* becas API authentication ``email`` parameter.
+    :param tool: *optional* becas API authentication ``tool`` parameter.
+    :param timeout: *optional* seconds to wait before timing out a request.
+    :param secure: *optional* whether to use HTTPS or plain HTTP.
+    :param pool_maxsize: *optional* maximum number of simultaneous
+                         connections to each instance of the becas API.
+    :param keep_alive: *optional* flag to keep connections open between
+                       requests (default: ``True``).
+    :param rate_limiter: *optional* :class:`becas.RateLimiter` for requests of
+                         this client.
+    :param retry: *optional* :class:`becas.RetryPolicy` for transient errors.
+    :param concurrency: *optional* :class:`becas.AdaptiveConcurrency`
+                        limiting requests in flight of this client.
+    :param coalesce: *optional* flag to share the response of a request with
+                     identical requests made while it is in flight, instead
+                     of repeating it (default: ``True``).
+    :param compress_requests: *optional* encoding (``'gzip'`` or
+                              ``'deflate'``) to compress large request
+                              bodies with.
+    :param metrics: *optional* :class:`becas.Metrics` to record client
+                    activity in.
+    :param typed: *optional* flag to return annotation results as compact
+                  :class:`becas.AnnotationResult` objects (default:
+                  ``False``).
+    :param hooks: *optional* :class:`dict` mapping events of
+                  :data:`becas.HOOKS` to a callable or list of callables,
+                  called with a :class:`becas.RequestInfo`.
+    :param base_url: *optional* base URL of the becas API, list of base URLs
+                     of instances to balance requests over, or
+                     :class:`becas.Balancer`.
+    :param superset_groups: *optional* semantic groups to annotate with
+                            whenever they include those asked for, filtering
+                            results locally (``True`` for all
+                            :data:`becas.SEMANTIC_GROUPS`).
+
+    Parameters left as ``None`` fall back to the :mod:`becas` module-level
+    configuration parameters, read at request time.
+
+    Usage::
+
+      import becas_aio
+
+      async def main():
+          async with becas_aio.AsyncBecasClient(email='you@example.com') as c:
+              results = await c.annotate_text('BRCA1 is a caretaker gene.')
+
+    '''
+
+    def __init__(self, email=None, tool=None, timeout=None, secure=None,
+                 pool_maxsize=None, keep_alive=True, rate_limiter=None,
+                 retry=None, coalesce=True, compress_requests=None,
+                 metrics=None, typed=False, hooks=None, concurrency=None,
+                 base_url=None, superset_groups=None):
+        self.email = email
+        self.tool = tool
+        self.timeout = timeout
+        self.secure = secure
+        self.rate_limiter = rate_limiter
+        self.retry = retry
+        self.concurrency = concurrency
+        self.base_url = base_url
+        self.superset_groups = superset_groups
+        self.pool_maxsize = pool_maxsize
+        self.keep_alive = keep_alive
+        self.coalesce = coalesce
+        if compress_requests not in (None,) + becas._REQUEST_ENCODINGS:
+            raise ValueError('Unknown request encoding ``%s``'
+                             % compress_requests)
+        self.compress_requests = compress_requests
+        self.metrics = metrics if metrics is not None else becas.Metrics()
+        self.typed = typed
+        becas._validate_hooks(hooks)
+        self.hooks = hooks
+        #: Number of requests answered by a request already in flight
+        self.coalesced = 0
+        self._in_flight = {}
+        self._session = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def close(self):
+        '''Close all pooled connections.'''
+
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    async def annotate_text(self, text, groups=None, echo=False):
+        '''Annotate text with biomedical concepts.
+
+        See :func:`becas.annotate_text`.
+        '''
+
+        groups, wanted = self._widen_groups(groups)
+        payload = becas._annotate_text_payload(text, groups, echo)
+        content = await self._request('annotate_text', payload)
+
+        return self._annotation_result('annotate_text', content, wanted)
+
+    async def export_text(self, text, format, groups=None):
+        '''Export text annotated with biomedical concepts in JSON, XML, A1 or
+        CONLL.
+
+        See :func:`becas.export_text`.
+        '''
+
+        payload = becas._export_text_payload(text, format, groups)
+        wanted = None
+        if format in becas.FILTERED_FORMATS:
+            groups, wanted = self._widen_groups(groups)
+            payload = becas._export_text_payload(text, format, groups)
+        content = await self._request('export_text', payload)
+
+        return becas._filter_export(content.decode('utf-8'), format, wanted)
+
+    async def export_text_formats(self, text, formats, groups=None,
+                                  render_locally=False):
+        '''Export text annotated with biomedical concepts in several formats.
+
+        See :func:`becas.export_text_formats`.
+        '''
+
+        formats = becas._validate_formats(formats)
+        results = {}
+        if render_locally and set(formats) & set(becas.LOCAL_EXPORT_FORMATS):
+            results['json'] = await self.export_text(text, 'json', groups)
+            result = self._decode_json('export_text', results['json'])
+            for format in formats:
+                if format not in results and \
+                        format in becas.LOCAL_EXPORT_FORMATS:
+                    results[format] = becas._render_export(text, result,
+                                                           format)
+        for format in formats:
+            if format not in results:
+                results[format] = await self.export_text(text, format, groups)
+        return dict((format, results[format]) for format in formats)
+
+    async def annotate_publication(self, pmid, groups=None):
+        '''Annotate PubMed publication with biomedical concepts.
+
+        See :func:`becas.annotate_publication`.
+        '''
+
+        groups, wanted = self._widen_groups(groups)
+        payload = becas._publication_payload(pmid, groups)
+        content = await self._request('annotate_publication', payload, pmid)
+
+        return self._annotation_result('annotate_publication', content,
+                                       wanted)
+
+    async def export_publication(self, pmid, groups=None):
+        '''Export PubMed publication as MEDLINE IeXML annotated with
+        biomedical concepts.
+
+        See :func:`becas.export_publication`.
+        '''
+
+        payload = becas._publication_payload(pmid, groups)
+        content = await self._request('export_publication', payload, pmid)
+
+        return content.decode('utf-8')
+
+    async def _request(self, endpoint, payload, pmid=None):
+        '''Return the response body of a request to one of the becas API
+        endpoints, sharing the response of an identical request in flight.'''
+
+        self._validate_authentication()
+        if not self.coalesce:
+            return await self._do_request(endpoint, payload, pmid)
+
+        key = becas._cache_key(endpoint, payload, pmid)
+        call = self._in_flight.get(key)
+        if call is None:
+            # the shared task and the number of callers awaiting it
+            call = self._in_flight[key] = [asyncio.ensure_future(
+                self._do_request(endpoint, payload, pmid)), 0]
+            call[0].add_done_callback(lambda _: self._forget(key, call))
+        else:
+            self.coalesced += 1
+        call[1] += 1
+        try:
+            # shielded, so cancelling one caller doesn't cancel the others
+            return await asyncio.shield(call[0])
+        except asyncio.CancelledError:
+            if call[1] == 1:
+                # the last caller gave up, so nobody awaits the request
+                self._forget(key, call)
+                call[0].cancel()
+            raise
+        finally:
+            call[1] -= 1
+
+    def _forget(self, key, call):
+        '''Stop answering requests for ``key`` by ``call``.'''
+
+        if self._in_flight.get(key) is call:
+            del self._in_flight[key]
+
+    def _decode_json(self, endpoint, content):
+        '''Decode JSON result of API method ``endpoint``, timing it.'''
+
+        started = becas._clock()
+        result = becas._decode_json(content)
+        self.metrics.record_decode(endpoint, becas._clock() - started)
+        return result
+
+    def _annotation_result(self, endpoint, content, groups=None):
+        '''Return annotation result of API method ``endpoint`` in response
+        body ``content``, filtered to semantic ``groups`` if given.'''
+
+        if groups is None:
+            return becas.AnnotationResult(content) if self.typed else \
+                self._decode_json(endpoint, content)
+        result = becas._filter_groups(self._decode_json(endpoint, content),
+                                      groups)
+        return becas.AnnotationResult(result) if self.typed else result
+
+    def _widen_groups(self, groups):
+        '''Return the semantic groups to request instead of ``groups``, and
+        the groups to filter results to, if any.'''
+
+        return becas._widen_groups(self._option('superset_groups'), groups)
+
+    def _option(self, name):
+        '''Return client option, falling back to module configuration.'''
+
+        value = getattr(self, name)
+        return getattr(becas, name) if value is None else value
+
+    def _validate_authentication(self):
+        '''Ensure the client has authentication parameters.'''
+
+        becas._validate_authentication(self._option('email'),
+                                       self._option('tool'))
+
+    def _endpoint_url(self, endpoint, pmid=None, instance=None):
+        '''Return service URL for given endpoint, of a balanced
+        ``instance`` if given.'''
+
+        return becas._endpoint_url(endpoint, pmid,
+                                   secure=self._option('secure'),
+                                   email=self._option('email'),
+                                   tool=self._option('tool'),
+                                   base_url=instance.url if instance else None)
+
+    def _rate_limiter(self):
+        '''Return the rate limiter throttling requests of this client.'''
+
+        return self._option('rate_limiter') or becas._shared_rate_limiter
+
+    def _get_session(self):
+        '''Return the client session, creating it in the running loop.'''
+
+        if self._session is None:
+            connector = aiohttp.TCPConnector(
+                limit=0, limit_per_host=self._option('pool_maxsize'),
+                force_close=not self.keep_alive,
+                ssl=False)  # same as becas, skip certificate validation
+            self._session = aiohttp.ClientSession(
+                connector=connector, headers=becas._default_headers())
+        return self._session
+
+    async def _do_request(self, endpoint, payload, pmid=None):
+        '''Perform a POST request to API method ``endpoint``, failing over
+        between balanced instances and retrying transient errors, and return
+        the response body.'''
+
+        balancer = becas._balancer(self._option('base_url'))
+        concurrency = self._option('concurrency')
+        retry = self._option('retry')
+        hooks = self._option('hooks')
+        failed = set()
+        started = becas._clock()
+        attempt = 0
+        while True:
+            attempt += 1
+            token = None
+            if concurrency is not None:
+                token = await self._acquire(concurrency)
+            instance = balancer.acquire(failed) if balancer else None
+            url = self._endpoint_url(endpoint, pmid, instance)
+            rate_limiter = instance and instance.rate_limiter or \
+                self._rate_limiter()
+            info = becas.RequestInfo(endpoint, url, attempt)
+            error = None
+            try:
+                try:
+                    # in here, so cancelling or a failing hook releases
+                    # token and instance
+                    wait = rate_limiter.reserve()
+                    if wait > 0:
+                        info.timings['throttle'] = wait
+                        self.metrics.record_throttle(wait)
+                        becas._fire(hooks, 'throttle', info)
+                        await asyncio.sleep(wait)
+                    becas._fire(hooks, 'before_request', info)
+                    content = await self._send(url, payload, info)
+                except BaseException as e:
+                    error = e
+                    raise
+                finally:
+                    if concurrency is not None:
+                        concurrency.release(token,
+                                            info.timings.get('total', 0),
+                                            error)
+                    if instance is not None:
+                        balancer.release(instance, error)
+            except becas.BecasException as e:
+                info.error = e
+                self.metrics.record_request(endpoint,
+                                            info.timings.get('total', 0), e)
+                becas._fire(hooks, 'after_request', info)
+                if instance is not None and \
+                        isinstance(e, becas._FAILOVER_ERRORS):
+                    failed.add(instance)
+                    if len(failed) < len(balancer.instances):
+                        # fail over to another instance right away
+                        info.delay = 0
+                        becas._fire(hooks, 'retry', info)
+                        continue
+                    failed.clear()
+                wait = retry and retry.delay(attempt, e,
+                                             becas._clock() - started)
+                if wait is None:
+                    raise
+                info.delay = wait
+                becas._fire(hooks, 'retry', info)
+                rate_limiter.pause(wait)
+            else:
+                self.metrics.record_request(endpoint, info.timings['total'])
+                becas._fire(hooks, 'after_request', info)
+                if content is not becas._RESEND:
+                    return content
+                info.delay = 0
+                becas._fire(hooks, 'retry', info)
+
+    async def _acquire(self, concurrency):
+        '''Wait without blocking until ``concurrency`` lets a request be
+        sent, and return its token.'''
+
+        loop = asyncio.get_event_loop()
+        while True:
+            released = asyncio.Event()
+
+            def wake():
+                try:
+                    loop.call_soon_threadsafe(released.set)
+                except RuntimeError:  # the loop was closed meanwhile
+                    pass
+
+            token = concurrency.try_acquire(wake)
+            if token is not None:
+                return token
+            await released.wait()
+
+    async def _send(self, url, payload, info):
+        '''Perform a single POST request to one of the becas API endpoints,
+        recording its transfer and timings in ``info``, and return the
+        response body, or ``becas._RESEND`` if it must be sent again
+        uncompressed.'''
+
+        session = self._get_session()
+        timeout = aiohttp.ClientTimeout(total=self._option('timeout'))
+        data = becas._json_codec().dumps(payload)
+        body, headers = becas._encode_body(data, self.compress_requests)
+        started = becas._clock()
+        try:
+            try:
+                async with session.post(url, data=body, headers=headers,
+                                        timeout=timeout) as res:
+                    info.timings['response'] = becas._clock() - started
+                    content = await res.read()
+            finally:
+                info.timings['total'] = becas._clock() - started
+        except asyncio.TimeoutError as e:
+            raise becas.Timeout(e)
+        except aiohttp.ClientSSLError as e:
+            raise becas.SSLError(e)
+        except aiohttp.ClientConnectionError as e:
+            raise becas.ConnectionError(e)
+        except aiohttp.ClientError as e:
+            raise becas.BecasException(e)
+
+        info.status = res.status
+        info.bytes_sent = len(body)
+        info.bytes_received = res.content_length or len(content)
+        info.timings['download'] = (info.timings['total'] -
+                                    info.timings['response'])
+        self.metrics.record_transfer(len(body), len(data),
+                                     info.bytes_received, len(content),
+                                     info.endpoint)
+        if headers and res.status == 415:
+            # the service doesn't accept compressed requests, stop trying
+            self.compress_requests = None
+            return becas._RESEND
+        becas._check_status(res.status, res.headers, content, res.reason)
+        return content
@@ -0,0 +1,278 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''Benchmark the becas client against a local stand-in of the becas API.
+
+Measures throughput, tail latency and memory at several concurrency levels,
+rate limiter accuracy, recovery from injected errors, adaptive
+concurrency against an overloaded service, and load balancing over a fast,
+a slow and a failing instance.
+
+Usage::
+
+  $ python benchmarks/bench_client.py [--requests N] [--latency SECONDS]
+                                      [--concurrency N [N ...]] [--json FILE]
+
+Compare runs of two client versions with ``--json`` and your diff tool of
+choice.
+
+'''
+
+from __future__ import print_function
+
+import os
+import sys
+import json
+import time
+import argparse
+import threading
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+import becas  # NOQA
+from mock_server import MockServer  # NOQA
+
+try:
+    import tracemalloc
+except ImportError:  # Python 2
+    tracemalloc = None
+
+
+TEXT = ('BRCA1 is a human caretaker gene that produces a protein responsible '
+        'for DNA repair. Mutations of BRCA1 cause breast cancer. ') * 10
+
+
+def percentile(values, fraction):
+    '''Return the ``fraction`` percentile of sorted ``values``.'''
+
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def run(client, requests, concurrency):
+    '''Annotate ``requests`` texts with ``concurrency`` threads sharing
+    ``client``. Return elapsed seconds, sorted latencies and errors.'''
+
+    todo = iter(range(requests))
+    lock = threading.Lock()
+    latencies, errors = [], []
+
+    def worker():
+        while True:
+            with lock:
+                i = next(todo, None)
+            if i is None:
+                return
+            started = time.time()
+            try:
+                client.annotate_text('%d. %s' % (i, TEXT))
+            except becas.BecasException as e:
+                errors.append(e)
+            latencies.append(time.time() - started)
+
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    started = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return time.time() - started, sorted(latencies), errors
+
+
+def summary(elapsed, latencies, errors):
+    return {
+        'throughput': len(latencies) / elapsed,
+        'p50': percentile(latencies, 0.5),
+        'p95': percentile(latencies, 0.95),
+        'p99': percentile(latencies, 0.99),
+        'max': latencies[-1] if latencies else None,
+        'errors': len(errors),
+    }
+
+
+def bench_concurrency(args):
+    '''Throughput, latency and memory at each concurrency level.'''
+
+    results = []
+    with MockServer(latency=args.latency, jitter=args.latency / 2) as server:
+        for concurrency in args.concurrency:
+            client = server.client(email='you@example.com',
+                                   pool_maxsize=concurrency)
+            run(client, concurrency, concurrency)  # warm up connections
+            result = summary(*run(client, args.requests, concurrency))
+            if tracemalloc is not None:
+                tracemalloc.start()
+                run(client, args.requests, concurrency)
+                result['peak_memory'] = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+            result['concurrency'] = concurrency
+            results.append(result)
+            client.close()
+    return results
+
+
+def bench_throttle(args):
+    '''Achieved request rate under a rate limiter, at the highest
+    concurrency level.'''
+
+    rate = args.rate
+    limiter = becas.RateLimiter(rate=rate, burst=1)
+    with MockServer(latency=args.latency) as server:
+        client = server.client(email='you@example.com',
+                               rate_limiter=limiter,
+                               pool_maxsize=max(args.concurrency))
+        requests = int(rate * args.throttle_seconds)
+        elapsed, latencies, errors = run(client, requests,
+                                         max(args.concurrency))
+        client.close()
+    # the first request goes through right away, the rest at ``rate``
+    achieved = (requests - 1) / (elapsed - args.latency)
+    return {'rate': rate, 'achieved': achieved,
+            'accuracy': achieved / rate,
+            'mean_wait': limiter.stats()['waited'] / requests}
+
+
+def bench_errors(args):
+    '''Throughput and latency with injected transient errors, retried.'''
+
+    errors = {503: args.error_rate / 2, 429: args.error_rate / 2}
+    concurrency = max(args.concurrency)
+    with MockServer(latency=args.latency, errors=errors, retry_after=0,
+                    seed=0) as server:
+        client = server.client(
+            email='you@example.com', pool_maxsize=concurrency,
+            retry=becas.RetryPolicy(max_attempts=10, backoff=0.01,
+                                    max_backoff=0.1))
+        result = summary(*run(client, args.requests, concurrency))
+        client.close()
+        result['attempts'] = (float(sum(server.requests.values())) /
+                              args.requests)
+    result['error_rate'] = args.error_rate
+    return result
+
+
+def bench_adaptive(args):
+    '''Fixed and adaptive concurrency against a service of limited
+    capacity, answering 503 when overloaded.'''
+
+    results = []
+    concurrency = max(args.concurrency)
+    for adaptive in (False, True):
+        with MockServer(latency=args.latency, capacity=args.capacity,
+                        retry_after=0) as server:
+            limiter = becas.AdaptiveConcurrency(maximum=concurrency) \
+                if adaptive else None
+            client = server.client(
+                email='you@example.com', pool_maxsize=concurrency,
+                concurrency=limiter,
+                retry=becas.RetryPolicy(max_attempts=20, backoff=0.01,
+                                        max_backoff=0.5))
+            result = summary(*run(client, args.requests, concurrency))
+            client.close()
+            result['adaptive'] = adaptive
+            result['overloaded'] = server.responses.get(503, 0)
+            result['limit'] = limiter.limit if limiter else concurrency
+            results.append(result)
+    return results
+
+
+def bench_balance(args):
+    '''Each balancing strategy over a fast, a four times slower and a
+    failing instance.'''
+
+    results = []
+    concurrency = max(args.concurrency)
+    for strategy in becas.Balancer.STRATEGIES:
+        servers = [MockServer(latency=args.latency),
+                   MockServer(latency=args.latency * 4),
+                   MockServer(errors={503: 1})]
+        for server in servers:
+            server.start()
+        balancer = becas.Balancer([server.url for server in servers],
+                                  strategy=strategy)
+        client = servers[0].client(email='you@example.com',
+                                   pool_maxsize=concurrency,
+                                   base_url=balancer)
+        result = summary(*run(client, args.requests, concurrency))
+        client.close()
+        for server in servers:
+            server.stop()
+        result['strategy'] = strategy
+        result['requests'] = [stats['requests'] for stats in balancer.stats()]
+        results.append(result)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--requests', type=int, default=500,
+                        help='requests per run (default: 500)')
+    parser.add_argument('--latency', type=float, default=0.02,
+                        help='service latency in seconds (default: 0.02)')
+    parser.add_argument('--concurrency', type=int, nargs='+',
+                        default=[1, 4, 16, 64],
+                        help='concurrency levels (default: 1 4 16 64)')
+    parser.add_argument('--rate', type=float, default=50,
+                        help='requests per second allowed by the rate '
+                        'limiter in the throttle run (default: 50)')
+    parser.add_argument('--throttle-seconds', type=float, default=3,
+                        help='duration of the throttle run (default: 3)')
+    parser.add_argument('--error-rate', type=float, default=0.1,
+                        help='fraction of requests answered with 429 or 503 '
+                        'in the errors run (default: 0.1)')
+    parser.add_argument('--capacity', type=int, default=16,
+                        help='requests the service handles at once in the '
+                        'adaptive run (default: 16)')
+    parser.add_argument('--json', metavar='FILE',
+                        help='also write results to FILE as JSON')
+    args = parser.parse_args()
+
+    results = {'concurrency': bench_concurrency(args)}
+    print('%11s %10s %9s %9s %9s %9s %7s %12s' % (
+        'concurrency', 'req/s', 'p50 (ms)', 'p95 (ms)', 'p99 (ms)',
+        'max (ms)', 'errors', 'memory (KiB)'))
+    for result in results['concurrency']:
+        print('%11d %10.1f %9.1f %9.1f %9.1f %9.1f %7d %12s' % (
+            result['concurrency'], result['throughput'],
+            result['p50'] * 1000, result['p95'] * 1000,
+            result['p99'] * 1000, result['max'] * 1000, result['errors'],
+            '%d' % (result['peak_memory'] // 1024)
+            if 'peak_memory' in result else '-'))
+
+    results['throttle'] = throttle = bench_throttle(args)
+    print('\nthrottle: %.1f req/s allowed, %.1f req/s achieved (%.1f%%), '
+          '%.1f ms mean wait' % (throttle['rate'], throttle['achieved'],
+                                 throttle['accuracy'] * 100,
+                                 throttle['mean_wait'] * 1000))
+
+    results['errors'] = errors = bench_errors(args)
+    print('errors: %d%% injected, %.2f attempts per request, %d failed, '
+          '%.1f req/s, p99 %.1f ms' % (
+              errors['error_rate'] * 100, errors['attempts'],
+              errors['errors'], errors['throughput'], errors['p99'] * 1000))
+
+    results['adaptive'] = bench_adaptive(args)
+    for result in results['adaptive']:
+        print('%s concurrency: limit %.1f, %.1f req/s, %d overloaded, '
+              'p99 %.1f ms' % (
+                  'adaptive' if result['adaptive'] else 'fixed',
+                  result['limit'], result['throughput'],
+                  result['overloaded'], result['p99'] * 1000))
+
+    results['balance'] = bench_balance(args)
+    for result in results['balance']:
+        print('%s: %.1f req/s, p99 %.1f ms, %d failed, requests to fast, '
+              'slow and failing instances %s' % (
+                  result['strategy'], result['throughput'],
+                  result['p99'] * 1000, result['errors'],
+                  '/'.join(str(n) for n in result['requests'])))
+
+    if args.json:
+        results['version'] = becas.__version__
+        with open(args.json, 'w') as output:
+            json.dump(results, output, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
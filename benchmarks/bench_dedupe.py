@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''Compare annotating a corpus with repeated boilerplate sentences as whole
+texts and with sentence deduplication, against a local stand-in of the becas
+API.
+
+Usage::
+
+  $ python benchmarks/bench_dedupe.py [--texts N] [--boilerplate FRACTION]
+                                      [--latency SECONDS] [--workers N]
+
+'''
+
+from __future__ import print_function
+
+import os
+import sys
+import time
+import random
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from mock_server import MockServer  # NOQA
+
+
+BOILERPLATE = (
+    'This note is confidential and intended for the care team only.',
+    'Patient consent was obtained before any procedure.',
+    'Family history includes breast cancer and BRCA1 mutations.',
+    'Follow-up in the oncology clinic is recommended in six months.',
+    'Results were reviewed by the attending physician.',
+)
+WORDS = ('p53', 'DNA repair', 'tumour', 'expression', 'cells', 'analysis',
+         'signalling', 'pathway', 'human', 'gene', 'protein', 'response')
+
+
+def corpus(texts, sentences, boilerplate, seed=0):
+    '''Return ``texts`` texts of ``sentences`` sentences, a ``boilerplate``
+    fraction of them repeated across texts.'''
+
+    rng = random.Random(seed)
+    corpus = []
+    for i in range(texts):
+        text = []
+        for j in range(sentences):
+            if rng.random() < boilerplate:
+                text.append(rng.choice(BOILERPLATE))
+            else:
+                text.append(' '.join(rng.choice(WORDS) for _ in range(12))
+                            .capitalize() + ' (%d.%d).' % (i, j))
+        corpus.append(' '.join(text))
+    return corpus
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--texts', type=int, default=500,
+                        help='texts to annotate (default: 500)')
+    parser.add_argument('--sentences', type=int, default=10,
+                        help='sentences per text (default: 10)')
+    parser.add_argument('--boilerplate', type=float, default=0.7,
+                        help='fraction of boilerplate sentences '
+                        '(default: 0.7)')
+    parser.add_argument('--latency', type=float, default=0.02,
+                        help='service latency in seconds (default: 0.02)')
+    parser.add_argument('--workers', type=int, default=8,
+                        help='concurrent requests (default: 8)')
+    args = parser.parse_args()
+
+    texts = corpus(args.texts, args.sentences, args.boilerplate)
+    print('%d texts of %d sentences, %d%% boilerplate' % (
+        args.texts, args.sentences, args.boilerplate * 100))
+    print('%-14s %10s %12s %10s %10s'
+          % ('', 'requests', 'bytes sent', 'seconds', 'texts/s'))
+    for dedupe in (False, True):
+        with MockServer(latency=args.latency) as server:
+            client = server.client(email='you@example.com',
+                                   pool_maxsize=args.workers)
+            started = time.time()
+            for result in client.annotate_texts(texts, workers=args.workers,
+                                                dedupe=dedupe):
+                if result.error is not None:
+                    raise result.error
+            elapsed = time.time() - started
+            client.close()
+            print('%-14s %10d %12d %10.2f %10.1f' % (
+                'dedupe' if dedupe else 'whole texts',
+                sum(server.requests.values()),
+                client.metrics.snapshot()['bytes_sent'], elapsed,
+                args.texts / elapsed))
+
+
+if __name__ == '__main__':
+    main()
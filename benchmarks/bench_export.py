@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''Compare exporting texts in several formats with a request per format and
+with a single request, against a local stand-in of the becas API.
+
+Usage::
+
+  $ python benchmarks/bench_export.py [--texts N] [--latency SECONDS]
+                                      [--rate N] [--formats FORMATS]
+
+'''
+
+from __future__ import print_function
+
+import os
+import sys
+import time
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+import becas  # NOQA
+from mock_server import MockServer  # NOQA
+
+
+TEXT = ('BRCA1 is a human caretaker gene that produces a protein responsible '
+        'for DNA repair. Mutations of BRCA1 cause breast cancer. ')
+
+
+def run(export, texts):
+    '''Return seconds to call ``export`` on each of ``texts``.'''
+
+    started = time.time()
+    for text in texts:
+        export(text)
+    return time.time() - started
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--texts', type=int, default=20,
+                        help='texts to export (default: 20)')
+    parser.add_argument('--latency', type=float, default=0.05,
+                        help='service latency in seconds (default: 0.05)')
+    parser.add_argument('--rate', type=float, default=20,
+                        help='requests per second allowed by the rate '
+                        'limiter (default: 20)')
+    parser.add_argument('--formats', default='json,a1,conll',
+                        help='comma separated export formats (default: '
+                        'json,a1,conll)')
+    args = parser.parse_args()
+
+    formats = args.formats.split(',')
+    texts = ['%d. %s' % (i, TEXT * 10) for i in range(args.texts)]
+    print('%d texts in %s, %.0f ms latency, %.0f req/s allowed' % (
+        args.texts, args.formats, args.latency * 1000, args.rate))
+    print('%-18s %10s %10s %12s' % ('', 'requests', 'seconds',
+                                    'texts/s'))
+    for name in ('one per format', 'single request'):
+        with MockServer(latency=args.latency) as server:
+            client = server.client(
+                email='you@example.com',
+                rate_limiter=becas.RateLimiter(rate=args.rate, burst=1))
+            if name == 'single request':
+                def export(text):
+                    return client.export_text_formats(text, formats,
+                                                      render_locally=True)
+            else:
+                def export(text):
+                    return dict((format, client.export_text(text, format))
+                                for format in formats)
+            elapsed = run(export, texts)
+            client.close()
+            print('%-18s %10d %10.2f %12.1f' % (
+                name, sum(server.requests.values()), elapsed,
+                args.texts / elapsed))
+
+
+if __name__ == '__main__':
+    main()
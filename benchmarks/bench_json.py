@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''Compare JSON codecs on becas-like annotation results.
+
+Usage::
+
+  $ python benchmarks/bench_json.py [--entities N] [--repeat N]
+
+'''
+
+from __future__ import print_function
+
+import os
+import sys
+import random
+import timeit
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+import becas  # NOQA
+
+
+WORDS = (u'BRCA1', u'caretaker', u'gene', u'tumour', u'suppressor', u'DNA',
+         u'repair', u'protein', u'mutation', u'breast', u'cancer', u'cell',
+         u'expression', u'αβ-crystallin', u'p53', u'kinase')
+
+
+def annotation_result(entities, seed=0):
+    '''Return an ``annotate_text`` result with ``entities`` entities.'''
+
+    rng = random.Random(seed)
+    words = [rng.choice(WORDS) for _ in range(entities * 4)]
+    text = u' '.join(words)
+    found, offset = [], 0
+    for i, word in enumerate(words):
+        if i % 4 == 0:
+            group = rng.choice(list(becas.SEMANTIC_GROUPS))
+            refs = [u'%s:%07d:%s' % (rng.choice(('UMLS', 'UNIPROT')),
+                                     rng.randrange(10 ** 7), group)
+                    for _ in range(rng.randint(1, 3))]
+            found.append(u'|'.join([word] + refs) + u'|%d' % offset)
+        offset += len(word) + 1
+    return {u'text': text, u'entities': found}
+
+
+def run(codec, document, repeat):
+    '''Return best seconds to encode and decode ``document`` with
+    ``codec``.'''
+
+    data = codec.dumps(document)
+    encode = min(timeit.repeat(lambda: codec.dumps(document),
+                               number=10, repeat=repeat)) / 10
+    decode = min(timeit.repeat(lambda: codec.loads(data),
+                               number=10, repeat=repeat)) / 10
+    return len(data), encode, decode
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--entities', type=int, nargs='+',
+                        default=[100, 1000, 10000],
+                        help='entities per result (default: 100 1000 10000)')
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='timing repetitions (default: 5)')
+    args = parser.parse_args()
+
+    codecs = []
+    for name in becas._JSON_CODECS:
+        try:
+            codecs.append(becas._load_json_codec(name))
+        except ImportError:
+            print('%s: not installed' % name)
+
+    print('%-8s %9s %10s %12s %12s' % ('codec', 'entities', 'bytes',
+                                       'encode (ms)', 'decode (ms)'))
+    for entities in args.entities:
+        document = annotation_result(entities)
+        for codec in codecs:
+            size, encode, decode = run(codec, document, args.repeat)
+            print('%-8s %9d %10d %12.3f %12.3f' % (
+                codec.name, entities, size, encode * 1000, decode * 1000))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''Time importing becas and starting the command-line tool.
+
+Usage::
+
+  $ python benchmarks/bench_startup.py [--repeat N]
+
+'''
+
+from __future__ import print_function
+
+import os
+import sys
+import time
+import argparse
+import subprocess
+
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir))
+
+#: Commands timed, by name; each runs in a fresh interpreter
+COMMANDS = (
+    ('interpreter', ['-c', 'pass']),
+    ('import becas', ['-c', 'import becas']),
+    ('becas --help', [os.path.join(ROOT, 'becas.py'), '--help']),
+    ('becas bad args', [os.path.join(ROOT, 'becas.py'), 'annotate-text',
+                        '--email', 'you@example.com', '--text', '']),
+)
+
+#: Modules that should not be loaded until a request is made
+LAZY_MODULES = ('requests', 'argparse', 'sqlite3', 'gzip', 'zlib')
+
+
+def run(args, repeat):
+    '''Return best and median seconds to run python with ``args``.'''
+
+    env = dict(os.environ, PYTHONPATH=ROOT, PYTHONDONTWRITEBYTECODE='')
+    times = []
+    with open(os.devnull, 'w') as devnull:
+        for _ in range(repeat):
+            started = time.time()
+            subprocess.call([sys.executable] + args, env=env,
+                            stdout=devnull, stderr=devnull)
+            times.append(time.time() - started)
+    times.sort()
+    return times[0], times[len(times) // 2]
+
+
+def loaded_modules():
+    '''Return the modules of :data:`LAZY_MODULES` loaded by importing
+    becas, and not already by the interpreter itself.'''
+
+    code = ('import sys; before = set(sys.modules); import becas; '
+            'print(" ".join(m for m in %r '
+            'if m in sys.modules and m not in before))' % (LAZY_MODULES,))
+    output = subprocess.check_output([sys.executable, '-c', code],
+                                     env=dict(os.environ, PYTHONPATH=ROOT))
+    return output.decode('ascii').split()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--repeat', type=int, default=20,
+                        help='runs of each command (default: 20)')
+    args = parser.parse_args()
+
+    print('%-16s %10s %12s' % ('command', 'best (ms)', 'median (ms)'))
+    for name, command in COMMANDS:
+        best, median = run(command, args.repeat)
+        print('%-16s %10.1f %12.1f' % (name, best * 1000, median * 1000))
+
+    loaded = loaded_modules()
+    print('\nloaded by import becas: %s' % (' '.join(loaded) or 'none'))
+    if loaded:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
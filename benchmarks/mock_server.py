@@ -0,0 +1,402 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''Local stand-in for the becas API, for tests and benchmarks.
+
+Serves the four becas API endpoints with deterministic annotations,
+configurable latency and injected errors, using only the standard library.
+
+Usage::
+
+  $ python benchmarks/mock_server.py --port 8080 --latency 0.05 --error 503:0.1
+
+From Python::
+
+  >>> import becas, mock_server
+  >>> with mock_server.MockServer(latency=0.01) as server:
+  ...     client = server.client(email='you@example.com')
+  ...     result = client.annotate_text('BRCA1 mutations cause breast cancer.')
+  >>> result['entities'][0]
+  'BRCA1|UNIPROT:P38398:::PRGE|0'
+
+'''
+
+from __future__ import print_function
+
+import io
+import re
+import sys
+import gzip
+import json
+import time
+import zlib
+import random
+import argparse
+import threading
+try:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from socketserver import ThreadingMixIn
+    from urllib.parse import urlsplit, parse_qs
+except ImportError:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler  # NOQA
+    from SocketServer import ThreadingMixIn  # NOQA
+    from urlparse import urlsplit, parse_qs  # NOQA
+
+import becas
+
+
+#: Concept IDs of known words; other words are annotated now and then with
+#: made up concepts, so results have realistic densities
+LEXICON = {
+    'BRCA1': 'UNIPROT:P38398:::PRGE',
+    'p53': 'UNIPROT:P04637:::PRGE',
+    'breast cancer': 'UMLS:C0006142:T191:DISO',
+    'cancer': 'UMLS:C0006826:T191:DISO',
+    'DNA repair': 'GO:0006281:::PROC',
+    'human': 'NCBI:9606:::SPEC',
+    'gene': 'UMLS:C0017337:T028:COMP',
+}
+_LEXICON = re.compile('|'.join(r'\b%s\b' % re.escape(word) for word in
+                               sorted(LEXICON, key=len, reverse=True)))
+_WORD = re.compile(r'\w{4,}', re.UNICODE)
+
+#: Path of each endpoint, relative to the server address
+PATHS = (
+    ('annotate_text', '/becas/api/text/annotate'),
+    ('export_text', '/becas/api/text/export'),
+    ('annotate_publication', '/becas/api/pubmed/annotate/'),
+    ('export_publication', '/becas/api/pubmed/export/'),
+)
+
+
+def annotate(text, groups=None):
+    '''Return ``(text, start, concept_id)`` of mentions found in ``text``,
+    restricted to enabled ``groups``.'''
+
+    mentions = {}
+    for match in _WORD.finditer(text):
+        checksum = zlib.crc32(match.group().encode('utf-8')) & 0xffffffff
+        if checksum % 7 == 0:  # made up concept
+            group = becas.SEMANTIC_GROUPS[checksum % 11]
+            mentions[match.start()] = (match.group(), match.start(),
+                                       'MOCK:%08X:::%s' % (checksum, group))
+    for match in _LEXICON.finditer(text):
+        mentions[match.start()] = (match.group(), match.start(),
+                                   LEXICON[match.group()])
+    if groups:
+        enabled = set(group for group, on in groups.items() if on)
+        mentions = dict((start, mention) for start, mention
+                        in mentions.items()
+                        if mention[2].rsplit(':', 1)[1] in enabled)
+    return [mentions[start] for start in sorted(mentions)]
+
+
+def annotation_result(text, groups=None, echo=False):
+    '''Return ``annotate_text`` result :class:`dict` for ``text``.'''
+
+    mentions = annotate(text, groups)
+    result = {
+        'entities': ['%s|%s|%d' % (word, id, start)
+                     for word, start, id in mentions],
+        'ids': dict((id, {'name': word}) for word, _, id in mentions),
+    }
+    if echo:
+        result['text'] = text
+    return result
+
+
+def export(text, format, groups=None):
+    '''Return ``text`` annotations exported in ``format``.'''
+
+    mentions = annotate(text, groups)
+    if format == 'json':
+        return json.dumps(annotation_result(text, groups, echo=True))
+    if format == 'a1':
+        lines = []
+        for i, (word, start, id) in enumerate(mentions, 1):
+            lines.append('T%d\t%s %d %d\t%s' % (i, id.rsplit(':', 1)[1],
+                                                start, start + len(word),
+                                                word))
+            lines.append('N%d\tReference T%d %s\t%s' % (i, i, id, word))
+        return '\n'.join(lines) + '\n' if lines else ''
+    if format == 'conll':
+        groups_at = dict((start, id.rsplit(':', 1)[1])
+                         for _, start, id in mentions)
+        return ''.join('%s\t%d\t%d\t%s\n' % (
+            token.group(), token.start(), token.end(),
+            'B-' + groups_at[token.start()] if token.start() in groups_at
+            else 'O') for token in re.finditer(r'\S+', text))
+    entities, end = [], 0
+    for word, start, id in mentions:
+        entities.append(_xml_escape(text[end:start]))
+        entities.append('<e id="%s">%s</e>' % (id, _xml_escape(word)))
+        end = start + len(word)
+    entities.append(_xml_escape(text[end:]))
+    return '<s>%s</s>' % ''.join(entities)
+
+
+def publication(pmid):
+    '''Return made up ``(title, abstract)`` of publication ``pmid``.'''
+
+    rng = random.Random(pmid)
+    words = ('BRCA1', 'p53', 'breast cancer', 'DNA repair', 'human', 'gene',
+             'expression', 'patients', 'mutation', 'cells', 'protein',
+             'analysis', 'tumour', 'pathway', 'signalling', 'response')
+    title = ' '.join(rng.choice(words) for _ in range(8)).capitalize() + '.'
+    abstract = ' '.join(' '.join(rng.choice(words) for _ in range(15))
+                        .capitalize() + '.' for _ in range(10))
+    return title, abstract
+
+
+def _xml_escape(text):
+    return (text.replace('&', '&amp;').replace('<', '&lt;')
+            .replace('>', '&gt;'))
+
+
+class MockServer(ThreadingMixIn, HTTPServer):
+    '''Threaded HTTP server standing in for the becas API.
+
+    :param address: *optional* ``(host, port)`` to listen on (default: a free
+                    port of ``127.0.0.1``).
+    :param latency: *optional* seconds to wait before answering a request.
+    :param jitter: *optional* seconds of uniform random latency added.
+    :param errors: *optional* :class:`dict` of injected HTTP error status
+                   (413, 429, 502 or 503) to the probability of answering a
+                   request with it.
+    :param retry_after: *optional* ``Retry-After`` seconds sent with
+                        injected 429 and 503 errors.
+    :param max_text: *optional* characters of the longest text accepted
+                     before answering 413.
+    :param capacity: *optional* requests the server can handle at once, the
+                     rest being answered 503 like an overloaded service.
+    :param compressed: *optional* flag to accept compressed request bodies,
+                       else answered 415 (default: ``True``).
+    :param seed: *optional* seed for injected latency and errors.
+    '''
+
+    daemon_threads = True
+    allow_reuse_address = True
+    request_queue_size = 128
+
+    def __init__(self, address=('127.0.0.1', 0), latency=0, jitter=0,
+                 errors=None, retry_after=None, max_text=200000,
+                 capacity=None, compressed=True, seed=None):
+        HTTPServer.__init__(self, address, _Handler)
+        self.latency = latency
+        self.jitter = jitter
+        self.errors = dict(errors or {})
+        self.retry_after = retry_after
+        self.max_text = max_text
+        self.capacity = capacity
+        self.compressed = compressed
+        #: Requests being handled
+        self.in_flight = 0
+        #: Requests received, by endpoint name
+        self.requests = {}
+        #: Responses sent, by status code
+        self.responses = {}
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._thread = None
+
+    @property
+    def url(self):
+        '''Base URL of the becas API of this server, e.g.
+        ``'http://127.0.0.1:8080/becas/api/'``.'''
+
+        return 'http://%s:%d/becas/api/' % self.server_address[:2]
+
+    def start(self):
+        '''Serve requests in a background thread.'''
+
+        self._thread = threading.Thread(target=self.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        '''Stop serving requests and close the listening socket.'''
+
+        self.shutdown()
+        self.server_close()
+        self._thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def handle_error(self, request, client_address):
+        # clients timing out or cancelling requests close connections
+        if not isinstance(sys.exc_info()[1], (IOError, OSError)):
+            HTTPServer.handle_error(self, request, client_address)
+
+    def client(self, **kwargs):
+        '''Return a :class:`becas.BecasClient` sending requests to this
+        server, without rate limiting unless a ``rate_limiter`` is given.'''
+
+        kwargs.setdefault('base_url', self.url)
+        kwargs.setdefault('rate_limiter', becas.RateLimiter(rate=1e9,
+                                                            burst=1e9))
+        return becas.BecasClient(**kwargs)
+
+    def count(self, table, key):
+        with self._lock:
+            table[key] = table.get(key, 0) + 1
+
+    def enter(self):
+        with self._lock:
+            self.in_flight += 1
+
+    def leave(self):
+        with self._lock:
+            self.in_flight -= 1
+
+    def draw(self):
+        '''Return latency and injected error status of a request.'''
+
+        with self._lock:
+            if self.capacity is not None and self.in_flight > self.capacity:
+                return self.latency, 503
+            latency = self.latency + self._random.uniform(0, self.jitter)
+            roll = self._random.random()
+        for status, probability in sorted(self.errors.items()):
+            if roll < probability:
+                return latency, status
+            roll -= probability
+        return latency, None
+
+
+class _Handler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'  # keep-alive
+    disable_nagle_algorithm = True  # don't delay bodies after headers
+
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        server = self.server
+        url = urlsplit(self.path)
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        endpoint = next((name for name, path in PATHS
+                         if url.path.startswith(path)), None)
+        server.count(server.requests, endpoint or url.path)
+        if endpoint is None:
+            return self._send(404, {'error': 'Unknown endpoint'})
+        if not parse_qs(url.query).get('email'):
+            return self._send(403, {'error': 'Missing email parameter'})
+        if self.headers.get('Content-Encoding') and not server.compressed:
+            return self._send(415, {'error': 'Unsupported media type'})
+        try:
+            if self.headers.get('Content-Encoding') == 'gzip':
+                body = gzip.GzipFile(fileobj=io.BytesIO(body)).read()
+            elif self.headers.get('Content-Encoding') == 'deflate':
+                body = zlib.decompress(body)
+            payload = json.loads(body.decode('utf-8')) if body else {}
+        except (IOError, ValueError, zlib.error):
+            return self._send(400, {'error': 'Invalid request body'})
+
+        server.enter()
+        try:
+            self._answer(server, url, endpoint, payload)
+        finally:
+            server.leave()
+
+    def _answer(self, server, url, endpoint, payload):
+        latency, status = server.draw()
+        if latency:
+            time.sleep(latency)
+        if status == 413 or len(payload.get('text', '')) > server.max_text:
+            return self._send(413, {'error': 'Too much text'})
+        if status in (429, 503):
+            headers = {}
+            if server.retry_after is not None:
+                headers['Retry-After'] = str(server.retry_after)
+            return self._send(status, {'error': 'Service busy'}, headers)
+        if status is not None:
+            return self._send(status, None)
+
+        groups = payload.get('groups')
+        if endpoint == 'annotate_text':
+            self._send(200, annotation_result(payload['text'], groups,
+                                              payload.get('echo')))
+        elif endpoint == 'export_text':
+            self._send(200, export(payload['text'], payload['format'],
+                                   groups))
+        else:
+            pmid = url.path.rsplit('/', 1)[1]
+            if not pmid.isdigit() or len(pmid) > 8:
+                return self._send(404, {'error': 'Publication not found'})
+            title, abstract = publication(int(pmid))
+            if endpoint == 'annotate_publication':
+                self._send(200, {
+                    'title': annotation_result(title, groups, echo=True),
+                    'abstract': annotation_result(abstract, groups,
+                                                  echo=True)})
+            else:
+                self._send(200, '<MedlineCitation><PMID>%s</PMID>'
+                           '<ArticleTitle>%s</ArticleTitle>'
+                           '<AbstractText>%s</AbstractText>'
+                           '</MedlineCitation>' % (
+                               pmid, export(title, 'xml', groups),
+                               export(abstract, 'xml', groups)))
+
+    def _send(self, status, content, headers=None):
+        if content is None:
+            body, type_ = b'', 'text/plain'
+        elif isinstance(content, dict):
+            body, type_ = json.dumps(content).encode('utf-8'), \
+                'application/json'
+        else:
+            body, type_ = content.encode('utf-8'), 'text/plain; charset=utf-8'
+        self.server.count(self.server.responses, status)
+        self.send_response(status)
+        if len(body) >= 1024 and \
+                'gzip' in self.headers.get('Accept-Encoding', ''):
+            body = becas._gzip(body)
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Type', type_)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def _error_rate(value):
+    status, _, probability = value.partition(':')
+    if status not in ('413', '429', '502', '503'):
+        raise argparse.ArgumentTypeError('status must be 413, 429, 502 or '
+                                         '503')
+    return int(status), float(probability or 1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--latency', type=float, default=0,
+                        help='seconds to wait before answering')
+    parser.add_argument('--jitter', type=float, default=0,
+                        help='seconds of random latency added')
+    parser.add_argument('--error', type=_error_rate, action='append',
+                        default=[], metavar='STATUS:PROBABILITY',
+                        help='inject error responses (can be repeated)')
+    parser.add_argument('--retry-after', type=int,
+                        help='Retry-After seconds of 429 and 503 errors')
+    args = parser.parse_args()
+
+    server = MockServer((args.host, args.port), latency=args.latency,
+                        jitter=args.jitter, errors=dict(args.error),
+                        retry_after=args.retry_after)
+    print('Serving becas API at %s' % server.url)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        sys.exit(0)
+
+
+if __name__ == '__main__':
+    main()
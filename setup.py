@@ -66,8 +66,9 @@ setup(name='becas',
       license='CC-BY-NC',
       url='http://tnunes.github.io/becas-python/',
       download_url='http://github.com/tnunes/becas-python/tags',
-      install_requires=['requests>=1.2.0'],
-      py_modules=['becas'],
+      install_requires=['requests>=1.2.0',
+                        'futures; python_version < "3"'],
+      py_modules=['becas', 'becas_aio'],
       scripts=['becas.py'],
       platforms='any',
       classifiers=[
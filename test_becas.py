@@ -3,9 +3,519 @@
 
 '''Tests for becas-python.'''
 
+import os
+import sys
+
 import becas
+try:
+    import becas_aio
+except (ImportError, SyntaxError):  # needs Python 3.5+ and aiohttp
+    becas_aio = None
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                'benchmarks'))
+from mock_server import MockServer  # NOQA
+
+
+def requests_to_mock_server():
+    '''Requests go through the client to a local stand-in of the becas API.
+
+    >>> server = MockServer(errors={503: 0.5}, retry_after=0, seed=3).start()
+    >>> client = server.client(
+    ...     email='you@example.com',
+    ...     retry=becas.RetryPolicy(max_attempts=10, backoff=0.001))
+    >>> client.annotate_text('BRCA1 is a human gene.')['entities']
+    ['BRCA1|UNIPROT:P38398:::PRGE|0', 'human|NCBI:9606:::SPEC|11', \
+'gene|UMLS:C0017337:T028:COMP|17']
+    >>> client.export_text('BRCA1 mutations', 'a1').splitlines()[0].split()
+    ['T1', 'PRGE', '0', '5', 'BRCA1']
+    >>> results = [client.annotate_publication(pmid) for pmid in range(1, 11)]
+    >>> server.responses[200] >= 12 and server.responses[503] > 0
+    True
+    >>> client.annotate_publication(123456789)
+    Traceback (most recent call last):
+    ...
+    PublicationNotFound: Publication not found
+
+    Errors are raised once retries are exhausted:
+
+    >>> server.errors = {429: 1}
+    >>> client.annotate_publication(23225384)
+    Traceback (most recent call last):
+    ...
+    TooManyRequests: ...
+    >>> server.errors = {413: 1}
+    >>> client.annotate_text('BRCA1')
+    Traceback (most recent call last):
+    ...
+    TooMuchText: Too much text
+    >>> server.stop()
+
+    '''
+
+
+def resuming_interrupted_bulk_annotation():
+    '''An interrupted annotate-publications run resumes where it stopped.
+
+    >>> import json, tempfile
+    >>> server = MockServer().start()
+    >>> directory = tempfile.mkdtemp()
+    >>> pmid_file = os.path.join(directory, 'pmids.txt')
+    >>> output = os.path.join(directory, 'out.jsonl')
+    >>> with open(pmid_file, 'w') as pmids:
+    ...     _ = pmids.write(''.join('%d\\n' % pmid for pmid in range(1, 31)))
+    >>> def annotate_publications():
+    ...     sys.argv = ['becas.py', 'annotate-publications',
+    ...                 '--email', 'you@example.com', '--base-url', server.url,
+    ...                 '--pmid-file', pmid_file, '-o', output,
+    ...                 '--workers', '2', '--rate', '1e9']
+    ...     becas.main()
+    >>> class Interrupt(BaseException):
+    ...     pass
+    >>> def interrupt(info, requests=[]):
+    ...     requests.append(info)
+    ...     if len(requests) == 11:
+    ...         raise Interrupt()
+    >>> becas.hooks = {'after_request': interrupt}
+    >>> annotate_publications()
+    Traceback (most recent call last):
+    ...
+    Interrupt
+    >>> becas.hooks = None
+    >>> annotate_publications()
+    >>> with open(output) as lines:
+    ...     pmids = [json.loads(line)['pmid'] for line in lines]
+    >>> sorted(pmids) == list(range(1, 31))
+    True
+    >>> becas.email = becas.base_url = None
+    >>> server.stop()
+
+    '''
+
+
+def profiling_bulk_annotation():
+    '''``--profile`` covers the threads annotating in parallel.
+
+    >>> import pstats, tempfile
+    >>> server = MockServer().start()
+    >>> directory = tempfile.mkdtemp()
+    >>> profile = os.path.join(directory, 'becas.prof')
+    >>> pmid_file = os.path.join(directory, 'pmids.txt')
+    >>> with open(pmid_file, 'w') as pmids:
+    ...     _ = pmids.write('1\\n2\\n3\\n')
+    >>> sys.argv = ['becas.py', 'annotate-publications', '--profile', profile,
+    ...             '--email', 'you@example.com', '--base-url', server.url,
+    ...             '--pmid-file', pmid_file, '-o', os.devnull,
+    ...             '--workers', '2', '--rate', '1e9']
+    >>> becas.main()
+    >>> calls = dict((function[2], stats[1]) for function, stats
+    ...              in pstats.Stats(profile).stats.items())
+    >>> calls['_request'], becas._profilers
+    (3, None)
+    >>> becas.email = becas.base_url = None
+    >>> server.stop()
+
+    '''
+
+
+def async_requests_to_mock_server():
+    '''Coroutines of the asyncio client request the becas API alike.
+
+    >>> import asyncio
+    >>> server = MockServer(latency=0.01).start()
+    >>> loop = asyncio.new_event_loop()
+    >>> def client(**kwargs):
+    ...     kwargs.setdefault('base_url', server.url)
+    ...     return becas_aio.AsyncBecasClient(
+    ...         email='you@example.com',
+    ...         rate_limiter=becas.RateLimiter(rate=1e9, burst=1e9), **kwargs)
+    >>> async def endpoints():
+    ...     async with client() as c:
+    ...         return await asyncio.gather(
+    ...             c.annotate_text('BRCA1 is a human gene.'),
+    ...             c.export_text('BRCA1 mutations', 'a1'),
+    ...             c.annotate_publication(23225384),
+    ...             c.export_publication(23225384))
+    >>> text, a1, publication, xml = loop.run_until_complete(endpoints())
+    >>> text['entities'][0], a1.split()[:5]
+    ('BRCA1|UNIPROT:P38398:::PRGE|0', ['T1', 'PRGE', '0', '5', 'BRCA1'])
+    >>> sorted(publication), xml.startswith('<MedlineCitation>')
+    (['abstract', 'title'], True)
+
+    Errors are mapped to the exceptions of :mod:`becas`:
+
+    >>> async def request(coroutine, **kwargs):
+    ...     async with client(**kwargs) as c:
+    ...         return await coroutine(c)
+    >>> loop.run_until_complete(request(
+    ...     lambda c: c.annotate_publication(123456789)))
+    Traceback (most recent call last):
+    ...
+    PublicationNotFound: Publication not found
+    >>> server.errors = {503: 1}
+    >>> loop.run_until_complete(request(lambda c: c.annotate_text('BRCA1')))
+    Traceback (most recent call last):
+    ...
+    ServiceUnavailable: ...
+    >>> server.errors = {}
+    >>> loop.run_until_complete(request(lambda c: c.annotate_text('BRCA1'),
+    ...                                 timeout=0.001))
+    Traceback (most recent call last):
+    ...
+    Timeout: ...
+
+    Cancelling a request releases what it holds:
+
+    >>> balancer = becas.Balancer(server.url)
+    >>> concurrency = becas.AdaptiveConcurrency(initial=1)
+    >>> async def cancel():
+    ...     async with client(base_url=balancer, concurrency=concurrency,
+    ...                       coalesce=False) as c:
+    ...         task = asyncio.ensure_future(c.annotate_text('BRCA1'))
+    ...         await asyncio.sleep(0.005)
+    ...         task.cancel()
+    ...         try:
+    ...             await task
+    ...         except asyncio.CancelledError:
+    ...             return 'cancelled'
+    >>> loop.run_until_complete(cancel())
+    'cancelled'
+    >>> concurrency.in_flight, balancer.stats()[0]['outstanding']
+    (0, 0)
+
+    Cancelling the last caller of a coalesced request cancels the request:
+
+    >>> async def cancel_coalesced(n):
+    ...     async with client(base_url=balancer,
+    ...                       concurrency=concurrency) as c:
+    ...         tasks = [asyncio.ensure_future(c.annotate_text('BRCA1'))
+    ...                  for _ in range(n)]
+    ...         await asyncio.sleep(0.005)
+    ...         for task in tasks[1:]:
+    ...             task.cancel()
+    ...         await asyncio.sleep(0.005)
+    ...         before = concurrency.in_flight
+    ...         tasks[0].cancel()
+    ...         await asyncio.gather(*tasks, return_exceptions=True)
+    ...         await asyncio.sleep(0.005)
+    ...         return (before, concurrency.in_flight,
+    ...                 balancer.stats()[0]['outstanding'], c._in_flight)
+    >>> server.latency = 0.5
+    >>> loop.run_until_complete(cancel_coalesced(3))
+    (1, 0, 0, {})
+    >>> loop.close(), server.stop()
+    (None, None)
+
+    '''
+
+
+def coalescing_identical_requests():
+    '''Identical requests in flight at once share a single response.
+
+    >>> import threading
+    >>> server = MockServer(latency=0.2).start()
+    >>> client = server.client(email='you@example.com')
+    >>> def concurrently(n=8):
+    ...     results = []
+    ...     def annotate():
+    ...         try:
+    ...             results.append(client.annotate_text('BRCA1 mutations'))
+    ...         except becas.BecasException as e:
+    ...             results.append(e)
+    ...     threads = [threading.Thread(target=annotate) for _ in range(n)]
+    ...     for thread in threads:
+    ...         thread.start()
+    ...     for thread in threads:
+    ...         thread.join()
+    ...     return results
+    >>> results = concurrently()
+    >>> server.requests, client.coalesced > 0, len(results)
+    ({'annotate_text': 1}, True, 8)
+
+    Errors are raised in every caller:
+
+    >>> server.errors = {413: 1}
+    >>> [type(result).__name__ for result in concurrently()] == \\
+    ...     ['TooMuchText'] * 8
+    True
+    >>> server.requests
+    {'annotate_text': 2}
+    >>> server.stop()
+
+    '''
+
+
+def uncompressed_when_rejected():
+    '''Requests are sent again uncompressed if the service rejects them.
+
+    >>> server = MockServer(compressed=False).start()
+    >>> rate_limiter = becas.RateLimiter(rate=1e9, burst=1e9)
+    >>> events = []
+    >>> client = server.client(
+    ...     email='you@example.com', compress_requests='gzip',
+    ...     rate_limiter=rate_limiter,
+    ...     hooks={'after_request': lambda info: events.append(info.status),
+    ...            'retry': lambda info: events.append('retry')})
+    >>> result = client.annotate_text('BRCA1 mutations. ' * 100)
+    >>> events, client.compress_requests
+    ([415, 'retry', 200], None)
+    >>> server.requests, rate_limiter.stats()['requests']
+    ({'annotate_text': 2}, 2)
+    >>> client.metrics.snapshot()['endpoints']['annotate_text']['requests']
+    2
+    >>> server.stop()
+
+    '''
+
+
+def failing_hooks_release_requests():
+    '''Hooks raising errors don't leak requests in flight.
+
+    >>> server = MockServer().start()
+    >>> def fail(info):
+    ...     raise becas.BecasException('hook failed')
+    >>> balancer = becas.Balancer(server.url)
+    >>> concurrency = becas.AdaptiveConcurrency(initial=1)
+    >>> client = server.client(email='you@example.com', base_url=balancer,
+    ...                        concurrency=concurrency,
+    ...                        hooks={'before_request': fail})
+    >>> for _ in range(3):
+    ...     try:
+    ...         client.annotate_text('BRCA1')
+    ...     except becas.BecasException as e:
+    ...         print(e)
+    hook failed
+    hook failed
+    hook failed
+    >>> concurrency.in_flight, balancer.stats()[0]['outstanding']
+    (0, 0)
+    >>> server.requests
+    {}
+    >>> server.stop()
+
+    '''
+
+
+def adaptive_concurrency_of_requests():
+    '''Clients adapt the concurrency limit to the outcome of requests.
+
+    >>> server = MockServer().start()
+    >>> concurrency = becas.AdaptiveConcurrency(initial=4,
+    ...                                         latency_tolerance=None)
+    >>> client = server.client(email='you@example.com',
+    ...                        concurrency=concurrency)
+    >>> results = [client.annotate_text('BRCA1 %d' % i) for i in range(4)]
+    >>> concurrency.limit > 4
+    True
+
+    Errors being handled by the caller don't count as overload:
+
+    >>> try:
+    ...     raise becas.TooManyRequests(wait=None)
+    ... except becas.TooManyRequests:
+    ...     result = client.annotate_text('BRCA1')
+    >>> concurrency.decreases
+    0
+    >>> server.errors = {503: 1}
+    >>> client.annotate_text('p53')
+    Traceback (most recent call last):
+    ...
+    ServiceUnavailable: ...
+    >>> concurrency.decreases, concurrency.limit < 4, concurrency.in_flight
+    (1, True, 0)
+    >>> server.stop()
+
+    '''
+
+
+def async_adaptive_concurrency_of_requests():
+    '''Coroutines wait for the concurrency limit without blocking.
+
+    >>> import asyncio
+    >>> server = MockServer(latency=0.02).start()
+    >>> concurrency = becas.AdaptiveConcurrency(initial=1, maximum=1)
+    >>> async def annotate(n):
+    ...     async with becas_aio.AsyncBecasClient(
+    ...             email='you@example.com', base_url=server.url,
+    ...             rate_limiter=becas.RateLimiter(rate=1e9),
+    ...             concurrency=concurrency) as c:
+    ...         return await asyncio.gather(
+    ...             *[c.annotate_text('BRCA1 %d' % i) for i in range(n)])
+    >>> loop = asyncio.new_event_loop()
+    >>> len(loop.run_until_complete(annotate(5)))
+    5
+    >>> server.requests, concurrency.in_flight, concurrency._waiters
+    ({'annotate_text': 5}, 0, [])
+    >>> loop.close(), server.stop()
+    (None, None)
+
+    '''
+
+
+def async_coalescing_identical_requests():
+    '''Identical coroutines in flight at once share a single response.
+
+    >>> import asyncio
+    >>> server = MockServer(latency=0.05).start()
+    >>> loop = asyncio.new_event_loop()
+    >>> async def concurrently(n=8):
+    ...     async with becas_aio.AsyncBecasClient(
+    ...             email='you@example.com', base_url=server.url,
+    ...             rate_limiter=becas.RateLimiter(rate=1e9)) as c:
+    ...         results = await asyncio.gather(
+    ...             *[c.annotate_text('BRCA1 mutations') for _ in range(n)],
+    ...             return_exceptions=True)
+    ...         return c.coalesced, [type(result).__name__
+    ...                              for result in results]
+    >>> coalesced, results = loop.run_until_complete(concurrently())
+    >>> server.requests, coalesced, results == ['dict'] * 8
+    ({'annotate_text': 1}, 7, True)
+    >>> server.errors = {413: 1}
+    >>> coalesced, results = loop.run_until_complete(concurrently())
+    >>> server.requests, coalesced, results == ['TooMuchText'] * 8
+    ({'annotate_text': 2}, 7, True)
+    >>> loop.close(), server.stop()
+    (None, None)
+
+    '''
+
+
+if becas_aio is None:
+    del async_requests_to_mock_server, async_coalescing_identical_requests
+    del async_adaptive_concurrency_of_requests
+
+
+def bounded_interning():
+    '''Interned mentions and concepts don't grow without limit.
+
+    >>> import gc
+    >>> results = [becas.AnnotationResult(
+    ...     {'entities': ['word%d|MOCK:%d:::PRGE|0' % (i, i)]})
+    ...     for i in range(becas._MAX_MENTIONS + 100)]
+    >>> sum(len(result) for result in results)
+    65636
+    >>> len(becas._mentions) <= becas._MAX_MENTIONS
+    True
+    >>> concept = results[0].entities[0].concepts[0]
+    >>> concept is becas.Concept.get('MOCK:0:::PRGE')
+    True
+    >>> del results, concept
+    >>> _ = gc.collect()
+    >>> len(becas.Concept._interned) <= becas._MAX_MENTIONS
+    True
+
+    '''
+
+
+def failover_between_instances():
+    '''Requests fail over to healthy instances of the becas API.
+
+    >>> down = MockServer(errors={503: 1}).start()
+    >>> up = MockServer().start()
+    >>> balancer = becas.Balancer([down.url, up.url], cooldown=60)
+    >>> client = up.client(email='you@example.com', base_url=balancer)
+    >>> results = [client.annotate_text('BRCA1 %d' % i) for i in range(6)]
+    >>> down.requests, up.requests
+    ({'annotate_text': 1}, {'annotate_text': 6})
+    >>> [(stats['healthy'], stats['errors']) for stats in balancer.stats()]
+    [(False, 1), (True, 0)]
+
+    Errors being handled by the caller don't count as outages:
+
+    >>> try:
+    ...     raise becas.ServiceUnavailable()
+    ... except becas.ServiceUnavailable:
+    ...     result = client.annotate_text('p53')
+    >>> [(stats['healthy'], stats['errors']) for stats in balancer.stats()]
+    [(False, 1), (True, 0)]
+
+    Once all instances fail, the retry policy decides:
+
+    >>> up.errors = {502: 1}
+    >>> client.annotate_text('BRCA1')
+    Traceback (most recent call last):
+    ...
+    ServiceUnavailable: ...
+    >>> down.stop(), up.stop()
+    (None, None)
+
+    '''
+
+
+def export_formats_from_one_request():
+    '''Several export formats can be rendered from a single request.
+
+    >>> server = MockServer().start()
+    >>> client = server.client(email='you@example.com')
+    >>> text = 'BRCA1 mutations cause breast cancer in human patients.'
+    >>> results = client.export_text_formats(text, 'json,a1,conll')
+    >>> server.requests
+    {'export_text': 3}
+    >>> all(results[format] == client.export_text(text, format)
+    ...     for format in ('json', 'a1', 'conll'))
+    True
+
+    Rendered locally, CoNLL differs from the service's:
+
+    >>> server.requests.clear()
+    >>> local = client.export_text_formats(text, 'json,a1,conll',
+    ...                                    render_locally=True)
+    >>> server.requests
+    {'export_text': 1}
+    >>> local['json'] == results['json']
+    True
+    >>> [line.split()[-1] for line in local['conll'].splitlines()][3:5]
+    ['B-DISO', 'I-DISO']
+    >>> [line.split()[-1] for line in results['conll'].splitlines()][3:5]
+    ['B-DISO', 'O']
+    >>> server.stop()
+
+    '''
+
+
+def narrower_groups_from_one_request():
+    '''Requests for different semantic groups share a single result.
+
+    >>> server = MockServer().start()
+    >>> client = server.client(email='you@example.com', superset_groups=True,
+    ...                        cache=becas.ResultCache(':memory:'))
+    >>> text = 'BRCA1 mutations cause breast cancer in human patients.'
+    >>> client.annotate_text(text, {'PRGE': True})['entities']
+    ['BRCA1|UNIPROT:P38398:::PRGE|0']
+    >>> client.annotate_text(text, {'SPEC': True})['entities']
+    ['human|NCBI:9606:::SPEC|39']
+    >>> client.annotate_text(text)['entities'][0]
+    'BRCA1|UNIPROT:P38398:::PRGE|0'
+    >>> server.requests
+    {'annotate_text': 1}
+    >>> server.stop()
+
+    '''
+
+
+def repeated_sentences_annotated_once():
+    '''Batches can annotate sentences repeated across texts only once.
+
+    >>> server = MockServer().start()
+    >>> client = server.client(email='you@example.com')
+    >>> texts = ['Confidential. BRCA1 mutations cause breast cancer.',
+    ...          'Confidential. Human patients.', 'Confidential.']
+    >>> index = becas.SentenceIndex()
+    >>> results = [result.result for result in
+    ...            client.annotate_texts(texts, dedupe=index)]
+    >>> results == [client.annotate_text(text) for text in texts]
+    True
+    >>> server.requests['annotate_text'] - len(texts)
+    2
+    >>> sorted(index.stats().items())
+    [('entries', 3), ('hits', 2), ('sentences', 5), ('unique', 3)]
+    >>> server.stop()
+
+    '''
 
 
 if __name__ == '__main__':
     import doctest
     doctest.testmod(becas)
+    doctest.testmod(optionflags=doctest.ELLIPSIS |
+                    doctest.IGNORE_EXCEPTION_DETAIL)